@@ -0,0 +1,244 @@
+import csv
+import datetime
+import mmap
+import struct
+from collections import namedtuple
+from decimal import Decimal
+
+import invest
+from stock_pricer import StockPricer
+from util import Buy, Money, from_cents, from_fixed, to_fixed
+
+
+# A header with the date and symbol counts, the symbols as NUL padded
+# strings, the dates as proleptic Gregorian ordinals and then one row of
+# prices per date in units of 0.0001, zero where a symbol has no price
+MAGIC = 'PBHIST01'
+HEADER = struct.Struct('<8sII')
+SYMBOL = struct.Struct('<16s')
+PRICE_PLACES = 4
+
+BacktestStep = namedtuple('BacktestStep', 'date value cash drift cash_drag buys')
+
+
+def write_price_history(path, dates, symbols, rows):
+    row_struct = struct.Struct('<%dq' % len(symbols))
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(dates), len(symbols)))
+        for symbol in symbols:
+            if len(symbol) > SYMBOL.size:
+                raise ValueError('Symbol too long: %r' % symbol)
+            f.write(SYMBOL.pack(symbol))
+        f.write(struct.pack('<%di' % len(dates), *[date.toordinal() for date in dates]))
+        num_rows = 0
+        for row in rows:
+            f.write(row_struct.pack(*[to_fixed(price, PRICE_PLACES) if price else 0
+                                      for price in row]))
+            num_rows += 1
+    if num_rows != len(dates):
+        raise ValueError('%d price rows for %d dates' % (num_rows, len(dates)))
+
+
+def read_price_csv(csv_file):
+    # A date column followed by a column per symbol; empty cells have no price
+    reader = csv.reader(csv_file)
+    symbols = next(reader)[1:]
+    dates = []
+    rows = []
+    for line in reader:
+        dates.append(datetime.datetime.strptime(line[0], '%Y-%m-%d').date())
+        rows.append([Decimal(cell) if cell.strip() else None for cell in line[1:]])
+    return dates, symbols, rows
+
+
+class PriceHistory(object):
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, num_dates, num_symbols = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError('Not a price history: %s' % path)
+        offset = HEADER.size
+        self.symbols = [SYMBOL.unpack_from(self._map, offset + i * SYMBOL.size)[0].rstrip('\0')
+                        for i in range(num_symbols)]
+        self.symbol_indices = dict((symbol, i) for i, symbol in enumerate(self.symbols))
+        offset += num_symbols * SYMBOL.size
+        self.dates = [datetime.date.fromordinal(ordinal) for ordinal in
+                      struct.unpack_from('<%di' % num_dates, self._map, offset)]
+        self._rows_offset = offset + 4 * num_dates
+        self._row = struct.Struct('<%dq' % num_symbols)
+
+    def __len__(self):
+        return len(self.dates)
+
+    def row(self, i):
+        return self._row.unpack_from(self._map, self._rows_offset + i * self._row.size)
+
+
+class HistoryPricer(StockPricer):
+    # The prices of one date of a history. Stocks without a price on the
+    # date cannot be bought but are valued at their last known price.
+    def __init__(self, history):
+        self._history = history
+        self._units = self._last_units = (0,) * len(history.symbols)
+        self._prices = {}
+
+    def set_date(self, i):
+        self._units = self._history.row(i)
+        self._last_units = tuple(units or last_units for units, last_units
+                                 in zip(self._units, self._last_units))
+        self._prices = {}
+
+    def is_available(self, stock):
+        return self._units[self._history.symbol_indices[stock.symbol]] > 0
+
+    def get_price(self, stock):
+        try:
+            return self._prices[stock.symbol]
+        except KeyError:
+            units = self._last_units[self._history.symbol_indices[stock.symbol]]
+            if not units:
+                raise KeyError('No price for %s' % stock.symbol)
+            if units % 100:
+                price = Money(from_fixed(units, PRICE_PLACES))
+            else:
+                price = from_cents(units // 100)
+            self._prices[stock.symbol] = price
+            return price
+
+    def get_name(self, stock):
+        return stock.symbol
+
+
+def get_proportional_buys(portfolio, target_allocation, available_stocks, money, pricer):
+    # Like seligson.calculate_investments: each asset class gets its share of
+    # the money needed to reach its target, spent on whole shares of the
+    # first available stock of the class
+    class_stocks = {}
+    for stock in available_stocks:
+        class_stocks.setdefault(stock.asset_class, stock)
+    deficits = invest.get_asset_class_deficits(portfolio, target_allocation, money)
+    buys = []
+    new_portfolio = portfolio.clone()
+    money_remaining = money
+    for asset_class, deficit in sorted(deficits.items()):
+        stock = class_stocks.get(asset_class)
+        if stock is None:
+            continue
+        price = pricer.get_price(stock)
+        amount = int(min(deficit, money_remaining) / price)
+        if amount > 0:
+            new_portfolio.add_stock(stock, amount)
+            money_remaining -= amount * price
+            buys.append(Buy(stock, amount))
+    return buys, new_portfolio, money_remaining
+
+
+STRATEGIES = dict(invest.BUY_STRATEGIES, proportional=get_proportional_buys)
+
+
+def calculate_drift(portfolio, target_allocation):
+    # Half the summed absolute deviations from the targets, in percentage
+    # points: the share of the portfolio in the wrong asset classes
+    value = portfolio.value
+    if not value:
+        return 0.0
+    return sum(abs(100.0 * float(portfolio.asset_class_value(asset_class)) / float(value) -
+                   percent)
+               for asset_class, percent in target_allocation) / 2
+
+
+def run_backtest(history, portfolio, target_allocation, available_stocks, contribution,
+                 strategy=invest.get_next_buys):
+    # Contributes at every date of the history and carries the portfolio and
+    # the money left over to the next date
+    pricer = HistoryPricer(history)
+    previous_pricer = StockPricer.get_pricer()
+    StockPricer.set_pricer(pricer)
+    try:
+        portfolio = portfolio.clone()
+        cash = Money(0)
+        steps = []
+        for i, date in enumerate(history.dates):
+            pricer.set_date(i)
+            portfolio.reprice()
+            money = cash + contribution
+            stocks = [stock for stock in available_stocks if pricer.is_available(stock)]
+            buys = []
+            if stocks and money > 0:
+                buys, portfolio, cash = strategy(portfolio, target_allocation, stocks, money,
+                                                 pricer)
+            else:
+                cash = money
+            value = portfolio.value
+            cash_drag = 100.0 * float(cash) / float(value + cash) if value + cash else 0.0
+            steps.append(BacktestStep(date, value, cash,
+                                      calculate_drift(portfolio, target_allocation), cash_drag,
+                                      buys))
+        return steps
+    finally:
+        StockPricer.set_pricer(previous_pricer)
+
+
+def summarize(steps, contribution):
+    drifts = [step.drift for step in steps]
+    cash_drags = [step.cash_drag for step in steps]
+    return {'contributed': contribution * len(steps),
+            'value': steps[-1].value if steps else Money(0),
+            'cash': steps[-1].cash if steps else Money(0),
+            'mean_drift': sum(drifts) / len(drifts) if drifts else 0.0,
+            'max_drift': max(drifts) if drifts else 0.0,
+            'mean_cash_drag': sum(cash_drags) / len(cash_drags) if cash_drags else 0.0}
+
+
+def write_steps(output, strategy_steps):
+    writer = csv.writer(output)
+    writer.writerow(['strategy', 'date', 'value', 'cash', 'drift', 'cash_drag'])
+    for name, steps in strategy_steps:
+        for step in steps:
+            writer.writerow([name, step.date.isoformat(), step.value, step.cash,
+                             '%.4f' % step.drift, '%.4f' % step.cash_drag])
+
+
+def main(portfolio, target_allocation, available_stocks, history, contribution, strategies,
+         steps_output=None):
+    strategy_steps = []
+    print '%-12s %12s %12s %10s %10s %10s %10s' % ('Strategy', 'Contributed', 'Value', 'Cash',
+                                                    'Drift', 'Max drift', 'Cash drag')
+    for name in strategies:
+        steps = run_backtest(history, portfolio, target_allocation, available_stocks,
+                             contribution, STRATEGIES[name])
+        summary = summarize(steps, contribution)
+        print '%-12s %12.2f %12.2f %10.2f %9.2f%% %9.2f%% %9.2f%%' % (
+            name, summary['contributed'], summary['value'], summary['cash'],
+            summary['mean_drift'], summary['max_drift'], summary['mean_cash_drag'])
+        strategy_steps.append((name, steps))
+    if steps_output is not None:
+        write_steps(steps_output, strategy_steps)
+    return strategy_steps
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('portfolio')
+    parser.add_argument('history', help='price history file')
+    parser.add_argument('-c', '--contribution', help='money invested at every date',
+                        type=Money, required=True)
+    parser.add_argument('-s', '--strategies', help='comma separated strategies out of %s' %
+                        ', '.join(sorted(STRATEGIES)), default='greedy,proportional')
+    parser.add_argument('--from-csv', help='write the history file from a CSV of prices first',
+                        metavar='CSV')
+    parser.add_argument('--steps', help='write every step to a CSV file', metavar='FILE')
+    args = parser.parse_args()
+
+    strategies = args.strategies.split(',')
+    for name in strategies:
+        if name not in STRATEGIES:
+            parser.error('unknown strategy %s' % name)
+    if args.from_csv:
+        write_price_history(args.history, *read_price_csv(open(args.from_csv)))
+    portfolio, target_allocation, available_stocks = invest.read_invest_file(open(args.portfolio))
+    steps_output = open(args.steps, 'wb') if args.steps else None
+    main(portfolio, target_allocation, available_stocks, PriceHistory(args.history),
+         args.contribution, strategies, steps_output)
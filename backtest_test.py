@@ -0,0 +1,119 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+from cStringIO import StringIO
+from decimal import Decimal
+
+from mock import patch
+
+import invest
+from stock_pricer import StockPricer
+from util import Buy, Money, Stock
+from backtest import *
+
+
+stock1 = Stock('SYM1', 'bond')
+stock2 = Stock('SYM2', 'world')
+dates = [datetime.date(2013, month, 1) for month in (1, 2, 3)]
+
+
+class HistoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'prices.hist')
+        write_price_history(self.path, dates, ['SYM1', 'SYM2'],
+                            [[Money(10), None], [Money(11), Money(5)],
+                             [None, Decimal('5.1234')]])
+        self.history = PriceHistory(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+class PriceHistoryTest(HistoryTestCase):
+    def test_round_trip(self):
+        self.assertEqual(dates, self.history.dates)
+        self.assertEqual(['SYM1', 'SYM2'], self.history.symbols)
+        self.assertEqual(3, len(self.history))
+        self.assertEqual((110000, 50000), self.history.row(1))
+        self.assertEqual((0, 51234), self.history.row(2))
+
+    def test_row_count_checked(self):
+        self.assertRaises(ValueError, write_price_history, self.path, dates, ['SYM1'], [[1]])
+
+    def test_read_price_csv(self):
+        csv_file = StringIO('date,SYM1,SYM2\n2013-01-01,10.00,\n2013-02-01,11,5\n')
+        self.assertEqual((dates[:2], ['SYM1', 'SYM2'],
+                          [[Decimal('10.00'), None], [Decimal('11'), Decimal('5')]]),
+                         read_price_csv(csv_file))
+
+
+class HistoryPricerTest(HistoryTestCase):
+    def test_prices_of_date(self):
+        pricer = HistoryPricer(self.history)
+        pricer.set_date(0)
+        self.assertTrue(pricer.is_available(stock1))
+        self.assertFalse(pricer.is_available(stock2))
+        self.assertEqual(Money(10), pricer.get_price(stock1))
+        self.assertRaises(KeyError, pricer.get_price, stock2)
+
+    def test_last_known_price(self):
+        pricer = HistoryPricer(self.history)
+        for i in range(3):
+            pricer.set_date(i)
+        self.assertFalse(pricer.is_available(stock1))
+        self.assertEqual(Money(11), pricer.get_price(stock1))
+        self.assertEqual(Money('5.12'), pricer.get_price(stock2))
+
+
+class GetProportionalBuysTest(HistoryTestCase):
+    def test(self):
+        pricer = HistoryPricer(self.history)
+        pricer.set_date(1)
+        StockPricer.set_pricer(pricer)
+        target_allocation = invest.Allocation({'bond': 50, 'world': 50})
+        buys, portfolio, money_remaining = get_proportional_buys(
+            invest.Portfolio(), target_allocation, [stock1, stock2], Money(50), pricer)
+        self.assertEqual([Buy(stock1, 2), Buy(stock2, 5)], buys)
+        self.assertEqual(Money(3), money_remaining)
+
+
+class RunBacktestTest(HistoryTestCase):
+    def test(self):
+        previous_pricer = StockPricer.get_pricer()
+        target_allocation = invest.Allocation({'bond': 50, 'world': 50})
+        steps = run_backtest(self.history, invest.Portfolio(), target_allocation,
+                             [stock1, stock2], Money(30))
+        self.assertEqual(dates, [step.date for step in steps])
+        self.assertEqual([Buy(stock1, 3)], steps[0].buys)
+        self.assertEqual(Money(30), steps[0].value)
+        self.assertEqual(Money(0), steps[0].cash)
+        self.assertEqual(50.0, steps[0].drift)
+        self.assertEqual([Buy(stock2, 6)], steps[1].buys)
+        self.assertEqual(Money(63), steps[1].value)
+        self.assertTrue(steps[2].cash < Money('5.12'))
+        self.assertIs(previous_pricer, StockPricer.get_pricer())
+
+    def test_summarize(self):
+        target_allocation = invest.Allocation({'bond': 50, 'world': 50})
+        steps = run_backtest(self.history, invest.Portfolio(), target_allocation,
+                             [stock1, stock2], Money(30), get_proportional_buys)
+        summary = summarize(steps, Money(30))
+        self.assertEqual(Money(90), summary['contributed'])
+        self.assertEqual(steps[-1].value, summary['value'])
+        self.assertEqual(max(step.drift for step in steps), summary['max_drift'])
+
+
+class MainTest(HistoryTestCase):
+    @patch('sys.stdout')
+    def test_writes_steps(self, stdout):
+        steps_output = StringIO()
+        target_allocation = invest.Allocation({'bond': 50, 'world': 50})
+        main(invest.Portfolio(), target_allocation, [stock1, stock2], self.history, Money(30),
+             ['greedy', 'proportional'], steps_output)
+        lines = steps_output.getvalue().splitlines()
+        self.assertEqual('strategy,date,value,cash,drift,cash_drag', lines[0])
+        self.assertEqual(7, len(lines))
+        self.assertTrue(lines[1].startswith('greedy,2013-01-01,30.00,0.00,'))
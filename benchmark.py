@@ -0,0 +1,389 @@
+import datetime
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import timeit
+from decimal import Decimal
+from random import Random
+from cStringIO import StringIO
+
+import backtest
+import invest
+import rebalance
+import report
+import seligson
+import seligson_batch
+from stock_pricer import (CHUNK_SIZE, StockPricer, TableStockPricer, YahooStockPricer,
+                          parse_yahoo_quote)
+from util import Money, Stock, divide_half_even, from_cents, to_cents, to_fixed
+
+
+def time_call(function, repeat=5, number=100):
+    return min(timeit.repeat(function, repeat=repeat, number=number)) / number
+
+
+def split_evenly(total, parts):
+    return [total // parts + (1 if i < total % parts else 0) for i in range(parts)]
+
+
+def make_invest_case(num_stocks, num_asset_classes, money, num_held=None, seed=0):
+    random = Random(seed)
+    asset_classes = ['class%d' % i for i in range(num_asset_classes)]
+    stocks = [Stock('SYN%d' % i, asset_classes[i % num_asset_classes])
+              for i in range(num_stocks)]
+    quotes = dict((stock.symbol, ('Synthetic %d' % i, Money(random.randint(500, 50000)) / 100))
+                  for i, stock in enumerate(stocks))
+    portfolio = invest.Portfolio()
+    for stock in random.sample(stocks, min(num_held or num_stocks // 2, num_stocks)):
+        portfolio.add_stock(stock, random.randint(1, 100))
+    target_allocation = invest.Allocation(zip(asset_classes,
+                                              split_evenly(100, num_asset_classes)))
+    return portfolio, target_allocation, stocks, Money(money), TableStockPricer(quotes)
+
+
+def make_price_history(path, stocks, pricer, num_months, seed=0):
+    # Monthly prices from a random walk starting at the pricer's prices
+    random = Random(seed)
+    prices = [pricer.get_price(stock) for stock in stocks]
+    dates = []
+    rows = []
+    for month in range(num_months):
+        dates.append(datetime.date(2000 + month // 12, month % 12 + 1, 1))
+        rows.append(prices)
+        prices = [max(Money(price * Decimal(random.gauss(1.005, 0.04))), Money('0.01'))
+                  for price in prices]
+    backtest.write_price_history(path, dates, [stock.symbol for stock in stocks], rows)
+    return backtest.PriceHistory(path)
+
+
+def make_fund_values_html(fund_names, seed=0):
+    random = Random(seed)
+    rows = ''.join('<tr><td><a href="f%d.htm">%s</a></td><td>17.10.2013</td>'
+                   '<td>%d,%04d</td><td>+0,5</td></tr>\n'
+                   % (i, name, random.randint(1, 30), random.randint(0, 9999))
+                   for i, name in enumerate(fund_names))
+    return ('<html><head><meta charset="iso-8859-1"></head><body>\n'
+            '<table><tr><td><a href="/">Etusivu</a></td><td>Valikko</td></tr></table>\n'
+            '<table>\n<tr><th>Rahasto</th><th>Pvm</th><th>Arvo</th></tr>\n'
+            + rows + '</table></body></html>')
+
+
+def make_seligson_case(num_funds, amount, seed=0):
+    random = Random(seed)
+    names = ['Rahasto %d' % i for i in range(num_funds)]
+    portfolio = seligson.Portfolio()
+    for name, tenths in zip(names, split_evenly(1000, num_funds)):
+        portfolio.add_fund(seligson.Fund(name, Decimal(random.randint(0, 10**7)) / 10**4,
+                                         Decimal(tenths) / 10,
+                                         random.choice([0, 0, Decimal('0.5')])))
+    html = make_fund_values_html(names, seed)
+    pricer = seligson.Pricer(lambda: html)
+    return portfolio, seligson.Money(amount), pricer
+
+
+def parse_yahoo_quote_with_full_page_regexes(html):
+    # The quote parsing used before streaming, kept as a reference point
+    name = re.search('<div class="title"><h2>(.*?) \(.*\)</h2>', html).group(1)
+    price = Money(re.search('<span class="time_rtq_ticker"><span id=".*?">(\d+.\d+)</span>',
+                            html).group(1))
+    return name, price
+
+
+def bench_yahoo_parse(html_path='yahoo.html'):
+    html = open(html_path).read()
+    chunks = [html[i:i + CHUNK_SIZE] for i in range(0, len(html), CHUNK_SIZE)]
+    return {'yahoo_full_page_regexes': time_call(
+                lambda: parse_yahoo_quote_with_full_page_regexes(html)),
+            'yahoo_precompiled_regexes': time_call(
+                lambda: (YahooStockPricer.parse_yahoo_stock_name(html),
+                         YahooStockPricer.parse_yahoo_stock_price(html))),
+            'yahoo_streaming': time_call(lambda: parse_yahoo_quote(iter(chunks)))}
+
+
+def bench_fund_values_parse(html_path='fundvalues.html'):
+    if os.path.exists(html_path):
+        html = open(html_path).read()
+    else:
+        html = make_fund_values_html(['Rahasto %d' % i for i in range(40)])
+    return {'fund_values_parse': time_call(lambda: seligson.parse_fund_values(html),
+                                           number=20)}
+
+
+INVEST_CASES = [
+    # name, solver, stocks, asset classes, money, timing number
+    ('greedy_20x4_1k', 'greedy', 20, 4, 1000, 10),
+    ('greedy_100x8_10k', 'greedy', 100, 8, 10000, 1),
+    ('greedy_fixed_100x8_10k', 'greedy_fixed', 100, 8, 10000, 1),
+    ('vectorized_100x8_10k', 'vectorized', 100, 8, 10000, 1),
+    ('allocation_200x10_50k', 'allocation', 200, 10, 50000, 1),
+    ('lot_200x10_50k', 'lot', 200, 10, 50000, 1),
+    ('optimal_200x10_5k', 'optimal', 200, 10, 5000, 1),
+]
+
+
+def bench_invest(cases=INVEST_CASES):
+    solvers = dict(invest.BUY_STRATEGIES)
+    solvers['greedy_fixed'] = lambda *args: invest.get_next_buys(*args, fixed_point=True)
+    results = {}
+    for name, solver, num_stocks, num_asset_classes, money, number in cases:
+        if solver == 'vectorized' and invest.numpy is None:
+            continue
+        portfolio, target_allocation, stocks, money, pricer = make_invest_case(
+            num_stocks, num_asset_classes, money)
+        StockPricer.set_pricer(pricer)
+        results['invest_' + name] = time_call(
+            lambda: solvers[solver](portfolio, target_allocation, stocks, money, pricer),
+            repeat=3, number=number)
+    return results
+
+
+def bench_portfolio_value(num_stocks=1000, num_asset_classes=10):
+    portfolio, _, _, _, pricer = make_invest_case(num_stocks, num_asset_classes, 0,
+                                                  num_held=num_stocks)
+    StockPricer.set_pricer(pricer)
+    holdings = list(portfolio)
+
+    def value():
+        # A fresh portfolio, since the asset class values are cached
+        portfolio = invest.Portfolio()
+        for stock, amount in holdings:
+            portfolio.add_stock(stock, amount)
+        return portfolio.value
+    return {'portfolio_value_%d' % num_stocks: time_call(value, number=10)}
+
+
+def bench_seligson(num_funds=200, amount=10000):
+    portfolio, amount, pricer = make_seligson_case(num_funds, amount)
+    investments = [seligson.Investment(fund, seligson.Money(Random(i).randint(-5000, 5000)))
+                   for i, fund in enumerate(portfolio.funds)]
+    results = {}
+    for suffix, fixed_point in [('', False), ('_fixed', True)]:
+        results['seligson_calculate_investments%s_%d' % (suffix, num_funds)] = time_call(
+            lambda: seligson.calculate_investments(portfolio, amount, pricer,
+                                                   fixed_point=fixed_point),
+            number=2)
+        results['seligson_adjust_investments%s_%d' % (suffix, num_funds)] = time_call(
+            lambda: seligson.adjust_investments(investments, amount, fixed_point),
+            number=5)
+    return results
+
+
+def adjust_investments_by_repeated_cuts(investments, target_amount):
+    # The quadratic adjustment used before water-filling, kept as a reference point
+    while 1:
+        total_investment = sum(i.amount for i in investments)
+        excess = total_investment - target_amount
+        n = len(investments)
+        per_investment_excess = excess / n
+        investments = [i for i in investments if i.amount >= per_investment_excess]
+        if len(investments) == n:
+            break
+    return [seligson.Investment(i.fund, seligson.Money(round(i.amount - per_investment_excess)))
+            for i in investments]
+
+
+def make_investments(num_funds, num_sleeves=None, seed=0):
+    # With sleeves, funds in the same model portfolio sleeve share an amount
+    random = Random(seed)
+    amounts = [seligson.Money(random.randint(-500000, 500000)) / 100
+               for _ in range(num_sleeves or num_funds)]
+    return [seligson.Investment(seligson.Fund('Rahasto %d' % i, 0, 0), amounts[i % len(amounts)])
+            for i in range(num_funds)]
+
+
+def bench_seligson_adjust(num_funds=5000, num_sleeves=50, amount=10000):
+    results = {}
+    amount = seligson.Money(amount)
+    for case, investments in [('%d' % num_funds, make_investments(num_funds)),
+                              ('%d_sleeves' % num_funds, make_investments(num_funds, num_sleeves))]:
+        results['seligson_adjust_repeated_cuts_' + case] = time_call(
+            lambda: adjust_investments_by_repeated_cuts(investments, amount), repeat=3, number=1)
+        results['seligson_adjust_water_filling_' + case] = time_call(
+            lambda: seligson.adjust_investments(investments, amount), repeat=3, number=1)
+        results['seligson_adjust_water_filling_fixed_' + case] = time_call(
+            lambda: seligson.adjust_investments(investments, amount, True), repeat=3, number=1)
+    return results
+
+
+def bench_seligson_batch(num_portfolios=300, num_funds=20, amount=1000):
+    if seligson_batch.numpy is None:
+        return {}
+    _, amount, pricer = make_seligson_case(num_funds, amount)
+    portfolios = [make_seligson_case(num_funds, amount, seed)[0] for seed in range(num_portfolios)]
+
+    def target_investments_one_by_one():
+        # The fixed-point start of calculate_investments for each portfolio
+        results = []
+        for portfolio in portfolios:
+            fund_values = [seligson.calculate_fund_value_cents(fund, pricer)
+                           for fund in portfolio.funds]
+            new_value = sum(fund_values) + to_cents(amount)
+            results.append([seligson.Investment(fund, from_cents(divide_half_even(
+                                to_fixed(fund.target_allocation, 1) * new_value - 1000 * value,
+                                1000)))
+                            for fund, value in zip(portfolio.funds, fund_values)])
+        return results
+    return {'seligson_batch_target_investments_one_by_one_%d' % num_portfolios: time_call(
+                target_investments_one_by_one, repeat=3, number=1),
+            'seligson_batch_target_investments_%d' % num_portfolios: time_call(
+                lambda: seligson_batch.calculate_target_investments(portfolios, amount, pricer),
+                repeat=3, number=1)}
+
+
+def bench_repair(num_stocks=100, num_asset_classes=8, money=10000, change=0.02):
+    # Repairing yesterday's buys after every price moved by up to change,
+    # against solving again
+    portfolio, target_allocation, stocks, money, pricer = make_invest_case(
+        num_stocks, num_asset_classes, money)
+    StockPricer.set_pricer(pricer)
+    buys = invest.get_next_buys(portfolio, target_allocation, stocks, money, pricer)[0]
+    random = Random(1)
+    new_pricer = TableStockPricer(dict(
+        (stock.symbol, (pricer.get_name(stock), Money(round(
+            pricer.get_price(stock) * Decimal(1 + random.uniform(-change, change)), 2))))
+        for stock in stocks))
+    StockPricer.set_pricer(new_pricer)
+    portfolio.reprice()
+    suffix = '_%dx%d_%d' % (num_stocks, num_asset_classes, money)
+    return {'repair_cold' + suffix: time_call(
+                lambda: invest.get_next_buys(portfolio, target_allocation, stocks, money,
+                                             new_pricer), repeat=3, number=1),
+            'repair_warm' + suffix: time_call(
+                lambda: invest.repair_buys(portfolio, target_allocation, stocks, money,
+                                           new_pricer, buys), repeat=3, number=1)}
+
+
+def make_invest_file(portfolio, target_allocation, stocks):
+    lines = ['[portfolio]']
+    lines.extend('%s=%d' % (stock.symbol, amount) for stock, amount in portfolio)
+    lines.append('[target_allocation]')
+    lines.extend('%s=%d' % (asset_class, percent) for asset_class, percent in target_allocation)
+    for stock in stocks:
+        lines.extend(['[%s]' % stock.symbol, 'asset_class=%s' % stock.asset_class,
+                      'available=yes'])
+    return '\n'.join(lines) + '\n'
+
+
+def bench_read_invest_file(num_stocks=5000, num_asset_classes=10):
+    portfolio, target_allocation, stocks, _, _ = make_invest_case(num_stocks, num_asset_classes, 0)
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'portfolio.ini')
+        with open(path, 'w') as f:
+            f.write(make_invest_file(portfolio, target_allocation, stocks))
+        invest.load_invest_file(path)
+        suffix = '_%d' % num_stocks
+        return {'read_invest_file_ini' + suffix: time_call(
+                    lambda: invest.read_invest_file(open(path)), repeat=3, number=1),
+                'read_invest_file_compiled' + suffix: time_call(
+                    lambda: invest.load_invest_file(path), repeat=3, number=1)}
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_report(num_stocks=1000, num_asset_classes=10, money=10000):
+    portfolio, target_allocation, stocks, money, pricer = make_invest_case(
+        num_stocks, num_asset_classes, money, num_held=num_stocks)
+    StockPricer.set_pricer(pricer)
+    buys, new_portfolio, money_remaining = invest.get_next_buys(portfolio, target_allocation,
+                                                                stocks, money, pricer)
+
+    def write(output_format):
+        invest_report = report.make_invest_report(None, portfolio, target_allocation, money,
+                                                  buys, new_portfolio, money_remaining, pricer)
+        invest.REPORT_WRITERS[output_format]([invest_report], StringIO())
+    return dict(('report_%s_%d' % (output_format, num_stocks),
+                 time_call(lambda: write(output_format), repeat=3, number=5))
+                for output_format in sorted(invest.REPORT_WRITERS))
+
+
+def bench_backtest(num_stocks=500, num_asset_classes=10, num_months=120, contribution=1000):
+    portfolio, target_allocation, stocks, contribution, pricer = make_invest_case(
+        num_stocks, num_asset_classes, contribution)
+    directory = tempfile.mkdtemp()
+    try:
+        history = make_price_history(os.path.join(directory, 'prices.hist'), stocks, pricer,
+                                     num_months)
+        return dict(('backtest_%s_%dx%d' % (name, num_stocks, num_months), time_call(
+                        lambda: backtest.run_backtest(history, portfolio, target_allocation,
+                                                      stocks, contribution,
+                                                      backtest.STRATEGIES[name]),
+                        repeat=1, number=1))
+                    for name in ['greedy', 'proportional'])
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_rebalance(num_positions=500, money=10000):
+    # The trades solver alone on random drifts, and through the invest and
+    # Seligson rebalancing with rounding to shares and cents
+    random = Random(0)
+    values = [random.uniform(0, 10000) for _ in range(num_positions)]
+    targets = [1.0 / num_positions] * num_positions
+    costs = [random.choice([0, 0.005, 0.01]) for _ in range(num_positions)]
+    portfolio, target_allocation, stocks, money, pricer = make_invest_case(
+        num_positions, num_positions // 10, money, num_held=num_positions)
+    StockPricer.set_pricer(pricer)
+    funds, amount, fund_pricer = make_seligson_case(num_positions, money)
+    suffix = '_%d' % num_positions
+    return {'rebalance_solve' + suffix: time_call(
+                lambda: rebalance.solve_trades(values, targets, float(money), costs, costs),
+                number=10),
+            'rebalance_invest' + suffix: time_call(
+                lambda: invest.get_rebalance_trades(portfolio, target_allocation, stocks, money,
+                                                    pricer, cost_percent=Decimal('0.5')),
+                number=2),
+            'rebalance_seligson' + suffix: time_call(
+                lambda: seligson.calculate_rebalance(funds, amount, fund_pricer,
+                                                     sell_fee_percent=Decimal('0.5')),
+                number=2)}
+
+
+BENCHMARKS = [bench_yahoo_parse, bench_fund_values_parse, bench_invest, bench_portfolio_value,
+              bench_seligson, bench_seligson_adjust, bench_seligson_batch, bench_repair,
+              bench_read_invest_file, bench_report, bench_backtest, bench_rebalance]
+
+
+def run_benchmarks(benchmarks=BENCHMARKS):
+    results = {}
+    for benchmark in benchmarks:
+        results.update(benchmark())
+    return results
+
+
+def find_regressions(results, baseline, threshold):
+    # Benchmarks missing from either side are not compared
+    regressions = []
+    for name in sorted(set(results) & set(baseline)):
+        if results[name] > baseline[name] * (1 + threshold):
+            regressions.append((name, baseline[name], results[name]))
+    return regressions
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('-k', '--filter', help='run only benchmarks whose function name contains this')
+    parser.add_argument('--save', help='write the results to this JSON baseline file')
+    parser.add_argument('--compare', help='compare the results against this JSON baseline file')
+    parser.add_argument('--threshold', help='allowed slowdown as a fraction of the baseline',
+                        type=float, default=0.25)
+    args = parser.parse_args()
+
+    benchmarks = [b for b in BENCHMARKS if not args.filter or args.filter in b.__name__]
+    results = run_benchmarks(benchmarks)
+    for name, seconds in sorted(results.items()):
+        print '%-40s %12.1f us' % (name, seconds * 1e6)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        regressions = find_regressions(results, json.load(open(args.compare)), args.threshold)
+        for name, before, after in regressions:
+            print 'REGRESSION %-40s %12.1f us -> %12.1f us (%+.0f%%)' % (
+                name, before * 1e6, after * 1e6, (after / before - 1) * 100)
+        if regressions:
+            sys.exit(1)
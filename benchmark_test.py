@@ -0,0 +1,53 @@
+import unittest
+
+from benchmark import *
+
+
+class SplitEvenlyTest(unittest.TestCase):
+    def test(self):
+        self.assertEqual([34, 33, 33], split_evenly(100, 3))
+
+
+class MakeInvestCaseTest(unittest.TestCase):
+    def test_deterministic(self):
+        first = make_invest_case(10, 3, 1000, seed=1)
+        second = make_invest_case(10, 3, 1000, seed=1)
+        self.assertEqual(first[0], second[0])
+        self.assertEqual(first[2], second[2])
+        self.assertEqual([first[4].get_price(stock) for stock in first[2]],
+                         [second[4].get_price(stock) for stock in second[2]])
+
+    def test_case(self):
+        portfolio, target_allocation, stocks, money, pricer = make_invest_case(10, 3, 1000)
+        self.assertEqual(10, len(stocks))
+        self.assertEqual(set(['class0', 'class1', 'class2']), set(target_allocation.asset_classes))
+        self.assertEqual(5, len(list(portfolio)))
+        self.assertEqual(Money(1000), money)
+
+
+class MakeSeligsonCaseTest(unittest.TestCase):
+    def test_case(self):
+        portfolio, amount, pricer = make_seligson_case(7, 500)
+        self.assertEqual(100, sum(fund.target_allocation for fund in portfolio.funds))
+        for fund in portfolio.funds:
+            self.assertTrue(pricer.get_share_price(fund.name) > 0)
+        investments, _ = seligson.calculate_investments(portfolio, amount, pricer)
+        self.assertEqual(amount, sum(i.amount for i in investments))
+
+
+class AdjustInvestmentsTest(unittest.TestCase):
+    def test_water_filling_matches_repeated_cuts(self):
+        for num_sleeves in [None, 3]:
+            for seed in range(20):
+                investments = make_investments(40, num_sleeves, seed)
+                for amount in ['0.01', '1000', '1000000']:
+                    self.assertEqual(
+                        adjust_investments_by_repeated_cuts(investments, seligson.Money(amount)),
+                        seligson.adjust_investments(investments, seligson.Money(amount)))
+
+
+class FindRegressionsTest(unittest.TestCase):
+    def test(self):
+        baseline = {'fast': 1.0, 'slow': 1.0, 'removed': 1.0}
+        results = {'fast': 1.2, 'slow': 1.5, 'added': 9.0}
+        self.assertEqual([('slow', 1.0, 1.5)], find_regressions(results, baseline, 0.25))
@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+import sys
+from cStringIO import StringIO
+
+import profiling
+
+
+# Portfolio files compiled to plain JSON data, cached beside the file. The
+# cache is used while the file's mtime and size are unchanged, or while its
+# SHA-1 is, so that touching a file only costs a hash.
+VERSION = 1
+SEPARATORS = (',', ':')
+
+
+def cache_path(path):
+    directory, name = os.path.split(path)
+    return os.path.join(directory, '.%s.compiled.json' % name)
+
+
+def _read_cache(path, kind):
+    try:
+        with open(path, 'rb') as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if not isinstance(cache, dict) or (cache.get('version'), cache.get('kind')) != (VERSION, kind):
+        return None
+    return cache
+
+
+def _write_cache(path, cache):
+    # Written to a temporary file first so that readers never see a
+    # partially written cache. A directory that cannot be written to only
+    # loses the cache.
+    temporary_path = path + '.tmp'
+    try:
+        with open(temporary_path, 'wb') as f:
+            json.dump(cache, f, separators=SEPARATORS, sort_keys=True)
+        os.rename(temporary_path, path)
+    except (IOError, OSError):
+        pass
+
+
+def load_cached(path, kind, compile_file):
+    # Returns the data compile_file(file) gives for the file at path
+    stat = os.stat(path)
+    cache_file = cache_path(path)
+    cache = _read_cache(cache_file, kind)
+    if cache is not None and cache['mtime'] == stat.st_mtime and cache['size'] == stat.st_size:
+        profiling.count('compiled_cache_hits')
+        return encode_strings(cache['data'])
+    with open(path, 'rb') as f:
+        contents = f.read()
+    sha1 = hashlib.sha1(contents).hexdigest()
+    if cache is not None and cache['sha1'] == sha1:
+        profiling.count('compiled_cache_hits')
+        data = encode_strings(cache['data'])
+    else:
+        profiling.count('compiled_cache_misses')
+        data = compile_file(StringIO(contents))
+    _write_cache(cache_file, {'version': VERSION, 'kind': kind, 'mtime': stat.st_mtime,
+                              'size': stat.st_size, 'sha1': sha1, 'data': data})
+    return data
+
+
+def write_compiled(output, name, kind, data):
+    output.write(json.dumps({'name': name, 'kind': kind, 'data': data},
+                            separators=SEPARATORS, sort_keys=True) + '\n')
+
+
+def read_compiled(compiled_file, kind):
+    # Yields (name, data) for each portfolio of a file of compiled portfolios,
+    # one JSON object per line, reading one line at a time
+    for line_number, line in enumerate(compiled_file, 1):
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if record['kind'] != kind:
+            raise ValueError('Line %d is a %s portfolio, not %s' % (line_number, record['kind'],
+                                                                   kind))
+        yield encode_strings(record['name']), encode_strings(record['data'])
+
+
+def encode_strings(value):
+    # JSON gives unicode where ConfigParser gives UTF-8 str
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [encode_strings(item) for item in value]
+    if isinstance(value, dict):
+        return dict((encode_strings(key), encode_strings(item)) for key, item in value.items())
+    return value
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    import invest
+    import seligson
+    compilers = {'invest': invest.compile_invest_file, 'seligson': seligson.compile_portfolio_file}
+    parser = ArgumentParser()
+    parser.add_argument('kind', choices=sorted(compilers))
+    parser.add_argument('portfolios', nargs='+')
+    parser.add_argument('-o', '--output', help='write the portfolios to one file of compiled '
+                        'portfolios instead of caching each beside its file', metavar='FILE')
+    args = parser.parse_args()
+
+    if args.output:
+        output = sys.stdout if args.output == '-' else open(args.output, 'wb')
+        for path in args.portfolios:
+            write_compiled(output, path, args.kind, compilers[args.kind](open(path)))
+        output.close()
+    else:
+        for path in args.portfolios:
+            load_cached(path, args.kind, compilers[args.kind])
@@ -0,0 +1,141 @@
+# coding=utf-8
+import os
+import shutil
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+from mock import Mock
+
+import invest
+import seligson
+from util import Stock
+from compiled import *
+
+
+INVEST_PORTFOLIO = '''[portfolio]
+SYM1=3
+[target_allocation]
+bond=50
+world=50
+[SYM1]
+asset_class=bond
+available=no
+[SYM2]
+asset_class=world
+available=yes
+'''
+
+SELIGSON_PORTFOLIO = '''[Eurooppa]
+omistus=10,5
+allokaatio=50
+palkkio_prosentti=1
+[Pohjoismaat ä]
+omistus=10
+allokaatio=50
+'''
+
+
+class LoadCachedTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'portfolio.ini')
+        open(self.path, 'w').write(INVEST_PORTFOLIO)
+        self.compile_file = Mock(side_effect=invest.compile_invest_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def load(self):
+        return load_cached(self.path, 'invest', self.compile_file)
+
+    def test_cached_beside_file(self):
+        data = self.load()
+        self.assertEqual(data, self.load())
+        self.assertEqual(1, self.compile_file.call_count)
+        self.assertTrue(os.path.exists(cache_path(self.path)))
+        self.assertEqual(os.path.join(self.directory, '.portfolio.ini.compiled.json'),
+                         cache_path(self.path))
+
+    def test_touched_file_with_same_contents_is_not_compiled(self):
+        self.load()
+        os.utime(self.path, (0, 0))
+        self.load()
+        self.assertEqual(1, self.compile_file.call_count)
+
+    def test_changed_file_is_compiled(self):
+        self.load()
+        open(self.path, 'w').write(INVEST_PORTFOLIO.replace('SYM1=3', 'SYM1=4'))
+        os.utime(self.path, (0, 0))
+        self.assertEqual(4, self.load()['portfolio'][0][2])
+        self.assertEqual(2, self.compile_file.call_count)
+
+    def test_broken_cache_is_compiled(self):
+        open(cache_path(self.path), 'w').write('{"version":')
+        self.assertEqual(invest.compile_invest_file(open(self.path)), self.load())
+
+    def test_other_kind_is_compiled(self):
+        load_cached(self.path, 'other', lambda f: {})
+        self.load()
+        self.assertEqual(1, self.compile_file.call_count)
+
+    def test_unwritable_cache(self):
+        os.mkdir(cache_path(self.path) + '.tmp')
+        self.assertEqual(invest.compile_invest_file(open(self.path)), self.load())
+
+
+class ReadCompiledTest(unittest.TestCase):
+    def test_streams_records(self):
+        output = StringIO()
+        write_compiled(output, 'a.ini', 'invest', {'x': 1})
+        write_compiled(output, 'b.ini', 'invest', {'x': 2})
+        records = read_compiled(StringIO(output.getvalue() + '\n'), 'invest')
+        self.assertEqual(('a.ini', {'x': 1}), next(records))
+        self.assertEqual([('b.ini', {'x': 2})], list(records))
+
+    def test_other_kind(self):
+        output = StringIO()
+        write_compiled(output, 'a.ini', 'seligson', {})
+        self.assertRaises(ValueError, list, read_compiled(StringIO(output.getvalue()), 'invest'))
+
+    def test_encode_strings(self):
+        self.assertEqual([['a', 1, '\xc3\xa4']], encode_strings([[u'a', 1, u'\xe4']]))
+        self.assertIsInstance(encode_strings([u'a'])[0], str)
+
+
+class InvestLoaderTest(unittest.TestCase):
+    def test_matches_ini_file(self):
+        output = StringIO()
+        write_compiled(output, 'a.ini', 'invest',
+                       invest.compile_invest_file(StringIO(INVEST_PORTFOLIO)))
+        [(name, portfolio, target_allocation, available_stocks)] = list(
+            invest.read_compiled_invest_files(StringIO(output.getvalue())))
+        expected = invest.read_invest_file(StringIO(INVEST_PORTFOLIO))
+        self.assertEqual('a.ini', name)
+        self.assertEqual(expected, (portfolio, target_allocation, available_stocks))
+        self.assertEqual([Stock('SYM2', 'world')], available_stocks)
+        self.assertIsInstance(available_stocks[0].symbol, str)
+
+
+class SeligsonLoaderTest(unittest.TestCase):
+    def test_matches_ini_file(self):
+        output = StringIO()
+        write_compiled(output, 'a.ini', 'seligson',
+                       seligson.compile_portfolio_file(StringIO(SELIGSON_PORTFOLIO)))
+        [(name, portfolio)] = list(seligson.read_compiled_portfolios(StringIO(output.getvalue())))
+        expected = seligson.read_portfolio(StringIO(SELIGSON_PORTFOLIO))
+        self.assertEqual(expected.funds, portfolio.funds)
+        self.assertEqual([u'Eurooppa', u'Pohjoismaat \xe4'],
+                         [fund.name for fund in portfolio.funds])
+        self.assertEqual([seligson.FeePercent(1), seligson.FeePercent(0)],
+                         [fund.fee_percent for fund in portfolio.funds])
+        self.assertEqual(seligson.ShareAmount('10.5'), portfolio.funds[0].shares)
+
+    def test_allocations_checked(self):
+        data = seligson.compile_portfolio_file(StringIO(SELIGSON_PORTFOLIO))
+        data['funds'][0][2] = '40'
+        self.assertRaises(ValueError, seligson.load_portfolio_data, data)
+
+
+if __name__ == '__main__':
+    unittest.main()
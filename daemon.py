@@ -0,0 +1,203 @@
+import errno
+import json
+import os
+import socket
+import stat
+import sys
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn, UnixStreamServer
+from StringIO import StringIO
+
+import invest
+import seligson
+import stock_pricer
+from price_cache import PriceCache
+from util import Buy, Money
+
+
+class RebalanceService(object):
+    # Keeps the pricers, and so their downloaded prices, alive between requests
+    def __init__(self, stock_pricer, fund_pricer):
+        self.stock_pricer = stock_pricer
+        self.fund_pricer = fund_pricer
+        self._fund_prices_used = False
+
+    def invest(self, request):
+        portfolio, target_allocation, available_stocks = invest.read_invest_file(
+            StringIO(request['portfolio']))
+        money = Money(request['amount'])
+        buy_strategy = invest.BUY_STRATEGIES[request.get('solver', 'greedy')]
+        pricer = self.stock_pricer
+        pricer.prefetch(set(stock for stock, _ in portfolio) | set(available_stocks))
+        previous_buys = request.get('previous_buys')
+        stats = None
+        if previous_buys is None:
+            buys, new_portfolio, money_remaining = buy_strategy(
+                portfolio, target_allocation, available_stocks, money, pricer)
+        else:
+            # The buys of an earlier request at older prices are repaired
+            # instead of solved again
+            stocks = dict((stock.symbol, stock) for stock in available_stocks)
+            previous_buys = [Buy(stocks[buy['symbol']], int(buy['amount']))
+                             for buy in previous_buys if buy['symbol'] in stocks]
+            buys, new_portfolio, money_remaining, stats = invest.repair_buys(
+                portfolio, target_allocation, available_stocks, money, pricer, previous_buys)
+        result = {'buys': [{'symbol': stock.symbol, 'name': pricer.get_name(stock),
+                            'amount': amount, 'price': str(pricer.get_price(stock))}
+                           for stock, amount in sorted(buys)],
+                  'spent': str(money - money_remaining),
+                  'remaining': str(money_remaining),
+                  'portfolio': [{'symbol': stock.symbol, 'amount': amount}
+                                for stock, amount in sorted(new_portfolio)],
+                  'value': str(new_portfolio.value)}
+        if stats is not None:
+            result['repair'] = stats._asdict()
+        return result
+
+    def seligson(self, request):
+        portfolio = seligson.read_portfolio(StringIO(request['portfolio'].encode('utf-8')))
+        self._fund_prices_used = True
+        minimum_investment = request.get('minimum_investment')
+        if minimum_investment is not None:
+            minimum_investment = seligson.Money(minimum_investment)
+        investments, new_portfolio = seligson.calculate_investments(
+            portfolio, seligson.Money(request['amount']), self.fund_pricer, minimum_investment,
+            request.get('fixed_point', False))
+        return {'investments': [{'fund': i.fund.name, 'amount': str(i.amount),
+                                 'fee': str(i.fee), 'real_investment': str(i.real_investment)}
+                                for i in investments],
+                'portfolio': [{'fund': fund.name, 'shares': str(fund.shares),
+                               'value': str(fund.calculate_value(self.fund_pricer))}
+                              for fund in new_portfolio.funds]}
+
+    def refresh(self):
+        self.stock_pricer.refresh()
+        if self._fund_prices_used:
+            self.fund_pricer.refresh()
+
+
+class RebalanceHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    routes = {'/invest': 'invest', '/seligson': 'seligson'}
+    # The response is sent in one write when the request is done, so that
+    # small keep-alive responses are not held back by Nagle's algorithm
+    wbufsize = -1
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        if self.connection.family != socket.AF_UNIX:
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_POST(self):
+        if self.path not in self.routes:
+            return self._respond(404, {'error': 'unknown path %s' % self.path})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.getheader('content-length', 0))))
+            result = getattr(self.server.service, self.routes[self.path])(request)
+        except (ValueError, KeyError, TypeError, AssertionError) as e:
+            return self._respond(400, {'error': '%s: %s' % (type(e).__name__, e)})
+        except Exception as e:
+            return self._respond(500, {'error': '%s: %s' % (type(e).__name__, e)})
+        self._respond(200, result)
+
+    def _respond(self, status, result):
+        body = json.dumps(result, sort_keys=True)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Without the reverse DNS lookup
+        return str(self.client_address[0])
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class _ServerMixin(ThreadingMixIn):
+    daemon_threads = True
+    verbose = False
+
+
+class RebalanceHTTPServer(_ServerMixin, HTTPServer):
+    pass
+
+
+class RebalanceUnixServer(_ServerMixin, UnixStreamServer):
+    def server_bind(self):
+        # Only a socket left by an earlier server is replaced, as any other
+        # file at the path is most likely a mistyped address
+        if os.path.exists(self.server_address):
+            if not stat.S_ISSOCK(os.stat(self.server_address).st_mode):
+                raise socket.error(errno.EEXIST, '%s exists and is not a socket' %
+                                   self.server_address)
+            os.unlink(self.server_address)
+        UnixStreamServer.server_bind(self)
+
+    def get_request(self):
+        request, _ = UnixStreamServer.get_request(self)
+        return request, ('unix', 0)
+
+
+def make_server(service, address):
+    # A path is a Unix socket, anything else HOST:PORT
+    if '/' in address:
+        server = RebalanceUnixServer(address, RebalanceHandler)
+    else:
+        host, port = address.rsplit(':', 1)
+        server = RebalanceHTTPServer((host, int(port)), RebalanceHandler)
+    server.service = service
+    return server
+
+
+def start_refresher(service, interval):
+    stop = threading.Event()
+
+    def refresh():
+        while not stop.wait(interval):
+            try:
+                service.refresh()
+            except Exception as e:
+                print >>sys.stderr, 'Price refresh failed: %s' % e
+    thread = threading.Thread(target=refresh)
+    thread.daemon = True
+    thread.start()
+    return stop
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('address', help='Unix socket path or HOST:PORT')
+    parser.add_argument('--refresh', help='price refresh interval in seconds', type=float,
+                        default=900)
+    parser.add_argument('--max-quotes', help='most stock quotes to keep in memory', type=int,
+                        default=10000)
+    parser.add_argument('--price-cache', help='persistent price cache file')
+    parser.add_argument('--cache-ttl', help='price cache time to live in seconds', type=float,
+                        default=3600)
+    parser.add_argument('-v', '--verbose', help='log requests', action='store_true')
+    args = parser.parse_args()
+
+    price_cache = None
+    if args.price_cache:
+        price_cache = PriceCache(args.price_cache, args.cache_ttl)
+    pricer = stock_pricer.YahooStockPricer(price_cache=price_cache, max_entries=args.max_quotes)
+    stock_pricer.StockPricer.set_pricer(pricer)
+    service = RebalanceService(pricer, seligson.Pricer(price_cache=price_cache))
+    try:
+        server = make_server(service, args.address)
+    except socket.error as e:
+        parser.error(e.strerror or str(e))
+    server.verbose = args.verbose
+    start_refresher(service, args.refresh)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
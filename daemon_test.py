@@ -0,0 +1,231 @@
+import httplib
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+
+from mock import Mock
+
+import seligson
+from stock_pricer import StockPricer, TableStockPricer
+from util import Money
+from daemon import *
+
+
+INVEST_PORTFOLIO = '''[portfolio]
+SYM1=1
+[target_allocation]
+bond=50
+world=50
+[SYM1]
+asset_class=bond
+available=yes
+[SYM2]
+asset_class=world
+available=yes
+'''
+
+SELIGSON_PORTFOLIO = '''[Eurooppa]
+omistus=10
+allokaatio=50
+[Aasia]
+omistus=10
+allokaatio=50
+'''
+
+FUND_VALUES_HTML = '''<table>
+<tr><td><a href="e.htm">Eurooppa</a></td><td>17.10.2013</td><td>2,0000</td></tr>
+<tr><td><a href="a.htm">Aasia</a></td><td>17.10.2013</td><td>1,0000</td></tr>
+</table>'''
+
+
+def make_service():
+    pricer = TableStockPricer({'SYM1': ('Stock 1', Money(4)), 'SYM2': ('Stock 2', Money(10))})
+    StockPricer.set_pricer(pricer)
+    return RebalanceService(pricer, seligson.Pricer(Mock(return_value=FUND_VALUES_HTML)))
+
+
+class RebalanceServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.service = make_service()
+
+    def test_invest(self):
+        result = self.service.invest({'portfolio': INVEST_PORTFOLIO, 'amount': '20'})
+        self.assertEqual([{'symbol': 'SYM1', 'name': 'Stock 1', 'amount': 2, 'price': '4.00'},
+                          {'symbol': 'SYM2', 'name': 'Stock 2', 'amount': 1, 'price': '10.00'}],
+                         result['buys'])
+        self.assertEqual('2.00', result['remaining'])
+        self.assertEqual([{'symbol': 'SYM1', 'amount': 3}, {'symbol': 'SYM2', 'amount': 1}],
+                         result['portfolio'])
+        self.assertEqual('22.00', result['value'])
+
+    def test_invest_repairs_previous_buys(self):
+        result = self.service.invest({'portfolio': INVEST_PORTFOLIO, 'amount': '20',
+                                      'previous_buys': [{'symbol': 'SYM1', 'amount': 2},
+                                                        {'symbol': 'SYM2', 'amount': 1},
+                                                        {'symbol': 'GONE', 'amount': 1}]})
+        self.assertEqual([{'symbol': 'SYM1', 'name': 'Stock 1', 'amount': 2, 'price': '4.00'},
+                          {'symbol': 'SYM2', 'name': 'Stock 2', 'amount': 1, 'price': '10.00'}],
+                         result['buys'])
+        self.assertEqual('2.00', result['remaining'])
+        self.assertEqual(0, result['repair']['moves'])
+
+    def test_seligson(self):
+        result = self.service.seligson({'portfolio': SELIGSON_PORTFOLIO, 'amount': '30'})
+        self.assertEqual([{'fund': 'Aasia', 'amount': '20.00', 'fee': '0.00',
+                           'real_investment': '20.00'},
+                          {'fund': 'Eurooppa', 'amount': '10.00', 'fee': '0.00',
+                           'real_investment': '10.00'}],
+                         result['investments'])
+        self.assertEqual(['30.00', '30.00'], [fund['value'] for fund in result['portfolio']])
+
+    def test_prices_stay_warm(self):
+        self.service.seligson({'portfolio': SELIGSON_PORTFOLIO, 'amount': '30'})
+        self.service.seligson({'portfolio': SELIGSON_PORTFOLIO, 'amount': '30'})
+        self.service.fund_pricer.downloader.assert_called_once_with()
+
+    def test_refresh_skips_unused_fund_prices(self):
+        self.service.refresh()
+        self.assertFalse(self.service.fund_pricer.downloader.called)
+        self.service.seligson({'portfolio': SELIGSON_PORTFOLIO, 'amount': '30'})
+        self.service.refresh()
+        self.assertEqual(2, self.service.fund_pricer.downloader.call_count)
+
+
+class ConcurrentInvestTest(unittest.TestCase):
+    def test_concurrent_requests_intern_stocks_safely(self):
+        # Each request holds stocks no other request has seen, so the
+        # threads intern new stocks at the same time
+        num_threads, num_stocks = 8, 200
+        quotes = {}
+        requests = []
+        for thread in range(num_threads):
+            symbols = ['CONCURRENT%d_%d' % (thread, i) for i in range(num_stocks)]
+            quotes.update((symbol, (symbol, Money(1))) for symbol in symbols)
+            requests.append({'amount': '1', 'portfolio': '\n'.join(
+                ['[portfolio]'] + ['%s=%d' % (symbol, i + 1) for i, symbol in enumerate(symbols)] +
+                ['[target_allocation]', 'world=100'] +
+                ['[%s]\nasset_class=world\navailable=no' % symbol for symbol in symbols])})
+        pricer = TableStockPricer(quotes)
+        StockPricer.set_pricer(pricer)
+        service = RebalanceService(pricer, None)
+        results = [None] * num_threads
+
+        def invest(thread):
+            results[thread] = service.invest(requests[thread])
+        threads = [threading.Thread(target=invest, args=(thread,))
+                   for thread in range(num_threads)]
+        check_interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setcheckinterval(check_interval)
+        for thread, result in enumerate(results):
+            self.assertItemsEqual([{'symbol': 'CONCURRENT%d_%d' % (thread, i), 'amount': i + 1}
+                                   for i in range(num_stocks)], result['portfolio'])
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    def __init__(self, path):
+        httplib.HTTPConnection.__init__(self, 'localhost')
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+class ServerTestCase(object):
+    def setUp(self):
+        self.server = make_server(make_service(), self.address())
+        thread = threading.Thread(target=self.server.serve_forever, args=(0.01,))
+        thread.daemon = True
+        thread.start()
+        self.connection = self.connect()
+
+    def tearDown(self):
+        self.connection.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def post(self, path, request):
+        self.connection.request('POST', path, json.dumps(request))
+        response = self.connection.getresponse()
+        return response.status, json.loads(response.read())
+
+    def test_invest(self):
+        status, result = self.post('/invest', {'portfolio': INVEST_PORTFOLIO, 'amount': '20'})
+        self.assertEqual(200, status)
+        self.assertEqual('18.00', result['spent'])
+
+    def test_keep_alive(self):
+        self.post('/seligson', {'portfolio': SELIGSON_PORTFOLIO, 'amount': '30'})
+        status, _ = self.post('/seligson', {'portfolio': SELIGSON_PORTFOLIO, 'amount': '30'})
+        self.assertEqual(200, status)
+
+    def test_bad_request(self):
+        status, result = self.post('/invest', {'portfolio': INVEST_PORTFOLIO})
+        self.assertEqual(400, status)
+        self.assertTrue(result['error'].startswith('KeyError'))
+
+    def test_unknown_path(self):
+        self.assertEqual(404, self.post('/stocks', {})[0])
+
+
+class HTTPServerTest(ServerTestCase, unittest.TestCase):
+    def address(self):
+        return '127.0.0.1:0'
+
+    def connect(self):
+        return httplib.HTTPConnection('127.0.0.1', self.server.server_address[1])
+
+
+class UnixServerTest(ServerTestCase, unittest.TestCase):
+    def address(self):
+        self.directory = tempfile.mkdtemp()
+        return os.path.join(self.directory, 'daemon.sock')
+
+    def connect(self):
+        return UnixHTTPConnection(self.server.server_address)
+
+    def tearDown(self):
+        ServerTestCase.tearDown(self)
+        shutil.rmtree(self.directory)
+
+
+class UnixServerBindTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'daemon.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_replaces_stale_socket(self):
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.path)
+        stale.close()
+        make_server(make_service(), self.path).server_close()
+
+    def test_keeps_other_files(self):
+        open(self.path, 'w').write('[portfolio]')
+        self.assertRaises(socket.error, make_server, make_service(), self.path)
+        self.assertEqual('[portfolio]', open(self.path).read())
+
+
+class StartRefresherTest(unittest.TestCase):
+    def test(self):
+        service = Mock()
+        refreshed = threading.Event()
+        service.refresh.side_effect = refreshed.set
+        stop = start_refresher(service, 0.01)
+        self.assertTrue(refreshed.wait(5))
+        stop.set()
@@ -1,10 +1,28 @@
 import sys
+from array import array
+from bisect import bisect_left
 from collections import defaultdict
 from itertools import count
+from functools import partial
 import datetime
+import threading
+import time
 import ConfigParser
+from decimal import Decimal
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import compiled
+import profiling
+import rebalance
+import report
 import stock_pricer
+from price_cache import PriceCache
+from snapshot import (Snapshot, SnapshotWriter, RecordingStockPricer,
+                      SnapshotStockPricer)
 from util import *
 
 
@@ -31,161 +49,1043 @@ class Allocation(object):
         return self._asset_classes_percents.values()
 
 
+class StockTable(object):
+    # Interns stocks to small integers shared by all portfolios, so that a
+    # portfolio only needs arrays of the indices and amounts of its holdings
+    def __init__(self):
+        self.stocks = []
+        self._indices = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.stocks)
+
+    def index(self, stock):
+        try:
+            return self._indices[stock]
+        except KeyError:
+            # The daemon reads portfolios in concurrent threads. A stock is
+            # appended before its index is published, so that an index
+            # found without the lock is always in the table.
+            with self._lock:
+                if stock not in self._indices:
+                    self.stocks.append(stock)
+                    self._indices[stock] = len(self.stocks) - 1
+                return self._indices[stock]
+
+    def find(self, stock):
+        # Like index, but None for stocks not interned yet
+        return self._indices.get(stock)
+
+
+stock_table = StockTable()
+
+
 class Portfolio(object):
+    # The holdings are parallel arrays of stock table indices, sorted, and
+    # their nonzero amounts, so a portfolio's size follows its holdings and
+    # not the size of the stock table
+    __slots__ = ('_indices', '_amounts', '_shared', '_asset_class_values')
+
     def __init__(self):
-        self._stocks_amounts = defaultdict(int)
-        self._asset_class_values = {}
+        self._indices = array('l')
+        self._amounts = array('l')
+        self._shared = False
+        self._asset_class_values = None
+
+    def __getstate__(self):
+        # Wrapped so that the state of an empty portfolio is not false,
+        # which would skip __setstate__
+        return (list(self),)
+
+    def __setstate__(self, state):
+        self.__init__()
+        for stock, amount in state[0]:
+            self.add_stock(stock, amount)
     
     def __eq__(self, other):
-        return self._stocks_amounts == other._stocks_amounts
+        return self._indices == other._indices and self._amounts == other._amounts
+
+    def __ne__(self, other):
+        return not self == other
 
     def __iter__(self):
-        return iter(self._stocks_amounts.items())
+        stocks = stock_table.stocks
+        return ((stocks[i], amount) for i, amount in zip(self._indices, self._amounts))
 
     def __str__(self):
-        lines = []
-        for stock, amount in self:
-            price = self._pricer.get_price(stock)
-            name = self._pricer.get_name(stock)
-            value = price * amount
-            lines.append('%-30s: %4d x %6.2f = %10.2f' % (name, amount, price, value))
-        lines.append('%-30s: %26.2f' % ('Total value', self.value))
-        return '\n'.join(lines)
+        return '\n'.join(format_holdings(report.value_portfolio(self, self._pricer)))
 
     @property
     def _pricer(self):
         return stock_pricer.StockPricer.get_pricer()
-    
+
     def clone(self):
+        # The arrays are copied only when either portfolio is modified
+        profiling.count('portfolio_clone')
         clone = Portfolio()
-        for stock, amount in self:
-            clone.add_stock(stock, amount)
+        clone._indices = self._indices
+        clone._amounts = self._amounts
+        clone._shared = self._shared = True
+        clone._asset_class_values = self._asset_class_values
         return clone
 
     @property
     def asset_classes(self):
-        return set(stock.asset_class for stock in self._stocks_amounts)
+        return set(stock.asset_class for stock, _ in self)
 
     @property
     def value(self):
-        return sum(self.asset_class_value(asset_class) for asset_class in self.asset_classes)
+        return sum(self._get_asset_class_values().values())
+
+    def _get_asset_class_values(self):
+        if self._asset_class_values is None:
+            get_price = self._pricer.get_price
+            values = defaultdict(int)
+            for stock, amount in self:
+                values[stock.asset_class] += get_price(stock) * amount
+            self._asset_class_values = dict((asset_class, Money(value))
+                                            for asset_class, value in values.items())
+        return self._asset_class_values
 
     def asset_class_value(self, asset_class):
-        if asset_class not in self._asset_class_values:
-            value = Money(sum(self._pricer.get_price(stock) * amount for stock, amount in self if stock.asset_class == asset_class))
-            self._asset_class_values[asset_class] = value
-        return self._asset_class_values[asset_class]
+        return self._get_asset_class_values().get(asset_class, Money(0))
+
+    def reprice(self):
+        # The cached asset class values are stale once prices change
+        self._asset_class_values = None
 
     def add_stock(self, stock, amount):
         if amount < 1:
             return
-        self._stocks_amounts[stock] += amount
-        self._value = None
-        try:
-            del self._asset_class_values[stock.asset_class]
-        except KeyError:
-            pass
+        self._change_amount(stock, amount)
+
+    def remove_stock(self, stock, amount):
+        if amount < 1:
+            return
+        if amount > self.get_amount(stock):
+            raise ValueError('Cannot remove %d of %d %s' % (amount, self.get_amount(stock),
+                                                            stock.symbol))
+        self._change_amount(stock, -amount)
+
+    def get_amount(self, stock):
+        i = stock_table.find(stock)
+        if i is None:
+            return 0
+        position = bisect_left(self._indices, i)
+        if position < len(self._indices) and self._indices[position] == i:
+            return self._amounts[position]
+        return 0
+
+    def _change_amount(self, stock, amount):
+        i = stock_table.index(stock)
+        if self._shared:
+            self._indices = array('l', self._indices)
+            self._amounts = array('l', self._amounts)
+            self._shared = False
+        position = bisect_left(self._indices, i)
+        if position < len(self._indices) and self._indices[position] == i:
+            self._amounts[position] += amount
+            if not self._amounts[position]:
+                del self._indices[position]
+                del self._amounts[position]
+        else:
+            self._indices.insert(position, i)
+            self._amounts.insert(position, amount)
+        if self._asset_class_values is not None:
+            # Clones may share the cached values, so update a copy
+            values = dict(self._asset_class_values)
+            value = values.get(stock.asset_class, 0) + self._pricer.get_price(stock) * amount
+            values[stock.asset_class] = Money(value)
+            self._asset_class_values = values
 
     def get_asset_class_percent(self, asset_class):
         p = 100.0 * float(self.asset_class_value(asset_class)) / float(self.value)
         return p
 
     def print_asset_class_balance(self, target_allocation):
-        print 'Asset class  Allocation    Target Deviation'
-        for asset_class in self.asset_classes:
-            current = self.get_asset_class_percent(asset_class)
-            target = target_allocation[asset_class]
-            deviation = current - target
-            print '%-12s: %8.1f%% %8.1f%% %+8.1f%%' % (asset_class, current, target, deviation)
+        valuation = report.value_portfolio(self, self._pricer, target_allocation)
+        print '\n'.join(format_asset_class_balance(valuation))
     
 
-def get_next_buys(portfolio, target_allocation, available_stocks, money, pricer):
+class AssetClassBalance(object):
+    # With fixed_point the values are integer cents and the values added must
+    # be given in cents too
+    def __init__(self, portfolio, target_allocation, fixed_point=False):
+        asset_classes = portfolio.asset_classes | set(target_allocation.asset_classes)
+        if fixed_point:
+            self._targets = dict((asset_class, target_allocation[asset_class])
+                                 for asset_class in asset_classes)
+            self._values = dict((asset_class, to_cents(portfolio.asset_class_value(asset_class)))
+                                for asset_class in asset_classes)
+        else:
+            self._targets = dict((asset_class, Decimal(target_allocation[asset_class]))
+                                 for asset_class in asset_classes)
+            self._values = dict((asset_class, portfolio.asset_class_value(asset_class))
+                                for asset_class in asset_classes)
+        self._total = sum(self._values.values())
+        self._squares = sum(value * value for value in self._values.values())
+        self._weighted = sum(self._targets[asset_class] * value
+                             for asset_class, value in self._values.items())
+        self._target_squares = float(sum(target * target for target in self._targets.values()))
+
+    def add(self, asset_class, value):
+        target = self._targets[asset_class]
+        old_value = self._values[asset_class]
+        self._values[asset_class] = old_value + value
+        self._total += value
+        self._squares += (2 * old_value + value) * value
+        self._weighted += target * value
+
+    @property
+    def asset_classes(self):
+        return self._targets.keys()
+
+    def float_terms(self):
+        values = dict((asset_class, float(value)) for asset_class, value in self._values.items())
+        targets = dict((asset_class, float(target)) for asset_class, target in self._targets.items())
+        return (values, targets, float(self._total), float(self._squares), float(self._weighted),
+                self._target_squares)
+
+    def clone(self):
+        clone = AssetClassBalance.__new__(AssetClassBalance)
+        clone.__dict__.update(self.__dict__)
+        clone._values = dict(self._values)
+        return clone
+
+    def deviation_scorer(self):
+        # The sum of squared percent deviations expands to
+        # 10000 * sum(v^2) / T^2 - 200 * sum(t * v) / T + sum(t^2), so adding
+        # value to one asset class only changes that class's terms
+        values, targets, total, squares, weighted, target_squares = self.float_terms()
+
+        def score(asset_class, price):
+            new_total = total + price
+            new_squares = squares + (2 * values[asset_class] + price) * price
+            new_weighted = weighted + targets[asset_class] * price
+            return (10000 * new_squares / (new_total * new_total) - 200 * new_weighted / new_total +
+                    target_squares)
+        return score
+
+    def deviation(self):
+        values, targets, total, squares, weighted, target_squares = self.float_terms()
+        return 10000 * squares / (total * total) - 200 * weighted / total + target_squares
+
+    def scorer(self, money_remaining, money):
+        deviation_score = self.deviation_scorer()
+        money_remaining = float(money_remaining)
+        money = float(money)
+
+        def score(asset_class, price):
+            return deviation_score(asset_class, price) + abs(money_remaining - price) / money
+        return score
+
+
+def index_candidates(available_stocks, pricer):
+    # The error of a buy depends only on the asset class and price of the
+    # stock, so only the first stock of each (asset class, price) pair can be
+    # chosen. Prices are keyed as strings since hashing Decimals is slow;
+    # equal prices written differently only leave a redundant candidate.
+    candidates = []
+    seen = set()
+    for stock in available_stocks:
+        price = pricer.get_price(stock)
+        key = (stock.asset_class, str(price))
+        if key not in seen:
+            seen.add(key)
+            candidates.append((stock, price))
+    return candidates
+
+
+def _buy_greedily(portfolio, target_allocation, available_stocks, money, money_remaining, pricer,
+                  fixed_point=False, max_steps=None, deadline=None):
+    # Stops early after max_steps shares or at the deadline
+    buys = []
+    portfolio = portfolio.clone()
+    balance = AssetClassBalance(portfolio, target_allocation, fixed_point)
+    if fixed_point:
+        money, money_remaining = to_cents(money), to_cents(money_remaining)
+        candidates = [(stock, to_cents(price), float(to_cents(price)))
+                      for stock, price in index_candidates(available_stocks, pricer)]
+    else:
+        candidates = [(stock, price, float(price))
+                      for stock, price in index_candidates(available_stocks, pricer)]
+
+    while 1:
+        candidates = [candidate for candidate in candidates if candidate[1] <= money_remaining]
+        if not candidates:
+            break
+        if ((max_steps is not None and len(buys) >= max_steps) or
+                (deadline is not None and time.time() > deadline)):
+            break
+        score = balance.scorer(money_remaining, money)
+        stock, price, _ = min(candidates, key=lambda (stock, _, price): score(stock.asset_class, price))
+        portfolio.add_stock(stock, 1)
+        balance.add(stock.asset_class, price)
+        money_remaining -= price
+        buys.append(Buy(stock, 1))
+
+    profiling.count('solver_iterations', len(buys))
+    if fixed_point:
+        money_remaining = from_cents(money_remaining)
+    return buys, portfolio, money_remaining
+
+
+def _buy_vectorized(portfolio, target_allocation, available_stocks, money, money_remaining, pricer):
+    if numpy is None:
+        raise RuntimeError('The vectorized solver requires numpy')
+    buys = []
+    portfolio = portfolio.clone()
+    balance = AssetClassBalance(portfolio, target_allocation)
+    asset_classes = list(balance.asset_classes)
+    asset_class_indices = dict((asset_class, i) for i, asset_class in enumerate(asset_classes))
+    candidates = index_candidates(available_stocks, pricer)
+    if not candidates:
+        return buys, portfolio, money_remaining
+    stocks, stock_prices = zip(*candidates)
+    prices = numpy.array([float(price) for price in stock_prices])
+    class_indices = numpy.array([asset_class_indices[stock.asset_class] for stock in stocks])
+    float_money = float(money)
+
+    while 1:
+        float_money_remaining = float(money_remaining)
+        affordable = prices <= float_money_remaining
+        if not affordable.any():
+            break
+        values, targets, total, squares, weighted, target_squares = balance.float_terms()
+        class_values = numpy.array([values[asset_class] for asset_class in asset_classes])
+        class_targets = numpy.array([targets[asset_class] for asset_class in asset_classes])
+        new_total = total + prices
+        new_squares = squares + (2 * class_values[class_indices] + prices) * prices
+        new_weighted = weighted + class_targets[class_indices] * prices
+        errors = (10000 * new_squares / (new_total * new_total) - 200 * new_weighted / new_total +
+                  target_squares + numpy.abs(float_money_remaining - prices) / float_money)
+        errors[~affordable] = numpy.inf
+        i = int(numpy.argmin(errors))
+        stock, price = stocks[i], stock_prices[i]
+        portfolio.add_stock(stock, 1)
+        balance.add(stock.asset_class, price)
+        money_remaining -= price
+        buys.append(Buy(stock, 1))
+
+    profiling.count('solver_iterations', len(buys))
+    return buys, portfolio, money_remaining
+
+
+def get_next_buys(portfolio, target_allocation, available_stocks, money, pricer, fixed_point=False):
+    assert money > 0
+
+    buys, portfolio, money_remaining = _buy_greedily(portfolio, target_allocation, available_stocks,
+                                                     money, money, pricer, fixed_point)
+    return compress_buys(buys), portfolio, money_remaining
+
+
+def get_asset_class_deficits(portfolio, target_allocation, money, asset_classes=None):
+    # Only the given asset_classes are considered, by default all target
+    # classes. Deficits beyond the money are cut evenly, dropping the classes
+    # whose deficit does not cover its cut, and money beyond the deficits,
+    # left when some target classes are not considered, is spread evenly
+    # over the classes, which is where the greedy search ends up too. The
+    # level is found in one pass over integer cents, since repeated Decimal
+    # cuts can leave an excess too small to change any deficit.
+    new_value = portfolio.value + money
+    deficits = {}
+    for asset_class, percent in target_allocation:
+        if asset_classes is None or asset_class in asset_classes:
+            target_value = Money(Decimal(percent) / 100 * new_value)
+            deficits[asset_class] = target_value - portfolio.asset_class_value(asset_class)
+    cents = dict((asset_class, to_cents(deficit)) for asset_class, deficit in deficits.items())
+    excess, n = water_fill(cents.values(), to_cents(money))
+    if n == 0:
+        return {}
+    per_class_excess = from_cents(excess) / n
+    return dict((asset_class, deficit - per_class_excess)
+                for asset_class, deficit in deficits.items() if cents[asset_class] * n > excess)
+
+
+def _get_bulk_stocks(available_stocks, pricer):
+    # The greedy search fills large deficits with the most expensive stock of
+    # the asset class, so that is the stock to buy in bulk
+    bulk_stocks = {}
+    for stock in available_stocks:
+        bulk_stock = bulk_stocks.get(stock.asset_class)
+        if bulk_stock is None or pricer.get_price(stock) > pricer.get_price(bulk_stock):
+            bulk_stocks[stock.asset_class] = stock
+    return bulk_stocks
+
+
+def get_allocation_buys(portfolio, target_allocation, available_stocks, money, pricer):
     assert money > 0
 
+    # All but the last share of each deficit is bought in bulk and the
+    # greedy search places the remainder
+    bulk_stocks = _get_bulk_stocks(available_stocks, pricer)
+    new_portfolio = portfolio.clone()
+    money_remaining = money
     buys = []
-    
-    def get_next_state(portfolio, money_remaining):
-        def calculate_state_error(state):
-            _, new_portfolio, new_money_remaining = state
-            asset_classes = set(new_portfolio.asset_classes) | set(target_allocation.asset_classes)
-            error = 0.0
-            for asset_class in asset_classes:
-                error += abs(new_portfolio.get_asset_class_percent(asset_class) -
-                             target_allocation[asset_class])**2
-            error += abs(float(new_money_remaining) / float(money))
-            return error
-        
-        def create_state(stock):
-            new_portfolio = portfolio.clone()
-            new_portfolio.add_stock(stock, 1)
-            new_money_remaining = money_remaining - pricer.get_price(stock)
-            if new_money_remaining < 0:
-                return None
-            return Buy(stock, 1), new_portfolio, new_money_remaining
-
-        next_states = filter(None, [create_state(stock) for stock in available_stocks])
-        return min(next_states, key=calculate_state_error) if next_states else None
+    # Money budgeted for classes without available stocks would be left to
+    # the greedy search, so only the classes that can be bought get deficits
+    deficits = get_asset_class_deficits(portfolio, target_allocation, money, bulk_stocks)
+    for asset_class, deficit in sorted(deficits.items()):
+        stock = bulk_stocks[asset_class]
+        amount = int(deficit / pricer.get_price(stock)) - 1
+        if amount < 1:
+            continue
+        new_portfolio.add_stock(stock, amount)
+        money_remaining -= amount * pricer.get_price(stock)
+        buys.append(Buy(stock, amount))
+
+    refinement_buys, new_portfolio, money_remaining = _buy_greedily(
+        new_portfolio, target_allocation, available_stocks, money, money_remaining, pricer)
+    return compress_buys(buys + refinement_buys), new_portfolio, money_remaining
+
+
+def get_lot_buys(portfolio, target_allocation, available_stocks, money, pricer):
+    assert money > 0
 
+    # A step buys lots in every asset class at once: all but the last share
+    # of a fraction of each class's deficit, in the most expensive stock of
+    # the class as the allocation solver does. A step is only taken when it
+    # improves on the current error, and the fraction halves when it does
+    # not. Lots into one class alone would make the other classes' shares
+    # worse, so they could never grow.
+    bulk_stocks = _get_bulk_stocks(available_stocks, pricer)
+    new_portfolio = portfolio.clone()
+    balance = AssetClassBalance(new_portfolio, target_allocation)
     money_remaining = money
+    buys = []
+
+    def get_lots(deficits, fraction):
+        lots = []
+        for asset_class, deficit in sorted(deficits.items()):
+            stock = bulk_stocks[asset_class]
+            price = pricer.get_price(stock)
+            amount = int(fraction * float(deficit) / float(price)) - 1
+            if amount > 0:
+                lots.append((stock, price, amount))
+        return lots
+
+    def buy(lots):
+        for stock, price, amount in lots:
+            new_portfolio.add_stock(stock, amount)
+            buys.append(Buy(stock, amount))
+        return sum(amount * price for _, price, amount in lots)
+
+    deficits = get_asset_class_deficits(portfolio, target_allocation, money, bulk_stocks)
+    fraction = 1.0
     while 1:
-        next_state = get_next_state(portfolio, money_remaining)
-        if next_state is None:
+        lots = get_lots(deficits, fraction)
+        if all(amount <= 1 for _, _, amount in lots):
             break
-        next_buy, portfolio, money_remaining = next_state
-        buys.append(next_buy)
+        # An empty portfolio has no error yet, so any step improves it
+        error = (balance.deviation() + float(money_remaining) / float(money)
+                 if new_portfolio.value else float('inf'))
+        step_balance = balance.clone()
+        spent = 0
+        for stock, price, amount in lots:
+            step_balance.add(stock.asset_class, amount * price)
+            spent += amount * price
+        if step_balance.deviation() + float(money_remaining - spent) / float(money) >= error:
+            fraction /= 2
+            continue
+        for stock, price, amount in lots:
+            deficits[stock.asset_class] -= amount * price
+        money_remaining -= buy(lots)
+        balance = step_balance
+
+    # Steps are rejected where spending raises the error, but the greedy
+    # search spends the money anyway, a share at a time. So money left beyond
+    # a couple of shares per class is spent in one more step toward the
+    # deficits of the money left, which is where the greedy search ends up.
+    if money_remaining > 2 * sum(pricer.get_price(stock) for stock in bulk_stocks.values()):
+        money_remaining -= buy(get_lots(get_asset_class_deficits(
+            new_portfolio, target_allocation, money_remaining, bulk_stocks), 1.0))
 
+    refinement_buys, new_portfolio, money_remaining = _buy_greedily(
+        new_portfolio, target_allocation, available_stocks, money, money_remaining, pricer)
+    return compress_buys(buys + refinement_buys), new_portfolio, money_remaining
+
+
+def get_vectorized_buys(portfolio, target_allocation, available_stocks, money, pricer):
+    assert money > 0
+
+    buys, portfolio, money_remaining = _buy_vectorized(portfolio, target_allocation, available_stocks,
+                                                       money, money, pricer)
     return compress_buys(buys), portfolio, money_remaining
 
 
-def read_invest_file(inifile):
-    portfolio = Portfolio()
+def repair_buys(portfolio, target_allocation, available_stocks, money, pricer, previous_buys,
+                max_moves=1000):
+    # Repairs the buys planned for the same portfolio and money at earlier
+    # prices. Shares are first removed until the plan is affordable, then the
+    # best of adding, removing or swapping one share is applied until none
+    # lowers the greedy error. cold_evaluations estimates the scores a cold
+    # greedy solve would compute: all candidates for every share bought.
+    assert money > 0
+    candidates = [(stock, price, float(price))
+                  for stock, price in index_candidates(available_stocks, pricer)]
+    available_stocks = set(available_stocks)
+    counts = defaultdict(int)
+    for stock, amount in previous_buys:
+        if stock in available_stocks:
+            counts[stock] += amount
+    prices = dict((stock, pricer.get_price(stock)) for stock in counts)
+    float_prices = dict((stock, float(price)) for stock, price in prices.items())
+    balance = AssetClassBalance(portfolio, target_allocation)
+    for stock, amount in counts.items():
+        balance.add(stock.asset_class, prices[stock] * amount)
+    money_remaining = money - sum(prices[stock] * amount for stock, amount in counts.items())
+    float_money = float(money)
+    moves = evaluations = 0
+
+    def removals(score):
+        total = balance.float_terms()[2]
+        for stock in counts:
+            # An empty portfolio has no error to compare
+            if total - float_prices[stock] > 0:
+                yield score(stock.asset_class, -float_prices[stock]), stock
+
+    def remove(stock):
+        counts[stock] -= 1
+        if not counts[stock]:
+            del counts[stock]
+        balance.add(stock.asset_class, -prices[stock])
+        return prices[stock]
+
+    def add(stock, price):
+        prices[stock] = price
+        float_prices[stock] = float(price)
+        counts[stock] += 1
+        balance.add(stock.asset_class, price)
+        return price
+
+    while money_remaining < 0:
+        options = list(removals(balance.scorer(money_remaining, money)))
+        evaluations += len(options)
+        if not options:
+            # Every removal would empty the portfolio
+            options = [(0, stock) for stock in counts]
+        money_remaining += remove(min(options)[1])
+        moves += 1
+
+    while moves < max_moves:
+        # Ties keep the current plan, so every move strictly lowers the error
+        if balance.float_terms()[2] > 0:
+            best_error = balance.deviation() + float(money_remaining) / float_money
+        else:
+            best_error = float('inf')
+        best_move = None
+        score = balance.scorer(money_remaining, money)
+        for stock, price, float_price in candidates:
+            if price <= money_remaining:
+                evaluations += 1
+                error = score(stock.asset_class, float_price)
+                if error < best_error:
+                    best_error, best_move = error, (None, stock, price)
+        for error, stock in removals(score):
+            evaluations += 1
+            if error < best_error:
+                best_error, best_move = error, (stock, None, None)
+        for removed in counts:
+            swapped = balance.clone()
+            swapped.add(removed.asset_class, -prices[removed])
+            swap_money_remaining = money_remaining + prices[removed]
+            swap_score = swapped.scorer(swap_money_remaining, money)
+            for stock, price, float_price in candidates:
+                if price <= swap_money_remaining and stock != removed:
+                    evaluations += 1
+                    error = swap_score(stock.asset_class, float_price)
+                    if error < best_error:
+                        best_error, best_move = error, (removed, stock, price)
+        if best_move is None:
+            break
+        removed, added, price = best_move
+        if removed is not None:
+            money_remaining += remove(removed)
+        if added is not None:
+            money_remaining -= add(added, price)
+        moves += 1
+
+    # Like the greedy solver, money is spent while any share fits
+    while 1:
+        affordable = [candidate for candidate in candidates if candidate[1] <= money_remaining]
+        if not affordable:
+            break
+        evaluations += len(affordable)
+        score = balance.scorer(money_remaining, money)
+        stock, price, _ = min(affordable, key=lambda (stock, _, price): score(stock.asset_class,
+                                                                               price))
+        money_remaining -= add(stock, price)
+        moves += 1
+
+    buys = [Buy(stock, amount) for stock, amount in sorted(counts.items())]
+    new_portfolio = portfolio.clone()
+    for stock, amount in buys:
+        new_portfolio.add_stock(stock, amount)
+    stats = RepairStats(moves, evaluations, len(candidates) * sum(counts.values()))
+    return buys, new_portfolio, money_remaining, stats
+
+
+class _SearchBudgetExhausted(Exception):
+    pass
+
+
+def _counts_nearest_first(ideal_count, max_count):
+    ideal_count = min(max(ideal_count, 0), max_count)
+    yield ideal_count
+    for offset in count(1):
+        above, below = ideal_count + offset, ideal_count - offset
+        if above > max_count and below < 0:
+            return
+        if above <= max_count:
+            yield above
+        if below >= 0:
+            yield below
+
+
+def get_optimal_buys(portfolio, target_allocation, available_stocks, money, pricer,
+                     max_nodes=100000, time_limit=None):
+    assert money > 0
+
+    candidates = index_candidates(available_stocks, pricer)
+    candidate_indices = dict(((stock.asset_class, price), i)
+                             for i, (stock, price) in enumerate(candidates))
+    asset_classes = sorted(portfolio.asset_classes | set(target_allocation.asset_classes))
+    asset_class_indices = dict((asset_class, i) for i, asset_class in enumerate(asset_classes))
+    targets = [float(target_allocation[asset_class]) for asset_class in asset_classes]
+
+    # Money is handled in integer cents so that holdings reached through
+    # different buys compare equal in the transposition table
+    def cents(value):
+        return int(value * 100)
+
+    prices = [cents(price) for _, price in candidates]
+    candidate_classes = [asset_class_indices[stock.asset_class] for stock, _ in candidates]
+    open_classes = [set(candidate_classes[i:]) for i in range(len(candidates) + 1)]
+    money_cents = cents(money)
+    values = [cents(portfolio.asset_class_value(asset_class)) for asset_class in asset_classes]
+
+    def calculate_error(values, total, remaining):
+        deviation = sum((100.0 * value / total - target)**2 for value, target in zip(values, targets))
+        return deviation + float(remaining) / money_cents
+
+    def calculate_lower_bound(i, total, remaining):
+        # A class's share is lowest when all the remaining money is spent and
+        # highest when none is, and only classes of the remaining candidates
+        # can still grow
+        max_total = total + remaining
+        bound = 0.0
+        for asset_class, (value, target) in enumerate(zip(values, targets)):
+            lowest = 100.0 * value / max_total
+            if lowest > target:
+                bound += (lowest - target)**2
+            elif total > 0 and asset_class not in open_classes[i]:
+                highest = 100.0 * value / total
+                if highest < target:
+                    bound += (target - highest)**2
+        return bound
+
+    def evaluate(buys, money_remaining):
+        plan_counts = [0] * len(candidates)
+        plan_values = list(values)
+        for stock, amount in buys:
+            i = candidate_indices[(stock.asset_class, pricer.get_price(stock))]
+            plan_counts[i] += amount
+            plan_values[candidate_classes[i]] += amount * prices[i]
+        return [calculate_error(plan_values, sum(plan_values), cents(money_remaining)),
+                plan_counts]
+
+    # The search starts from the better of the allocation and greedy plans.
+    # The budget covers them too: the allocation plan is cheap, but the
+    # greedy one takes a step per share, so it is only made with the nodes
+    # and time left, one node per step, and may be cut short. Given the
+    # budget for it, a search cut off later is never worse than greedy.
+    deadline = time.time() + time_limit if time_limit is not None else None
+    seeds = [get_allocation_buys(portfolio, target_allocation, available_stocks, money, pricer)]
+    nodes = [0]
+    if max_nodes > 0 and (deadline is None or time.time() < deadline):
+        seeds.insert(0, _buy_greedily(portfolio, target_allocation, available_stocks, money, money,
+                                      pricer, max_steps=max_nodes, deadline=deadline))
+        nodes[0] += len(seeds[0][0])
+    best = min([evaluate(buys, money_remaining) for buys, _, money_remaining in seeds],
+               key=lambda (error, _): error)
+    counts = [0] * len(candidates)
+    total = sum(values)
+    visited = set()
+
+    def enter(i, total, remaining):
+        nodes[0] += 1
+        if nodes[0] > max_nodes or (deadline is not None and time.time() > deadline):
+            raise _SearchBudgetExhausted()
+        key = (i, tuple(values))
+        if key in visited:
+            return None
+        visited.add(key)
+        if total > 0:
+            error = calculate_error(values, total, remaining)
+            if error < best[0]:
+                best[:] = [error, list(counts)]
+        if i == len(candidates) or calculate_lower_bound(i, total, remaining) >= best[0]:
+            return None
+        price, asset_class = prices[i], candidate_classes[i]
+        ideal_count = int(round((targets[asset_class] / 100 * (total + remaining) -
+                                 values[asset_class]) / price))
+        return _counts_nearest_first(ideal_count, remaining // price)
+
+    money_remaining = money_cents
+    stack = []
+    try:
+        children = enter(0, total, money_remaining)
+        if children is not None:
+            stack.append([0, children, 0])
+        while stack:
+            frame = stack[-1]
+            i, children, applied = frame
+            spent = applied * prices[i]
+            values[candidate_classes[i]] -= spent
+            total -= spent
+            money_remaining += spent
+            amount = next(children, None)
+            if amount is None:
+                counts[i] = 0
+                stack.pop()
+                continue
+            spent = amount * prices[i]
+            values[candidate_classes[i]] += spent
+            total += spent
+            money_remaining -= spent
+            counts[i] = frame[2] = amount
+            children = enter(i + 1, total, money_remaining)
+            if children is not None:
+                stack.append([i + 1, children, 0])
+    except _SearchBudgetExhausted:
+        pass
+    profiling.count('solver_iterations', nodes[0])
+
+    buys = [Buy(stock, amount) for (stock, _), amount in zip(candidates, best[1]) if amount > 0]
+    new_portfolio = portfolio.clone()
+    money_remaining = money
+    for stock, amount in buys:
+        new_portfolio.add_stock(stock, amount)
+        money_remaining -= amount * pricer.get_price(stock)
+    return buys, new_portfolio, money_remaining
+
+
+def get_rebalance_trades(portfolio, target_allocation, available_stocks, money, pricer,
+                         cost_percent=0, penalty=1.0):
+    # Sells as well as buys. The asset class trades minimizing the deviation
+    # from the targets plus cost_percent of the money traded are found by
+    # rebalance.solve_trades and rounded to whole shares: sells of stocks no
+    # longer available first, then of the largest holdings, and buys of the
+    # cheapest available stock of each class. Sells are Buys of negative
+    # amounts and the costs are paid from the money.
+    assert money >= 0
+    cost_rate = Decimal(cost_percent) / 100
+    buy_stocks = {}
+    for stock in available_stocks:
+        cheapest = buy_stocks.get(stock.asset_class)
+        if cheapest is None or pricer.get_price(stock) < pricer.get_price(cheapest):
+            buy_stocks[stock.asset_class] = stock
+    targets = dict(target_allocation)
+    asset_classes = sorted(set(targets) | portfolio.asset_classes)
+    costs = [float(cost_rate)] * len(asset_classes)
+    class_trades = zip(asset_classes, rebalance.solve_trades(
+        [float(portfolio.asset_class_value(asset_class)) for asset_class in asset_classes],
+        [targets.get(asset_class, 0) / 100.0 for asset_class in asset_classes], float(money),
+        costs, costs, upper=[rebalance.INFINITY if asset_class in buy_stocks else 0
+                             for asset_class in asset_classes], penalty=penalty))
+
+    holdings = defaultdict(list)
+    for stock, amount in portfolio:
+        holdings[stock.asset_class].append((stock, amount))
+    available_stocks = set(available_stocks)
+    new_portfolio = portfolio.clone()
+    money_remaining = money
+    trades = []
+    for asset_class, class_trade in class_trades:
+        if class_trade >= 0:
+            continue
+        to_sell = -class_trade
+        for stock, amount in sorted(holdings[asset_class], key=lambda (stock, amount): (
+                stock in available_stocks, -pricer.get_price(stock) * amount)):
+            price = pricer.get_price(stock)
+            amount = min(amount, int(round(to_sell / float(price))))
+            if amount < 1:
+                continue
+            new_portfolio.remove_stock(stock, amount)
+            money_remaining += amount * price - Money(amount * price * cost_rate)
+            to_sell -= float(amount * price)
+            trades.append(Buy(stock, -amount))
+    for asset_class, class_trade in sorted(class_trades, key=lambda (_, trade): -trade):
+        if class_trade <= 0:
+            continue
+        stock = buy_stocks[asset_class]
+        price = pricer.get_price(stock)
+        amount = min(int(round(class_trade / float(price))),
+                     int(money_remaining / (price * (1 + cost_rate))))
+        while amount > 0 and amount * price + Money(amount * price * cost_rate) > money_remaining:
+            amount -= 1
+        if amount < 1:
+            continue
+        new_portfolio.add_stock(stock, amount)
+        money_remaining -= amount * price + Money(amount * price * cost_rate)
+        trades.append(Buy(stock, amount))
+    return trades, new_portfolio, money_remaining
+
+
+BUY_STRATEGIES = {'greedy': get_next_buys,
+                  'allocation': get_allocation_buys,
+                  'lot': get_lot_buys,
+                  'vectorized': get_vectorized_buys,
+                  'optimal': get_optimal_buys,
+                  'rebalance': get_rebalance_trades}
+
+
+def sweep_buys(portfolio, target_allocation, available_stocks, budgets, pricer):
+    assert all(money > 0 for money in budgets)
+
+    # Every budget follows the same greedy path until the leftover money
+    # term makes one of them choose a different stock, so budgets are
+    # searched in groups that share their state and split when they diverge.
+    # The buys of a group are kept as a linked list of (buy, previous) pairs so
+    # that splitting a group does not copy the common path
+    candidates = [(stock, price, float(price))
+                  for stock, price in index_candidates(available_stocks, pricer)]
+    results = {}
+    groups = [(None, Money(0), AssetClassBalance(portfolio, target_allocation), sorted(set(budgets)))]
+    while groups:
+        buys, money_spent, balance, group_budgets = groups.pop()
+        deviation_score = balance.deviation_scorer()
+        deviations = [deviation_score(stock.asset_class, float_price)
+                      for stock, _, float_price in candidates]
+        choices = defaultdict(list)
+        for money in group_budgets:
+            money_remaining = money - money_spent
+            float_money_remaining = float(money_remaining)
+            float_money = float(money)
+            choice = None
+            for i, (_, price, float_price) in enumerate(candidates):
+                if price > money_remaining:
+                    continue
+                error = deviations[i] + abs(float_money_remaining - float_price) / float_money
+                if choice is None or error < choice_error:
+                    choice, choice_error = i, error
+            if choice is None:
+                buy_list = []
+                node = buys
+                while node is not None:
+                    buy, node = node
+                    buy_list.append(buy)
+                new_portfolio = portfolio.clone()
+                for stock, amount in buy_list:
+                    new_portfolio.add_stock(stock, amount)
+                results[money] = compress_buys(buy_list), new_portfolio, money_remaining
+            else:
+                choices[choice].append(money)
+        for n, (choice, choice_budgets) in enumerate(sorted(choices.items())):
+            stock, price, _ = candidates[choice]
+            new_balance = balance if n == len(choices) - 1 else balance.clone()
+            new_balance.add(stock.asset_class, price)
+            groups.append(((Buy(stock, 1), buys), money_spent + price, new_balance, choice_budgets))
+    return results
+
+
+def budget_range(start, stop, step):
+    assert step > 0
+    budgets = []
+    money = start
+    while money <= stop:
+        budgets.append(money)
+        money += step
+    return budgets
+
+
+def compile_invest_file(inifile):
+    # The file as plain data, read in one pass over the stock sections
     config = ConfigParser.ConfigParser()
     config.optionxform = str
     config.readfp(inifile)
-    symbols_stocks = {}
-    for symbol, amount in config.items('portfolio'):
-        asset_class = config.get(symbol, 'asset_class')
-        stock = Stock(symbol, asset_class)
-        portfolio.add_stock(stock, int(amount))
-    target_allocation = Allocation(dict((a, int(b)) for a, b in config.items('target_allocation')))
-    stock_symbols = set(config.sections()) - set(['portfolio', 'target_allocation'])
+    asset_classes = {}
     available_stocks = []
-    for symbol in stock_symbols:
+    for symbol in config.sections():
+        if symbol in ('portfolio', 'target_allocation'):
+            continue
+        asset_class = asset_classes[symbol] = config.get(symbol, 'asset_class')
         if config.get(symbol, 'available') == 'yes':
-            asset_class = config.get(symbol, 'asset_class')
-            available_stocks.append(Stock(symbol, asset_class))
+            available_stocks.append([symbol, asset_class])
+    return {'portfolio': [[symbol, asset_classes[symbol], int(amount)]
+                          for symbol, amount in config.items('portfolio')],
+            'target_allocation': [[asset_class, int(percent)]
+                                  for asset_class, percent in config.items('target_allocation')],
+            'available_stocks': available_stocks}
+
+
+def load_invest_data(data):
+    portfolio = Portfolio()
+    for symbol, asset_class, amount in data['portfolio']:
+        portfolio.add_stock(Stock(symbol, asset_class), amount)
+    target_allocation = Allocation(data['target_allocation'])
+    available_stocks = [Stock(symbol, asset_class)
+                        for symbol, asset_class in data['available_stocks']]
     return portfolio, target_allocation, available_stocks
 
 
-def main(portfolio, target_allocation, stocks_available, money_to_invest):
+def read_invest_file(inifile):
+    return load_invest_data(compile_invest_file(inifile))
+
+
+def load_invest_file(path):
+    # Like read_invest_file(open(path)) through a compiled cache beside the file
+    return load_invest_data(compiled.load_cached(path, 'invest', compile_invest_file))
+
+
+def read_compiled_invest_files(compiled_file):
+    # Yields (name, portfolio, target_allocation, available_stocks)
+    for name, data in compiled.read_compiled(compiled_file, 'invest'):
+        yield (name,) + load_invest_data(data)
+
+
+def format_holdings(valuation):
+    lines = ['%-30s: %4d x %6.2f = %10.2f' % (holding.name, holding.amount, holding.price,
+                                              holding.value)
+             for holding in valuation.holdings]
+    lines.append('%-30s: %26.2f' % ('Total value', valuation.value))
+    return lines
+
+
+def format_asset_class_balance(valuation):
+    lines = ['Asset class  Allocation    Target Deviation']
+    lines.extend('%-12s: %8.1f%% %8.1f%% %+8.1f%%' % (share.asset_class, share.percent,
+                                                      share.target, share.deviation)
+                 for share in valuation.asset_classes)
+    return lines
+
+
+def write_text_reports(reports, output=sys.stdout):
+    for invest_report in reports:
+        lines = ['Current portfolio as of %s' % invest_report.date]
+        lines.extend(format_holdings(invest_report.current))
+        lines.append('Current asset class balance')
+        lines.extend(format_asset_class_balance(invest_report.current))
+        lines.append('Finding investment actions')
+        lines.append('Found actions')
+        lines.extend(' - %s %3d x %-30s for %7.2f (%2.0f%%)' % (
+            'Buy' if buy.amount > 0 else 'Sell', abs(buy.amount), buy.name, abs(buy.total),
+            buy.percent) for buy in invest_report.buys)
+        lines.append('Money spent %.2f, remaining %.2f' % (invest_report.spent,
+                                                            invest_report.remaining))
+        lines.append('New portfolio')
+        lines.extend(format_holdings(invest_report.new))
+        lines.append('New asset class balance')
+        lines.extend(format_asset_class_balance(invest_report.new))
+        print >>output, '\n'.join(lines)
+
+
+REPORT_WRITERS = {'text': write_text_reports, 'jsonl': report.write_jsonl,
+                  'csv': report.write_invest_csv}
+
+
+def main(portfolio, target_allocation, stocks_available, money_to_invest,
+         buy_strategy=get_next_buys, output_format='text', output=sys.stdout):
+    pricer = stock_pricer.StockPricer.get_pricer()
+    pricer.prefetch(set(stock for stock, _ in portfolio) | set(stocks_available))
+    with profiling.span('solve'):
+        buys, new_portfolio, money_remaining = buy_strategy(portfolio, target_allocation, stocks_available, money_to_invest, pricer)
+    with profiling.span('render'):
+        invest_report = report.make_invest_report(None, portfolio, target_allocation,
+                                                  money_to_invest, buys, new_portfolio,
+                                                  money_remaining, pricer)
+        REPORT_WRITERS[output_format]([invest_report], output)
+    return new_portfolio, money_remaining
+
+
+def sweep_main(portfolio, target_allocation, stocks_available, budgets):
     pricer = stock_pricer.StockPricer.get_pricer()
+    pricer.prefetch(set(stock for stock, _ in portfolio) | set(stocks_available))
     print 'Current portfolio as of %s' % datetime.date.today()
     print(portfolio)
-    print 'Current asset class balance'
-    portfolio.print_asset_class_balance(target_allocation)
-    print 'Finding investment actions'
-    buys, new_portfolio, money_remaining = get_next_buys(portfolio, target_allocation, stocks_available, money_to_invest, pricer)
-    money_spent = money_to_invest - money_remaining
-    print 'Found actions'
-    for stock, amount in buys:
-        price = pricer.get_price(stock)
-        name = pricer.get_name(stock)
-        total_price = amount * price
-        percent = 100.0 * float(total_price) / float(money_spent)
-        print ' - Buy %3d x %-30s for %7.2f (%2.0f%%)' % (amount, name, total_price, percent)
-    print 'Money spent %.2f, remaining %.2f' % (money_spent, money_remaining)
-    print 'New portfolio'
-    print(new_portfolio)
-    print 'New asset class balance'
-    new_portfolio.print_asset_class_balance(target_allocation)
-    return new_portfolio, money_remaining
+    print 'Finding investment actions for %d budgets' % len(budgets)
+    with profiling.span('solve'):
+        results = sweep_buys(portfolio, target_allocation, stocks_available, budgets, pricer)
+    with profiling.span('render'):
+        for money_to_invest in sorted(results):
+            buys, new_portfolio, money_remaining = results[money_to_invest]
+            print 'Investing %.2f: spent %.2f, remaining %.2f' % (
+                money_to_invest, money_to_invest - money_remaining, money_remaining)
+            for stock, amount in buys:
+                print ' - Buy %3d x %-30s' % (amount, pricer.get_name(stock))
+    return results
 
 
 if __name__ == '__main__':
-    portfolio, target_allocation, available_stocks = read_invest_file(open(sys.argv[1]))
-    money_to_invest = Money(sys.argv[2])
-    pricer = stock_pricer.YahooStockPricer()
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('portfolio')
+    parser.add_argument('amount', nargs='?')
+    parser.add_argument('-s', '--solver', help='buy solver', choices=sorted(BUY_STRATEGIES),
+                        default='greedy')
+    parser.add_argument('-r', '--range', help='sweep budgets from START to STOP by STEP',
+                        nargs=3, type=Money, metavar=('START', 'STOP', 'STEP'))
+    parser.add_argument('-t', '--time-limit', help='time limit in seconds for the optimal solver',
+                        type=float)
+    parser.add_argument('--fixed-point', help='use integer cents in the greedy solver',
+                        action='store_true')
+    parser.add_argument('--cost-percent', help='trading cost percent for the rebalance solver',
+                        type=Decimal, default=Decimal(0))
+    parser.add_argument('--price-cache', help='persistent price cache file')
+    parser.add_argument('--cache-ttl', help='price cache time to live in seconds', type=float,
+                        default=3600)
+    parser.add_argument('--profile', help='write a JSON timing profile to FILE (default stderr)',
+                        nargs='?', const='-', metavar='FILE')
+    parser.add_argument('--compiled-cache', help='cache the parsed portfolio file beside it',
+                        action='store_true')
+    parser.add_argument('--format', help='output format for an amount',
+                        choices=sorted(REPORT_WRITERS), default='text')
+    snapshot_group = parser.add_mutually_exclusive_group()
+    snapshot_group.add_argument('--record-snapshot', help='record the prices used to a snapshot '
+                                'file', metavar='FILE')
+    snapshot_group.add_argument('--snapshot', help='use the prices of a snapshot file instead '
+                                'of downloading them', metavar='FILE')
+    args = parser.parse_args()
+    if (args.amount is None) == (args.range is None):
+        parser.error('give either an amount or a budget range')
+    if args.range and args.format != 'text':
+        parser.error('a budget range is only written as text')
+    if args.profile:
+        profiling.set_profiler(profiling.Profiler())
+
+    with profiling.span('read_config'):
+        if args.compiled_cache:
+            portfolio, target_allocation, available_stocks = load_invest_file(args.portfolio)
+        else:
+            portfolio, target_allocation, available_stocks = read_invest_file(open(args.portfolio))
+    price_cache = None
+    if args.price_cache:
+        price_cache = PriceCache(args.price_cache, args.cache_ttl)
+    pricer = stock_pricer.YahooStockPricer(price_cache=price_cache)
+    if args.snapshot:
+        pricer = SnapshotStockPricer(Snapshot(args.snapshot))
+    elif args.record_snapshot:
+        snapshot_writer = SnapshotWriter(args.record_snapshot)
+        pricer = RecordingStockPricer(pricer, snapshot_writer)
     stock_pricer.StockPricer.set_pricer(pricer)
 
-    print 'Investing %.2f' % money_to_invest
-    portfolio, money_remaining = main(portfolio, target_allocation, available_stocks, money_to_invest)
+    if args.range:
+        sweep_main(portfolio, target_allocation, available_stocks, budget_range(*args.range))
+    else:
+        money_to_invest = Money(args.amount)
+        if args.format == 'text':
+            print 'Investing %.2f' % money_to_invest
+        buy_strategy = BUY_STRATEGIES[args.solver]
+        if args.solver == 'optimal' and args.time_limit is not None:
+            buy_strategy = partial(get_optimal_buys, time_limit=args.time_limit)
+        elif args.solver == 'greedy' and args.fixed_point:
+            buy_strategy = partial(get_next_buys, fixed_point=True)
+        elif args.solver == 'rebalance':
+            buy_strategy = partial(get_rebalance_trades, cost_percent=args.cost_percent)
+        portfolio, money_remaining = main(portfolio, target_allocation, available_stocks,
+                                         money_to_invest, buy_strategy, args.format)
+    if args.record_snapshot:
+        snapshot_writer.close()
+    if args.profile:
+        profiling.write_profile(profiling.get_profiler(), args.profile)
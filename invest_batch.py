@@ -0,0 +1,149 @@
+import json
+import os
+import sys
+from multiprocessing import Pool
+
+import invest
+import stock_pricer
+from price_cache import PriceCache
+from snapshot import Snapshot, SnapshotStockPricer
+from util import Money
+
+
+def read_manifest(manifest_file, base_dir=''):
+    # One client per line: the portfolio file and the amount to invest.
+    # Relative paths are relative to the manifest.
+    clients = []
+    for line in manifest_file:
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        path, amount = line.rsplit(None, 1)
+        clients.append((os.path.join(base_dir, path), Money(amount)))
+    return clients
+
+
+def list_portfolio_dir(directory, amount):
+    return [(os.path.join(directory, name), amount)
+            for name in sorted(os.listdir(directory)) if name.endswith('.ini')]
+
+
+def read_clients(clients, compiled_cache=False):
+    tasks = []
+    for path, amount in clients:
+        if compiled_cache:
+            portfolio, target_allocation, available_stocks = invest.load_invest_file(path)
+        else:
+            portfolio, target_allocation, available_stocks = invest.read_invest_file(open(path))
+        tasks.append((path, portfolio, target_allocation, available_stocks, amount))
+    return tasks
+
+
+def read_compiled_clients(compiled_file, amount):
+    return [(name, portfolio, target_allocation, available_stocks, amount)
+            for name, portfolio, target_allocation, available_stocks
+            in invest.read_compiled_invest_files(compiled_file)]
+
+
+def make_price_table(pricer, tasks):
+    stocks = set()
+    for _, portfolio, _, available_stocks, _ in tasks:
+        stocks.update(stock for stock, _ in portfolio)
+        stocks.update(available_stocks)
+    pricer.prefetch(stocks)
+    return dict((stock.symbol, (pricer.get_name(stock), pricer.get_price(stock)))
+                for stock in stocks)
+
+
+def _init_worker(pricer, solver):
+    global _solver
+    stock_pricer.StockPricer.set_pricer(pricer)
+    _solver = solver
+
+
+def _rebalance(task):
+    client, portfolio, target_allocation, available_stocks, money = task
+    pricer = stock_pricer.StockPricer.get_pricer()
+    try:
+        buys, new_portfolio, money_remaining = invest.BUY_STRATEGIES[_solver](
+            portfolio, target_allocation, available_stocks, money, pricer)
+    except Exception as e:
+        return {'client': client, 'error': '%s: %s' % (type(e).__name__, e)}
+    return {'client': client,
+            'money': str(money),
+            'spent': str(money - money_remaining),
+            'remaining': str(money_remaining),
+            'buys': [{'symbol': stock.symbol, 'amount': amount,
+                      'price': str(pricer.get_price(stock))}
+                     for stock, amount in sorted(buys)]}
+
+
+def rebalance_batch(tasks, pricer, solver='greedy', processes=None, chunksize=16):
+    # Yields one result per client in completion order. The pricer is sent
+    # to each worker, so it should be a table or snapshot pricer.
+    if processes == 1:
+        _init_worker(pricer, solver)
+        for task in tasks:
+            yield _rebalance(task)
+        return
+    pool = Pool(processes, _init_worker, (pricer, solver))
+    try:
+        for result in pool.imap_unordered(_rebalance, tasks, chunksize):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def main(clients, pricer, solver='greedy', processes=None, output=sys.stdout,
+         compiled_cache=False):
+    write_results(read_clients(clients, compiled_cache), pricer, solver, processes, output)
+
+
+def write_results(tasks, pricer, solver='greedy', processes=None, output=sys.stdout):
+    if not isinstance(pricer, SnapshotStockPricer):
+        # A snapshot is shared by the workers mapping the same file
+        pricer = stock_pricer.TableStockPricer(make_price_table(pricer, tasks))
+    for result in rebalance_batch(tasks, pricer, solver, processes):
+        output.write(json.dumps(result, sort_keys=True) + '\n')
+        output.flush()
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('clients', help='manifest file of "portfolio amount" lines, a '
+                        'directory of portfolio files or a .jsonl file of compiled portfolios')
+    parser.add_argument('-a', '--amount', help='amount to invest for each portfolio in a '
+                        'directory or compiled file', type=Money)
+    parser.add_argument('-s', '--solver', help='buy solver',
+                        choices=sorted(invest.BUY_STRATEGIES), default='greedy')
+    parser.add_argument('-j', '--processes', help='number of worker processes', type=int)
+    parser.add_argument('--snapshot', help='use the prices of a snapshot file instead of '
+                        'downloading them', metavar='FILE')
+    parser.add_argument('--price-cache', help='persistent price cache file')
+    parser.add_argument('--cache-ttl', help='price cache time to live in seconds', type=float,
+                        default=3600)
+    parser.add_argument('--compiled-cache', help='cache each parsed portfolio file beside it',
+                        action='store_true')
+    args = parser.parse_args()
+
+    compiled_file = args.clients.endswith('.jsonl')
+    if (os.path.isdir(args.clients) or compiled_file) and args.amount is None:
+        parser.error('a directory or compiled file of portfolios needs --amount')
+    if compiled_file:
+        tasks = read_compiled_clients(open(args.clients), args.amount)
+    elif os.path.isdir(args.clients):
+        tasks = read_clients(list_portfolio_dir(args.clients, args.amount), args.compiled_cache)
+    else:
+        tasks = read_clients(read_manifest(open(args.clients), os.path.dirname(args.clients)),
+                             args.compiled_cache)
+    price_cache = None
+    if args.price_cache:
+        price_cache = PriceCache(args.price_cache, args.cache_ttl)
+    if args.snapshot:
+        pricer = SnapshotStockPricer(Snapshot(args.snapshot))
+    else:
+        pricer = stock_pricer.YahooStockPricer(price_cache=price_cache)
+    write_results(tasks, pricer, args.solver, args.processes)
@@ -0,0 +1,127 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+from mock import Mock
+
+import compiled
+import invest
+from snapshot import Snapshot, SnapshotStockPricer, SnapshotWriter
+from stock_pricer import TableStockPricer
+from util import Money, Stock
+from invest_batch import *
+
+
+PORTFOLIO = '''[portfolio]
+SYM1=%d
+[target_allocation]
+bond=50
+world=50
+[SYM1]
+asset_class=bond
+available=yes
+[SYM2]
+asset_class=world
+available=yes
+'''
+
+QUOTES = {'SYM1': ('Stock 1', Money(4)), 'SYM2': ('Stock 2', Money(10))}
+
+
+class BatchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for i in range(3):
+            open(os.path.join(self.directory, 'client%d.ini' % i), 'w').write(PORTFOLIO % i)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+class ReadManifestTest(unittest.TestCase):
+    def test(self):
+        manifest = StringIO('# clients\nclient0.ini 100\n\n/abs/client 1.ini 25.5  # note\n')
+        self.assertEqual([('base/client0.ini', Money(100)), ('/abs/client 1.ini', Money('25.5'))],
+                         read_manifest(manifest, 'base'))
+
+
+class ListPortfolioDirTest(BatchTestCase):
+    def test(self):
+        open(os.path.join(self.directory, 'notes.txt'), 'w').write('')
+        self.assertEqual([(os.path.join(self.directory, 'client%d.ini' % i), Money(50))
+                          for i in range(3)],
+                         list_portfolio_dir(self.directory, Money(50)))
+
+
+class MakePriceTableTest(BatchTestCase):
+    def test_prefetches_union_once(self):
+        pricer = TableStockPricer(QUOTES)
+        pricer.prefetch = Mock()
+        tasks = read_clients(list_portfolio_dir(self.directory, Money(50)))
+        self.assertEqual(QUOTES, make_price_table(pricer, tasks))
+        pricer.prefetch.assert_called_once_with(
+            set([Stock('SYM1', 'bond'), Stock('SYM2', 'world')]))
+
+
+class MainTest(BatchTestCase):
+    def run_main(self, processes):
+        output = StringIO()
+        main(list_portfolio_dir(self.directory, Money(20)), TableStockPricer(QUOTES),
+             processes=processes, output=output)
+        return sorted((json.loads(line) for line in output.getvalue().splitlines()),
+                      key=lambda result: result['client'])
+
+    def test_in_process(self):
+        results = self.run_main(1)
+        self.assertEqual(3, len(results))
+        self.assertEqual({'client': os.path.join(self.directory, 'client0.ini'),
+                          'money': '20.00', 'spent': '18.00', 'remaining': '2.00',
+                          'buys': [{'symbol': 'SYM1', 'amount': 2, 'price': '4.00'},
+                                   {'symbol': 'SYM2', 'amount': 1, 'price': '10.00'}]},
+                         results[0])
+
+    def test_process_pool(self):
+        self.assertEqual(self.run_main(1), self.run_main(2))
+
+    def test_snapshot_shared_by_workers(self):
+        path = os.path.join(self.directory, 'prices.snapshot')
+        writer = SnapshotWriter(path)
+        for symbol, (name, price) in QUOTES.items():
+            writer.record('yahoo:' + symbol, name, price)
+        writer.close()
+        output = StringIO()
+        main(list_portfolio_dir(self.directory, Money(20)),
+             SnapshotStockPricer(Snapshot(path)), processes=2, output=output)
+        self.assertEqual(self.run_main(1),
+                         sorted((json.loads(line) for line in output.getvalue().splitlines()),
+                                key=lambda result: result['client']))
+
+    def test_compiled_cache(self):
+        output = StringIO()
+        main(list_portfolio_dir(self.directory, Money(20)), TableStockPricer(QUOTES),
+             processes=1, output=output, compiled_cache=True)
+        self.assertTrue(os.path.exists(os.path.join(self.directory, '.client0.ini.compiled.json')))
+        self.assertEqual(self.run_main(1),
+                         sorted((json.loads(line) for line in output.getvalue().splitlines()),
+                                key=lambda result: result['client']))
+
+    def test_compiled_clients(self):
+        compiled_file = StringIO()
+        for path, _ in list_portfolio_dir(self.directory, Money(20)):
+            compiled.write_compiled(compiled_file, path, 'invest',
+                                    invest.compile_invest_file(open(path)))
+        output = StringIO()
+        write_results(read_compiled_clients(StringIO(compiled_file.getvalue()), Money(20)),
+                      TableStockPricer(QUOTES), processes=1, output=output)
+        self.assertEqual(self.run_main(1),
+                         sorted((json.loads(line) for line in output.getvalue().splitlines()),
+                                key=lambda result: result['client']))
+
+    def test_error_reported_per_client(self):
+        tasks = read_clients(list_portfolio_dir(self.directory, Money(20)))
+        results = list(rebalance_batch(tasks, TableStockPricer({}), processes=1))
+        self.assertEqual(3, len(results))
+        self.assertTrue(results[0]['error'].startswith('KeyError'))
@@ -1,10 +1,14 @@
+import json
 import os
+import pickle
 import unittest
 import datetime
 import tempfile
+from itertools import product
 from cStringIO import StringIO
 from mock import Mock, sentinel, call, patch
 
+import invest
 from stock_pricer import StockPricer
 from util import Money
 from invest import *
@@ -39,6 +43,78 @@ class TestCaseWithPortfolio(unittest.TestCase):
         self.available_stocks = [stock2, stock3, stock4]
         
 
+class PortfolioTest(TestCaseWithPortfolio):
+    def test_iteration(self):
+        self.assertItemsEqual([(stock1, 10), (stock2, 2), (stock3, 100)], list(self.portfolio))
+
+    def test_equality_ignores_order(self):
+        portfolio = Portfolio()
+        portfolio.add_stock(stock3, 100)
+        portfolio.add_stock(stock2, 2)
+        portfolio.add_stock(stock1, 10)
+        self.assertEqual(self.portfolio, portfolio)
+        portfolio.add_stock(stock4, 1)
+        self.assertNotEqual(self.portfolio, portfolio)
+
+    def test_clone_is_independent(self):
+        clone = self.portfolio.clone()
+        clone.add_stock(stock4, 3)
+        self.portfolio.add_stock(stock1, 1)
+        self.assertItemsEqual([(stock1, 11), (stock2, 2), (stock3, 100)], list(self.portfolio))
+        self.assertItemsEqual([(stock1, 10), (stock2, 2), (stock3, 100), (stock4, 3)], list(clone))
+
+    def test_values(self):
+        self.assertEqual(Money(360), self.portfolio.value)
+        self.assertEqual(Money(60), self.portfolio.asset_class_value('bond'))
+        self.assertEqual(Money(0), self.portfolio.asset_class_value('emerging'))
+        self.portfolio.add_stock(stock4, 2)
+        self.assertEqual(Money(374), self.portfolio.value)
+        self.assertEqual(Money(14), self.portfolio.asset_class_value('emerging'))
+
+    def test_clone_shares_cached_values_safely(self):
+        self.assertEqual(Money(360), self.portfolio.value)
+        clone = self.portfolio.clone()
+        clone.add_stock(stock4, 1)
+        self.assertEqual(Money(367), clone.value)
+        self.assertEqual(Money(360), self.portfolio.value)
+
+    def test_reprice(self):
+        self.assertEqual(Money(360), self.portfolio.value)
+        StockPricer.get_pricer().price_dict[stock3] = Money(4)
+        self.assertEqual(Money(360), self.portfolio.value)
+        self.portfolio.reprice()
+        self.assertEqual(Money(460), self.portfolio.value)
+
+    def test_remove_stock(self):
+        self.portfolio.remove_stock(stock1, 4)
+        self.assertEqual(Money(344), self.portfolio.value)
+        self.portfolio.remove_stock(stock2, 2)
+        self.assertItemsEqual([(stock1, 6), (stock3, 100)], list(self.portfolio))
+        self.assertRaises(ValueError, self.portfolio.remove_stock, stock4, 1)
+
+    def test_removing_all_shares_drops_holding(self):
+        portfolio = Portfolio()
+        portfolio.add_stock(stock4, 2)
+        portfolio.remove_stock(stock4, 2)
+        self.assertEqual(Portfolio(), portfolio)
+        self.assertEqual([], list(portfolio))
+
+    def test_size_follows_holdings(self):
+        for i in range(100):
+            stock_table.index(Stock('UNUSED%d' % i, 'world'))
+        portfolio = Portfolio()
+        portfolio.add_stock(stock4, 1)
+        self.assertEqual(1, len(portfolio._amounts))
+        self.assertEqual(0, portfolio.get_amount(Stock('NEVER_HELD', 'world')))
+        self.assertIsNone(stock_table.find(Stock('NEVER_HELD', 'world')))
+
+    def test_pickle(self):
+        self.assertEqual(self.portfolio, pickle.loads(pickle.dumps(self.portfolio)))
+
+    def test_pickle_empty(self):
+        self.assertEqual(Portfolio(), pickle.loads(pickle.dumps(Portfolio())))
+
+
 class AcceptanceTest(unittest.TestCase):
     def setUp(self):
         StockPricer.set_pricer(FakePricer())
@@ -98,6 +174,15 @@ class MainTest(TestCaseWithPortfolio):
     def test_remaining_money(self):
         self.assertEqual(Money(2), self.money_remaining)
 
+    def test_jsonl_output(self):
+        output = StringIO()
+        main(self.portfolio, self.target_allocation, self.available_stocks, Money(50),
+             output_format='jsonl', output=output)
+        record = json.loads(output.getvalue())
+        self.assertEqual('48.00', record['spent'])
+        self.assertItemsEqual([('SYM2', 2), ('SYM4', 4)],
+                              [(buy['symbol'], buy['amount']) for buy in record['buys']])
+
         
 class GetNextBuysTest(TestCaseWithPortfolio):
     def test(self):
@@ -113,8 +198,399 @@ class GetNextBuysTest(TestCaseWithPortfolio):
 
         self.assertItemsEqual([Buy(stock2, 2), Buy(stock4, 4)], buys)
         self.assertEqual(Money(2), money_remaining)
+
+    def test_fixed_point_matches_decimal(self):
+        for money in [Money(3), Money(50), Money('123.45'), Money(1000)]:
+            expected = get_next_buys(self.portfolio, self.target_allocation,
+                                     self.available_stocks, money, self.pricer)
+            buys, new_portfolio, money_remaining = get_next_buys(
+                self.portfolio, self.target_allocation, self.available_stocks, money, self.pricer,
+                fixed_point=True)
+            self.assertItemsEqual(expected[0], buys)
+            self.assertEqual(expected[1], new_portfolio)
+            self.assertEqual(expected[2], money_remaining)
+            self.assertIsInstance(money_remaining, Decimal)
+
+    def test_portfolio_not_modified(self):
+        original = self.portfolio.clone()
+        get_next_buys(self.portfolio, self.target_allocation, self.available_stocks, Money(50),
+                      self.pricer)
+        self.assertEqual(original, self.portfolio)
         
 
+class IndexCandidatesTest(TestCaseWithPortfolio):
+    def test_keeps_first_stock_of_each_asset_class_and_price(self):
+        stock5 = Stock('SYM5', 'bond')
+        stock6 = Stock('SYM6', 'emerging')
+        self.pricer.price_dict[stock5] = Money(10)
+        self.pricer.price_dict[stock6] = Money(8)
+        candidates = index_candidates([stock2, stock3, stock5, stock4, stock6], self.pricer)
+        self.assertEqual([(stock2, Money(10)), (stock3, Money(3)), (stock4, Money(7)),
+                          (stock6, Money(8))], candidates)
+
+    def test_duplicates_do_not_change_buys(self):
+        stock5 = Stock('SYM5', 'emerging')
+        self.pricer.price_dict[stock5] = Money(7)
+        buys, new_portfolio, money_remaining = get_next_buys(
+            self.portfolio, self.target_allocation, self.available_stocks + [stock5], Money(50),
+            self.pricer)
+        self.assertItemsEqual([Buy(stock2, 2), Buy(stock4, 4)], buys)
+
+
+class AssetClassBalanceTest(TestCaseWithPortfolio):
+    def calculate_error(self, portfolio, money_remaining, money):
+        error = 0.0
+        for asset_class in set(portfolio.asset_classes) | set(self.target_allocation.asset_classes):
+            error += (portfolio.get_asset_class_percent(asset_class) -
+                      self.target_allocation[asset_class])**2
+        return error + float(money_remaining) / float(money)
+
+    def test_score_matches_full_recalculation(self):
+        balance = AssetClassBalance(self.portfolio, self.target_allocation)
+        score = balance.scorer(Money(50), Money(50))
+        for stock in self.available_stocks:
+            price = self.pricer.get_price(stock)
+            new_portfolio = self.portfolio.clone()
+            new_portfolio.add_stock(stock, 1)
+            expected = self.calculate_error(new_portfolio, Money(50) - price, Money(50))
+            self.assertAlmostEqual(expected, score(stock.asset_class, float(price)))
+
+    def test_add(self):
+        balance = AssetClassBalance(self.portfolio, self.target_allocation)
+        balance.add(stock4.asset_class, Money(14))
+        self.portfolio.add_stock(stock4, 2)
+        expected = AssetClassBalance(self.portfolio, self.target_allocation)
+        self.assertEqual(expected.scorer(Money(36), Money(50))('bond', 10.0),
+                         balance.scorer(Money(36), Money(50))('bond', 10.0))
+
+
+class GetAllocationBuysTest(TestCaseWithPortfolio):
+    def test_matches_greedy(self):
+        for money in [Money(7), Money(50), Money(500), Money(5000)]:
+            expected = get_next_buys(self.portfolio, self.target_allocation,
+                                     self.available_stocks, money, self.pricer)
+            buys, new_portfolio, money_remaining = get_allocation_buys(
+                self.portfolio, self.target_allocation, self.available_stocks, money, self.pricer)
+            self.assertItemsEqual(expected[0], buys)
+            self.assertEqual(expected[1], new_portfolio)
+            self.assertEqual(expected[2], money_remaining)
+
+    def test_portfolio_not_modified(self):
+        original = self.portfolio.clone()
+        get_allocation_buys(self.portfolio, self.target_allocation, self.available_stocks,
+                            Money(500), self.pricer)
+        self.assertEqual(original, self.portfolio)
+
+    def test_asset_class_deficits(self):
+        deficits = get_asset_class_deficits(self.portfolio, self.target_allocation, Money(50))
+        self.assertEqual({'bond': Decimal('15.5'), 'emerging': Decimal('34.5')}, deficits)
+
+    def test_asset_class_deficits_of_some_classes(self):
+        # The money beyond the deficits of bond and world is split evenly
+        deficits = get_asset_class_deficits(self.portfolio, self.target_allocation, Money(5000),
+                                            ['bond', 'world'])
+        self.assertEqual({'bond': Decimal('1280'), 'world': Decimal('3720')}, deficits)
+
+    def test_refinement_bounded_without_stocks_of_a_class(self):
+        refinement_buys = []
+        original_buy_greedily = invest._buy_greedily
+
+        def buy_greedily(*args):
+            result = original_buy_greedily(*args)
+            refinement_buys.extend(result[0])
+            return result
+        with patch('invest._buy_greedily', buy_greedily):
+            get_allocation_buys(self.portfolio, self.target_allocation, [stock2, stock3],
+                                Money(5000), self.pricer)
+        self.assertLessEqual(len(refinement_buys), 4)
+
+    def test_asset_class_deficits_with_inexact_cuts(self):
+        # The cut of 3 deficits is not exact in Decimal
+        stocks = [Stock('S0', 'c0'), Stock('S4', 'c3'), Stock('S6', 'c1'), Stock('S7', 'c2')]
+        self.pricer.price_dict.update(zip(stocks, [Money(17), Money(5), Money('25.86'),
+                                                   Money(30)]))
+        portfolio = Portfolio()
+        for stock, amount in zip(stocks, [6, 15, 4, 15]):
+            portfolio.add_stock(stock, amount)
+        target_allocation = Allocation({'c3': 27, 'c2': 57, 'c1': 14, 'c0': 2})
+        deficits = get_asset_class_deficits(portfolio, target_allocation, Money(934))
+        self.assertEqual(['c1', 'c2', 'c3'], sorted(deficits))
+        self.assertEqual(Money(934), Money(sum(deficits.values())))
+        money_remaining = get_allocation_buys(portfolio, target_allocation, stocks, Money(934),
+                                              self.pricer)[2]
+        self.assertEqual(Money('0.56'), money_remaining)
+
+
+class GetLotBuysTest(TestCaseWithPortfolio):
+    def test_matches_greedy(self):
+        for money in [Money(50), Money(5000)]:
+            expected = get_next_buys(self.portfolio, self.target_allocation,
+                                     self.available_stocks, money, self.pricer)
+            buys, new_portfolio, money_remaining = get_lot_buys(
+                self.portfolio, self.target_allocation, self.available_stocks, money, self.pricer)
+            self.assertItemsEqual(expected[0], buys)
+            self.assertEqual(expected[1], new_portfolio)
+            self.assertEqual(expected[2], money_remaining)
+
+    def test_not_worse_than_greedy(self):
+        # Lots of S0 alone used to be bought although they made the
+        # allocation worse
+        stocks = [Stock('S0', 'c0'), Stock('S1', 'c1'), Stock('S2', 'c0')]
+        self.pricer.price_dict.update(zip(stocks, [Money('144.33'), Money('20.94'),
+                                                   Money('102.28')]))
+        portfolio = Portfolio()
+        portfolio.add_stock(stocks[2], 1)
+        target_allocation = Allocation({'c1': 40, 'c0': 60})
+        money = Money(37788)
+
+        def error(new_portfolio, money_remaining):
+            return (AssetClassBalance(new_portfolio, target_allocation).deviation() +
+                    float(money_remaining) / float(money))
+        greedy = get_next_buys(portfolio, target_allocation, stocks, money, self.pricer)
+        buys, new_portfolio, money_remaining = get_lot_buys(portfolio, target_allocation, stocks,
+                                                            money, self.pricer)
+        self.assertLessEqual(error(new_portfolio, money_remaining), error(greedy[1], greedy[2]))
+        self.assertEqual(money - sum(amount * self.pricer.get_price(stock)
+                                     for stock, amount in buys), money_remaining)
+
+    def test_number_of_steps_is_logarithmic(self):
+        add = AssetClassBalance.add
+        with patch.object(AssetClassBalance, 'add', autospec=True, side_effect=add) as mock_add:
+            buys, new_portfolio, money_remaining = get_lot_buys(
+                self.portfolio, self.target_allocation, self.available_stocks, Money(50000),
+                self.pricer)
+        self.assertLess(mock_add.call_count, 100)
+        self.assertLess(money_remaining, Money(3))
+
+    def test_number_of_steps_is_logarithmic_without_stocks_of_a_class(self):
+        add = AssetClassBalance.add
+        with patch.object(AssetClassBalance, 'add', autospec=True, side_effect=add) as mock_add:
+            buys, new_portfolio, money_remaining = get_lot_buys(
+                self.portfolio, self.target_allocation, [stock2, stock3], Money(50000),
+                self.pricer)
+        self.assertLess(mock_add.call_count, 100)
+        self.assertLess(money_remaining, Money(3))
+
+    def test_number_of_steps_is_logarithmic_when_buys_raise_the_error(self):
+        # Only world can be bought, and it is already above its target
+        add = AssetClassBalance.add
+        with patch.object(AssetClassBalance, 'add', autospec=True, side_effect=add) as mock_add:
+            buys, new_portfolio, money_remaining = get_lot_buys(
+                self.portfolio, self.target_allocation, [stock3], Money(50000), self.pricer)
+        self.assertLess(mock_add.call_count, 100)
+        self.assertEqual([Buy(stock3, 16666)], buys)
+        self.assertEqual(Money(2), money_remaining)
+
+
+class GetVectorizedBuysTest(TestCaseWithPortfolio):
+    def test_matches_greedy(self):
+        for money in [Money(3), Money(50), Money(500)]:
+            expected = get_next_buys(self.portfolio, self.target_allocation,
+                                     self.available_stocks, money, self.pricer)
+            buys, new_portfolio, money_remaining = get_vectorized_buys(
+                self.portfolio, self.target_allocation, self.available_stocks, money, self.pricer)
+            self.assertItemsEqual(expected[0], buys)
+            self.assertEqual(expected[1], new_portfolio)
+            self.assertEqual(expected[2], money_remaining)
+
+    def test_nothing_affordable(self):
+        buys, new_portfolio, money_remaining = get_vectorized_buys(
+            self.portfolio, self.target_allocation, self.available_stocks, Money(2), self.pricer)
+        self.assertEqual([], buys)
+        self.assertEqual(self.portfolio, new_portfolio)
+        self.assertEqual(Money(2), money_remaining)
+
+    @patch('invest.numpy', None)
+    def test_requires_numpy(self):
+        self.assertRaises(RuntimeError, get_vectorized_buys, self.portfolio,
+                          self.target_allocation, self.available_stocks, Money(50), self.pricer)
+
+
+class GetOptimalBuysTest(TestCaseWithPortfolio):
+    def calculate_error(self, portfolio, money_remaining, money):
+        error = 0.0
+        for asset_class in set(portfolio.asset_classes) | set(self.target_allocation.asset_classes):
+            error += (portfolio.get_asset_class_percent(asset_class) -
+                      self.target_allocation[asset_class])**2
+        return error + float(money_remaining) / float(money)
+
+    def test_finds_best_combination(self):
+        money = Money(30)
+        buys, new_portfolio, money_remaining = get_optimal_buys(
+            self.portfolio, self.target_allocation, self.available_stocks, money, self.pricer)
+        errors = []
+        for amount2, amount3, amount4 in product(range(4), range(11), range(5)):
+            cost = amount2 * Money(10) + amount3 * Money(3) + amount4 * Money(7)
+            if cost > money:
+                continue
+            portfolio = self.portfolio.clone()
+            portfolio.add_stock(stock2, amount2)
+            portfolio.add_stock(stock3, amount3)
+            portfolio.add_stock(stock4, amount4)
+            errors.append(self.calculate_error(portfolio, money - cost, money))
+        self.assertAlmostEqual(min(errors), self.calculate_error(new_portfolio, money_remaining, money))
+        self.assertEqual(money - sum(amount * self.pricer.get_price(stock) for stock, amount in buys),
+                         money_remaining)
+
+    def test_not_worse_than_greedy(self):
+        for money in [Money(50), Money(500)]:
+            greedy = get_next_buys(self.portfolio, self.target_allocation, self.available_stocks,
+                                   money, self.pricer)
+            optimal = get_optimal_buys(self.portfolio, self.target_allocation,
+                                       self.available_stocks, money, self.pricer)
+            self.assertLessEqual(self.calculate_error(optimal[1], optimal[2], money),
+                                 self.calculate_error(greedy[1], greedy[2], money))
+
+    def test_node_budget_returns_incumbent_buys(self):
+        expected = get_allocation_buys(self.portfolio, self.target_allocation,
+                                       self.available_stocks, Money(500), self.pricer)
+        buys, new_portfolio, money_remaining = get_optimal_buys(
+            self.portfolio, self.target_allocation, self.available_stocks, Money(500), self.pricer,
+            max_nodes=0)
+        self.assertItemsEqual(expected[0], buys)
+        self.assertEqual(expected[2], money_remaining)
+
+    def test_node_budget_not_worse_than_greedy(self):
+        # Here the allocation buys are worse than the greedy ones
+        stocks = [Stock('S0', 'c2'), Stock('S1', 'c2'), Stock('S2', 'c0'), Stock('S3', 'c1')]
+        self.pricer.price_dict.update(zip(stocks, [Money('29.20'), Money('17.36'),
+                                                   Money('28.41'), Money('34.57')]))
+        portfolio = Portfolio()
+        for stock, amount in zip(stocks, [50, 23, 49, 11]):
+            portfolio.add_stock(stock, amount)
+        self.target_allocation = Allocation({'c3': 19, 'c2': 33, 'c1': 4, 'c0': 44})
+        money = Money(2100)
+        greedy = get_next_buys(portfolio, self.target_allocation, stocks, money, self.pricer)
+        allocation = get_allocation_buys(portfolio, self.target_allocation, stocks, money,
+                                         self.pricer)
+        self.assertGreater(self.calculate_error(allocation[1], allocation[2], money),
+                           self.calculate_error(greedy[1], greedy[2], money))
+        # Nodes for the greedy steps but none for the search
+        max_nodes = sum(amount for _, amount in greedy[0])
+        buys, new_portfolio, money_remaining = get_optimal_buys(
+            portfolio, self.target_allocation, stocks, money, self.pricer, max_nodes=max_nodes)
+        self.assertItemsEqual(greedy[0], buys)
+        self.assertEqual(greedy[2], money_remaining)
+
+    def test_time_limit_covers_seeding(self):
+        expected = get_allocation_buys(self.portfolio, self.target_allocation,
+                                       self.available_stocks, Money(500), self.pricer)
+        buys, new_portfolio, money_remaining = get_optimal_buys(
+            self.portfolio, self.target_allocation, self.available_stocks, Money(500), self.pricer,
+            time_limit=0)
+        self.assertItemsEqual(expected[0], buys)
+        self.assertEqual(expected[2], money_remaining)
+
+
+class SweepBuysTest(TestCaseWithPortfolio):
+    def test_matches_separate_runs(self):
+        budgets = [Money(2), Money(10), Money(25), Money(50), Money(120)]
+        results = sweep_buys(self.portfolio, self.target_allocation, self.available_stocks,
+                             budgets, self.pricer)
+        self.assertItemsEqual(budgets, results.keys())
+        for money in budgets:
+            expected = get_next_buys(self.portfolio, self.target_allocation,
+                                     self.available_stocks, money, self.pricer)
+            buys, new_portfolio, money_remaining = results[money]
+            self.assertItemsEqual(expected[0], buys)
+            self.assertEqual(expected[1], new_portfolio)
+            self.assertEqual(expected[2], money_remaining)
+
+    def test_budget_range(self):
+        self.assertEqual([Money(1000), Money(2000), Money(3000)],
+                         budget_range(Money(1000), Money(3000), Money(1000)))
+
+
+class RepairBuysTest(TestCaseWithPortfolio):
+    def test_unchanged_prices_keep_greedy_buys(self):
+        buys, new_portfolio, money_remaining = get_next_buys(
+            self.portfolio, self.target_allocation, self.available_stocks, Money(50), self.pricer)
+        repaired = repair_buys(self.portfolio, self.target_allocation, self.available_stocks,
+                               Money(50), self.pricer, buys)
+        self.assertItemsEqual(buys, repaired[0])
+        self.assertEqual(new_portfolio, repaired[1])
+        self.assertEqual(money_remaining, repaired[2])
+        self.assertEqual(0, repaired[3].moves)
+
+    def test_price_rise_makes_buys_affordable(self):
+        buys = get_next_buys(self.portfolio, self.target_allocation, self.available_stocks,
+                             Money(50), self.pricer)[0]
+        self.pricer.price_dict[stock4] = Money(9)
+        self.portfolio.reprice()
+        repaired_buys, new_portfolio, money_remaining, stats = repair_buys(
+            self.portfolio, self.target_allocation, self.available_stocks, Money(50),
+            self.pricer, buys)
+        self.assertTrue(money_remaining >= 0)
+        self.assertEqual(self.portfolio.value + Money(50) - money_remaining, new_portfolio.value)
+        self.assertTrue(stats.moves > 0)
+        self.assertTrue(stats.evaluations > 0)
+
+    def test_not_worse_than_previous_buys(self):
+        buys = get_next_buys(self.portfolio, self.target_allocation, self.available_stocks,
+                             Money(50), self.pricer)[0]
+        self.pricer.price_dict[stock2] = Money(6)
+        self.pricer.price_dict[stock4] = Money(5)
+        self.portfolio.reprice()
+
+        def error(new_portfolio, money_remaining):
+            return (AssetClassBalance(new_portfolio, self.target_allocation).deviation() +
+                    float(money_remaining) / 50)
+        old_portfolio = self.portfolio.clone()
+        for stock, amount in buys:
+            old_portfolio.add_stock(stock, amount)
+        repaired_buys, new_portfolio, money_remaining, _ = repair_buys(
+            self.portfolio, self.target_allocation, self.available_stocks, Money(50),
+            self.pricer, buys)
+        self.assertTrue(error(new_portfolio, money_remaining) <=
+                        error(old_portfolio, Money(50) - (old_portfolio.value -
+                                                          self.portfolio.value)))
+
+    def test_unavailable_stocks_are_dropped(self):
+        repaired_buys = repair_buys(self.portfolio, self.target_allocation, [stock3],
+                                    Money(50), self.pricer, [Buy(stock4, 3)])[0]
+        self.assertEqual([stock3], [stock for stock, _ in repaired_buys])
+
+    def test_portfolio_not_modified(self):
+        original = self.portfolio.clone()
+        repair_buys(self.portfolio, self.target_allocation, self.available_stocks, Money(50),
+                    self.pricer, [Buy(stock2, 3)])
+        self.assertEqual(original, self.portfolio)
+
+
+class GetRebalanceTradesTest(TestCaseWithPortfolio):
+    def test_sells_and_buys(self):
+        trades, new_portfolio, money_remaining = get_rebalance_trades(
+            self.portfolio, self.target_allocation, self.available_stocks, Money(0), self.pricer)
+        self.assertEqual([Buy(stock3, -16), Buy(stock4, 5), Buy(stock2, 1)], trades)
+        self.assertEqual(Money(3), money_remaining)
+        self.assertEqual(self.portfolio.value - money_remaining, new_portfolio.value)
+
+    def test_unavailable_stocks_sold_first(self):
+        target_allocation = Allocation({'bond': 5, 'world': 85, 'emerging': 10})
+        trades = get_rebalance_trades(self.portfolio, target_allocation, self.available_stocks,
+                                      Money(0), self.pricer)[0]
+        self.assertIn(Buy(stock1, -10), trades)
+        self.assertNotIn(stock2, [stock for stock, _ in trades])
+
+    def test_costs_paid_from_money(self):
+        _, new_portfolio, money_remaining = get_rebalance_trades(
+            self.portfolio, self.target_allocation, self.available_stocks, Money(100),
+            self.pricer, cost_percent=1)
+        self.assertTrue(Money(0) <= money_remaining)
+        self.assertTrue(new_portfolio.value < self.portfolio.value + Money(100) - money_remaining)
+
+    def test_costs_above_drift_prevent_trades(self):
+        self.assertEqual(([], self.portfolio, Money(0)), get_rebalance_trades(
+            self.portfolio, self.target_allocation, self.available_stocks, Money(0),
+            self.pricer, cost_percent=50))
+
+    def test_portfolio_not_modified(self):
+        original = self.portfolio.clone()
+        get_rebalance_trades(self.portfolio, self.target_allocation, self.available_stocks,
+                             Money(0), self.pricer)
+        self.assertEqual(original, self.portfolio)
+
+
 class ReadInvestFileTest(unittest.TestCase):
     def setUp(self):
         invest_file = StringIO('''[portfolio]
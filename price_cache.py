@@ -0,0 +1,54 @@
+import sqlite3
+import threading
+import time
+from decimal import Decimal
+
+
+class PriceCache(object):
+    def __init__(self, path, ttl=3600, max_entries=10000, clock=time.time):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('CREATE TABLE IF NOT EXISTS prices '
+                                 '(key TEXT PRIMARY KEY, name TEXT, price TEXT, fetched REAL)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS prices_fetched ON prices (fetched)')
+        self._connection.commit()
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        oldest = self._clock() - self.ttl
+        quotes = {}
+        with self._lock:
+            for key in keys:
+                row = self._connection.execute(
+                    'SELECT name, price FROM prices WHERE key = ? AND fetched >= ?',
+                    (key, oldest)).fetchone()
+                if row is not None:
+                    quotes[key] = (row[0], Decimal(row[1]))
+        return quotes
+
+    def put(self, key, name, price):
+        self.put_many([(key, name, price)])
+
+    def put_many(self, quotes):
+        now = self._clock()
+        rows = [(key, name.decode('utf-8') if isinstance(name, str) else name, str(price), now)
+                for key, name, price in quotes]
+        with self._lock:
+            self._connection.executemany('INSERT OR REPLACE INTO prices VALUES (?, ?, ?, ?)', rows)
+            self._evict(now)
+            self._connection.commit()
+
+    def _evict(self, now):
+        self._connection.execute('DELETE FROM prices WHERE fetched < ?', (now - self.ttl,))
+        self._connection.execute('DELETE FROM prices WHERE key IN '
+                                 '(SELECT key FROM prices ORDER BY fetched DESC LIMIT -1 OFFSET ?)',
+                                 (self.max_entries,))
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM prices').fetchone()[0]
@@ -0,0 +1,56 @@
+# coding=utf-8
+import os
+import shutil
+import tempfile
+import unittest
+from decimal import Decimal
+
+from price_cache import PriceCache
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class PriceCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = PriceCache(':memory:', ttl=60, max_entries=3, clock=self.clock)
+
+    def test_get_missing(self):
+        self.assertEqual(None, self.cache.get('SYM1'))
+
+    def test_put_and_get(self):
+        self.cache.put('SYM1', 'Stock 1', Decimal('27.64'))
+        self.assertEqual((u'Stock 1', Decimal('27.64')), self.cache.get('SYM1'))
+
+    def test_unicode_names(self):
+        self.cache.put(u'seligson:Pohjois-Amer.', 'Yhteensä', Decimal('1.5'))
+        self.assertEqual(('Yhteensä'.decode('utf-8'), Decimal('1.5')),
+                         self.cache.get(u'seligson:Pohjois-Amer.'))
+
+    def test_expired_entries_are_not_returned(self):
+        self.cache.put('SYM1', 'Stock 1', Decimal('1'))
+        self.clock.now += 61
+        self.assertEqual(None, self.cache.get('SYM1'))
+
+    def test_oldest_entries_are_evicted(self):
+        for i in range(5):
+            self.clock.now += 1
+            self.cache.put('SYM%d' % i, 'Stock', Decimal(i))
+        self.assertEqual(3, len(self.cache))
+        self.assertEqual(['SYM2', 'SYM3', 'SYM4'], sorted(self.cache.get_many(
+            ['SYM%d' % i for i in range(5)])))
+
+    def test_persists_between_instances(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'prices.db')
+            PriceCache(path, clock=self.clock).put('SYM1', 'Stock 1', Decimal('2'))
+            self.assertEqual((u'Stock 1', Decimal('2')), PriceCache(path, clock=self.clock).get('SYM1'))
+        finally:
+            shutil.rmtree(directory)
@@ -0,0 +1,98 @@
+import json
+import sys
+import threading
+import time
+from collections import defaultdict
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class NullProfiler(object):
+    # The default profiler records nothing, so instrumented code only pays
+    # for a method call
+    _span = _NullSpan()
+
+    def span(self, name):
+        return self._span
+
+    def count(self, name, amount=1):
+        pass
+
+
+class _Span(object):
+    def __init__(self, profiler, name):
+        self._profiler = profiler
+        self._name = name
+
+    def __enter__(self):
+        self._start = self._profiler.clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._profiler.add_span(self._name, self._profiler.clock() - self._start)
+        return False
+
+
+class Profiler(object):
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.spans = defaultdict(lambda: [0, 0.0])
+        self.counters = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def span(self, name):
+        return _Span(self, name)
+
+    def add_span(self, name, seconds):
+        with self._lock:
+            span = self.spans[name]
+            span[0] += 1
+            span[1] += seconds
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def report(self):
+        return {'spans': dict((name, {'calls': calls, 'seconds': seconds})
+                              for name, (calls, seconds) in self.spans.items()),
+                'counters': dict(self.counters)}
+
+    def write_report(self, output):
+        json.dump(self.report(), output, indent=2, sort_keys=True)
+        output.write('\n')
+
+
+_profiler = NullProfiler()
+
+
+def set_profiler(profiler):
+    global _profiler
+    _profiler = profiler
+
+
+def get_profiler():
+    return _profiler
+
+
+def span(name):
+    return _profiler.span(name)
+
+
+def count(name, amount=1):
+    _profiler.count(name, amount)
+
+
+def write_profile(profiler, path):
+    # '-' writes to stderr
+    if path == '-':
+        profiler.write_report(sys.stderr)
+    else:
+        with open(path, 'w') as output:
+            profiler.write_report(output)
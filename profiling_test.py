@@ -0,0 +1,69 @@
+import json
+import unittest
+from StringIO import StringIO
+
+from mock import Mock
+
+import invest
+from profiling import *
+from stock_pricer import StockPricer, TableStockPricer
+from util import Money, Stock
+
+
+class NullProfilerTest(unittest.TestCase):
+    def test_records_nothing(self):
+        profiler = NullProfiler()
+        with profiler.span('solve'):
+            profiler.count('price_lookups')
+
+
+class ProfilerTest(unittest.TestCase):
+    def test_spans(self):
+        profiler = Profiler(clock=Mock(side_effect=[1.0, 1.5, 2.0, 4.0]))
+        with profiler.span('solve'):
+            pass
+        with profiler.span('solve'):
+            pass
+        self.assertEqual({'solve': {'calls': 2, 'seconds': 2.5}}, profiler.report()['spans'])
+
+    def test_span_recorded_on_exception(self):
+        profiler = Profiler(clock=Mock(side_effect=[1.0, 2.0]))
+        def fail():
+            with profiler.span('download'):
+                raise IOError()
+        self.assertRaises(IOError, fail)
+        self.assertEqual({'download': {'calls': 1, 'seconds': 1.0}}, profiler.report()['spans'])
+
+    def test_counters(self):
+        profiler = Profiler()
+        profiler.count('price_lookups')
+        profiler.count('price_lookups', 2)
+        self.assertEqual({'price_lookups': 3}, profiler.report()['counters'])
+
+    def test_write_report(self):
+        profiler = Profiler()
+        profiler.count('portfolio_clone')
+        output = StringIO()
+        profiler.write_report(output)
+        self.assertEqual({'spans': {}, 'counters': {'portfolio_clone': 1}},
+                         json.loads(output.getvalue()))
+
+
+class InstrumentationTest(unittest.TestCase):
+    def setUp(self):
+        self.profiler = Profiler()
+        set_profiler(self.profiler)
+
+    def tearDown(self):
+        set_profiler(NullProfiler())
+
+    def test_get_next_buys(self):
+        stock = Stock('SYM1', 'stock')
+        pricer = TableStockPricer({'SYM1': ('Stock 1', Money(10))})
+        StockPricer.set_pricer(pricer)
+        target_allocation = invest.Allocation({'stock': 100})
+        invest.get_next_buys(invest.Portfolio(), target_allocation, [stock], Money(30), pricer)
+        counters = self.profiler.report()['counters']
+        self.assertEqual(1, counters['portfolio_clone'])
+        self.assertEqual(3, counters['solver_iterations'])
+        self.assertTrue(counters['price_lookups'] > 0)
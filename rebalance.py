@@ -0,0 +1,87 @@
+# Trades x_i of positions with values v_i toward target fractions t_i of the
+# total value V after investing money minimize
+#
+#     sum(cost_i(x_i)) + penalty / (2 V) * sum((v_i + x_i - t_i V)^2)
+#
+# subject to sum(x_i) = money and lower_i <= x_i <= upper_i, where buying
+# costs buy_cost_i and selling sell_cost_i per unit of money traded. The
+# problem is separable and convex, so for a multiplier m of the money
+# constraint each trade is a soft threshold of its drift, nondecreasing and
+# piecewise linear in m. The trades sum to money at an m found exactly by
+# binary search over the breakpoints and interpolation between them. A
+# position is only traded while it drifts from its target by more than
+# cost / penalty of the total value.
+
+INFINITY = float('inf')
+
+
+def _trade(multiplier, weight, drift, buy_cost, sell_cost, lower, upper):
+    buy = (multiplier - buy_cost) / weight - drift
+    if buy > 0:
+        return min(buy, upper)
+    sell = (multiplier + sell_cost) / weight - drift
+    if sell < 0:
+        return max(sell, lower)
+    return 0.0
+
+
+def solve_trades(values, targets, money, buy_costs, sell_costs, lower=None, upper=None,
+                 penalty=1.0):
+    # Returns the trades in money, positive for buys. Without bounds a
+    # position can be sold down to zero and bought without limit. When the
+    # upper bounds keep all of the money from being spent the trades are at
+    # their upper bounds.
+    n = len(values)
+    total = sum(values) + money
+    if total <= 0:
+        raise ValueError('Nothing to rebalance: total value %s' % total)
+    if lower is None:
+        lower = [-value for value in values]
+    if upper is None:
+        upper = [INFINITY] * n
+    if money < sum(lower):
+        raise ValueError('Cannot withdraw %s from a portfolio worth %s' % (-money, sum(values)))
+    weight = penalty / total
+    drifts = [value - target * total for value, target in zip(values, targets)]
+    positions = zip(drifts, buy_costs, sell_costs, lower, upper)
+
+    def trades(multiplier):
+        return [_trade(multiplier, weight, *position) for position in positions]
+
+    breakpoints = set()
+    for drift, buy_cost, sell_cost, low, high in positions:
+        breakpoints.add(weight * drift + buy_cost)
+        breakpoints.add(weight * drift - sell_cost)
+        if 0 < high < INFINITY:
+            breakpoints.add(weight * (high + drift) + buy_cost)
+        if low < 0:
+            breakpoints.add(weight * (low + drift) - sell_cost)
+    breakpoints = sorted(breakpoints)
+    sums = {}
+
+    def traded(i):
+        if i not in sums:
+            sums[i] = sum(trades(breakpoints[i]))
+        return sums[i]
+
+    if money <= traded(0):
+        return trades(breakpoints[0])
+    last = len(breakpoints) - 1
+    if money >= traded(last):
+        # Only the positions without an upper bound still buy
+        unbounded = sum(1 for _, _, _, _, high in positions if high == INFINITY)
+        if not unbounded:
+            return trades(breakpoints[last])
+        return trades(breakpoints[last] + (money - traded(last)) * weight / unbounded)
+    # The last breakpoint whose trades sum to at most money
+    low, high = 0, last
+    while high - low > 1:
+        middle = (low + high) // 2
+        if traded(middle) <= money:
+            low = middle
+        else:
+            high = middle
+    start, end = breakpoints[low], breakpoints[high]
+    if traded(high) == traded(low):
+        return trades(start)
+    return trades(start + (money - traded(low)) * (end - start) / (traded(high) - traded(low)))
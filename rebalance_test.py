@@ -0,0 +1,66 @@
+import unittest
+
+from rebalance import *
+
+
+def objective(values, targets, money, buy_costs, sell_costs, trades, penalty=1.0):
+    total = sum(values) + money
+    cost = sum(buy_cost * trade if trade > 0 else -sell_cost * trade
+               for trade, buy_cost, sell_cost in zip(trades, buy_costs, sell_costs))
+    return cost + penalty / (2 * total) * sum((value + trade - target * total) ** 2
+                                              for value, trade, target
+                                              in zip(values, trades, targets))
+
+
+class SolveTradesTest(unittest.TestCase):
+    def test_without_costs_reaches_targets(self):
+        trades = solve_trades([60, 30, 10], [0.2, 0.3, 0.5], 100, [0] * 3, [0] * 3)
+        for trade, expected in zip(trades, [-20, 30, 90]):
+            self.assertAlmostEqual(expected, trade)
+
+    def test_spends_money(self):
+        values = [500, 20, 300, 0, 80]
+        targets = [0.1, 0.3, 0.2, 0.25, 0.15]
+        costs = [0.01, 0, 0.005, 0.02, 0.01]
+        trades = solve_trades(values, targets, 250, costs, costs)
+        self.assertAlmostEqual(250, sum(trades))
+        for i, trade in enumerate(trades):
+            self.assertTrue(trade >= -values[i])
+
+    def test_optimal(self):
+        # No transfer of money from one trade to another improves on the trades
+        values = [500, 20, 300, 0, 80]
+        targets = [0.1, 0.3, 0.2, 0.25, 0.15]
+        costs = [0.01, 0, 0.005, 0.02, 0.01]
+        trades = solve_trades(values, targets, 250, costs, costs)
+        best = objective(values, targets, 250, costs, costs, trades)
+        for i in range(5):
+            for j in range(5):
+                moved = list(trades)
+                moved[i] += 0.01
+                moved[j] -= 0.01
+                if i != j and moved[j] >= -values[j]:
+                    self.assertTrue(best <= objective(values, targets, 250, costs, costs,
+                                                      moved) + 1e-9)
+
+    def test_costs_above_drift_prevent_trades(self):
+        self.assertEqual([0.0, 0.0], solve_trades([55, 45], [0.5, 0.5], 0, [0.1] * 2, [0.1] * 2))
+
+    def test_bounds(self):
+        trades = solve_trades([50, 50], [0.9, 0.1], 0, [0, 0], [0, 0], [-10, -10], [5, 100])
+        self.assertAlmostEqual(5, trades[0])
+        self.assertAlmostEqual(-5, trades[1])
+
+    def test_money_beyond_upper_bounds(self):
+        self.assertEqual([10, 0], solve_trades([50, 50], [0.5, 0.5], 100, [0, 0], [0, 0],
+                                               upper=[10, 0]))
+
+    def test_withdrawal_beyond_holdings(self):
+        self.assertRaises(ValueError, solve_trades, [10, 10], [0.5, 0.5], -30, [0, 0], [0, 0])
+
+    def test_empty_portfolio(self):
+        self.assertRaises(ValueError, solve_trades, [0, 0], [0.5, 0.5], 0, [0, 0], [0, 0])
+
+
+if __name__ == '__main__':
+    unittest.main()
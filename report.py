@@ -0,0 +1,180 @@
+import csv
+import datetime
+import json
+from collections import defaultdict, namedtuple
+from decimal import Decimal
+
+from util import Money
+
+
+# Valuation snapshots of portfolios that every output format renders, so
+# that each price and name is looked up once per report however it is shown
+Holding = namedtuple('Holding', 'symbol name asset_class amount price value')
+AssetClassShare = namedtuple('AssetClassShare', 'asset_class value percent target deviation')
+Valuation = namedtuple('Valuation', 'holdings value asset_classes')
+BuyLine = namedtuple('BuyLine', 'symbol name asset_class amount price total percent')
+InvestReport = namedtuple('InvestReport', 'client date money spent remaining current buys new')
+
+FundHolding = namedtuple('FundHolding', 'name shares price value percent target deviation')
+FundValuation = namedtuple('FundValuation', 'funds value')
+InvestmentLine = namedtuple('InvestmentLine', 'name amount fee real_investment')
+SeligsonReport = namedtuple('SeligsonReport', 'client date amount current investments new')
+
+
+class Quotes(object):
+    # A pricer remembering the name and price of each stock it is asked for
+    def __init__(self, pricer):
+        self._pricer = pricer
+        self._names = {}
+        self._prices = {}
+
+    def get_price(self, stock):
+        try:
+            return self._prices[stock]
+        except KeyError:
+            price = self._prices[stock] = self._pricer.get_price(stock)
+            return price
+
+    def get_name(self, stock):
+        try:
+            return self._names[stock]
+        except KeyError:
+            name = self._names[stock] = self._pricer.get_name(stock)
+            return name
+
+
+def value_portfolio(portfolio, pricer, target_allocation=None):
+    # The asset classes are those held, as Portfolio.asset_classes gives them
+    holdings = []
+    class_values = defaultdict(int)
+    for stock, amount in portfolio:
+        price = pricer.get_price(stock)
+        value = price * amount
+        holdings.append(Holding(stock.symbol, pricer.get_name(stock), stock.asset_class, amount,
+                                price, value))
+        class_values[stock.asset_class] += value
+    class_values = dict((asset_class, Money(value)) for asset_class, value in class_values.items())
+    total = sum(class_values.values(), Money(0))
+    asset_classes = []
+    if target_allocation is not None:
+        for asset_class in set(holding.asset_class for holding in holdings):
+            percent = 100.0 * float(class_values[asset_class]) / float(total)
+            target = target_allocation[asset_class]
+            asset_classes.append(AssetClassShare(asset_class, class_values[asset_class], percent,
+                                                 target, percent - target))
+    return Valuation(holdings, total, asset_classes)
+
+
+def make_invest_report(client, portfolio, target_allocation, money, buys, new_portfolio,
+                       money_remaining, pricer, date=None):
+    # Sells are buys of negative amounts. The percent of each line is of the
+    # money bought, or of the money sold for sells.
+    quotes = Quotes(pricer)
+    spent = money - money_remaining
+    totals = [(stock, amount, quotes.get_price(stock), amount * quotes.get_price(stock))
+              for stock, amount in buys]
+    bought = float(sum(total for _, _, _, total in totals if total > 0))
+    sold = float(sum(-total for _, _, _, total in totals if total < 0))
+    buy_lines = []
+    for stock, amount, price, total in totals:
+        side = bought if total > 0 else sold
+        buy_lines.append(BuyLine(stock.symbol, quotes.get_name(stock), stock.asset_class, amount,
+                                 price, total, 100.0 * abs(float(total)) / side if side else 0.0))
+    return InvestReport(client, date or datetime.date.today(), money, spent, money_remaining,
+                        value_portfolio(portfolio, quotes, target_allocation), buy_lines,
+                        value_portfolio(new_portfolio, quotes, target_allocation))
+
+
+def value_funds(portfolio, pricer):
+    # Percents are Decimals, as seligson.Printer has always calculated them
+    prices = [pricer.get_share_price(fund.name) for fund in portfolio.funds]
+    values = [Money(fund.shares * price) for fund, price in zip(portfolio.funds, prices)]
+    total = sum(values, Money(0))
+    funds = []
+    for fund, price, value in zip(portfolio.funds, prices, values):
+        percent = value / total * 100 if total > 0 else Decimal(0)
+        funds.append(FundHolding(fund.name, fund.shares, price, value, percent,
+                                 fund.target_allocation, percent - fund.target_allocation))
+    return FundValuation(funds, total)
+
+
+def make_seligson_report(client, current, amount, investments, new_portfolio, pricer,
+                         date=None):
+    # current is the valuation of the portfolio before the investments were
+    # calculated, since new_with_investments adds the new shares to its funds
+    investment_lines = []
+    for investment in investments:
+        investment_lines.append(InvestmentLine(investment.fund.name, investment.amount,
+                                               investment.fee, investment.real_investment))
+    return SeligsonReport(client, date or datetime.date.today(), amount, current,
+                          investment_lines, value_funds(new_portfolio, pricer))
+
+
+def _to_json(value):
+    if isinstance(value, tuple) and hasattr(value, '_fields'):
+        return dict((field, _to_json(item)) for field, item in zip(value._fields, value))
+    if isinstance(value, list):
+        return [_to_json(item) for item in value]
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return value
+
+
+def write_jsonl(reports, output):
+    # One report per line, written as each report is made. The keys are not
+    # sorted, since sorting keeps json from using its C encoder.
+    for report in reports:
+        output.write(json.dumps(_to_json(report)) + '\n')
+
+
+def _csv_text(value):
+    return value.encode('utf-8') if isinstance(value, unicode) else value
+
+
+INVEST_CSV_FIELDS = ['client', 'section', 'symbol', 'name', 'asset_class', 'amount', 'price',
+                     'value', 'percent', 'target']
+
+
+def write_invest_csv(reports, output):
+    # current, buy and new rows for stocks, current_class and new_class rows
+    # for asset classes and a remaining row for the money left over
+    writer = csv.writer(output)
+    writer.writerow(INVEST_CSV_FIELDS)
+    for report in reports:
+        client = _csv_text(report.client)
+        for section, valuation in [('current', report.current), ('new', report.new)]:
+            for holding in valuation.holdings:
+                writer.writerow([client, section, holding.symbol, _csv_text(holding.name),
+                                 holding.asset_class, holding.amount, holding.price,
+                                 holding.value, '', ''])
+            for share in valuation.asset_classes:
+                writer.writerow([client, section + '_class', '', '', share.asset_class, '', '',
+                                 share.value, '%.4f' % share.percent, share.target])
+            if section == 'current':
+                for buy in report.buys:
+                    writer.writerow([client, 'buy', buy.symbol, _csv_text(buy.name),
+                                     buy.asset_class, buy.amount, buy.price, buy.total, '%.4f' % buy.percent, ''])
+        writer.writerow([client, 'remaining', '', '', '', '', '', report.remaining, '', ''])
+
+
+SELIGSON_CSV_FIELDS = ['client', 'section', 'fund', 'shares', 'price', 'value', 'percent',
+                       'target', 'fee']
+
+
+def write_seligson_csv(reports, output):
+    # current and new rows for funds and investment rows with the amount
+    # invested as the value
+    writer = csv.writer(output)
+    writer.writerow(SELIGSON_CSV_FIELDS)
+    for report in reports:
+        client = _csv_text(report.client)
+        for section, valuation in [('current', report.current), ('new', report.new)]:
+            for fund in valuation.funds:
+                writer.writerow([client, section, _csv_text(fund.name), fund.shares, fund.price,
+                                 fund.value, '%.1f' % fund.percent, fund.target, ''])
+            if section == 'current':
+                for investment in report.investments:
+                    writer.writerow([client, 'investment', _csv_text(investment.name), '', '',
+                                     investment.amount, '', '', investment.fee])
@@ -0,0 +1,192 @@
+import csv
+import datetime
+import json
+import unittest
+from cStringIO import StringIO
+
+from mock import Mock
+
+import invest
+import seligson
+from stock_pricer import StockPricer, TableStockPricer
+from util import Buy, Money, Stock
+from report import *
+
+
+stock1 = Stock('SYM1', 'bond')
+stock2 = Stock('SYM2', 'world')
+QUOTES = {'SYM1': ('Stock 1', Money(4)), 'SYM2': ('Stock 2', Money(10))}
+DATE = datetime.date(2013, 10, 17)
+
+
+def make_client_invest_report():
+    pricer = TableStockPricer(QUOTES)
+    StockPricer.set_pricer(pricer)
+    portfolio = invest.Portfolio()
+    portfolio.add_stock(stock1, 5)
+    target_allocation = invest.Allocation({'bond': 50, 'world': 50})
+    buys, new_portfolio, money_remaining = invest.get_next_buys(
+        portfolio, target_allocation, [stock1, stock2], Money(25), pricer)
+    return make_invest_report('client.ini', portfolio, target_allocation, Money(25), buys,
+                              new_portfolio, money_remaining, pricer, DATE)
+
+
+def make_family_seligson_report():
+    pricer = Mock()
+    pricer.get_share_price.side_effect = {'Eurooppa': seligson.SharePrice(2),
+                                          'Aasia': seligson.SharePrice(1)}.get
+    portfolio = seligson.Portfolio()
+    portfolio.add_fund(seligson.Fund('Eurooppa', 10, 50, 1))
+    portfolio.add_fund(seligson.Fund('Aasia', 10, 50))
+    current = value_funds(portfolio, pricer)
+    investments, new_portfolio = seligson.calculate_investments(portfolio, Money(30), pricer)
+    return make_seligson_report('family.ini', current, Money(30), investments, new_portfolio,
+                                pricer, DATE), pricer
+
+
+class QuotesTest(unittest.TestCase):
+    def test_looks_up_once(self):
+        pricer = Mock()
+        pricer.get_price.return_value = Money(4)
+        pricer.get_name.return_value = 'Stock 1'
+        quotes = Quotes(pricer)
+        for _ in range(3):
+            self.assertEqual(Money(4), quotes.get_price(stock1))
+            self.assertEqual('Stock 1', quotes.get_name(stock1))
+        pricer.get_price.assert_called_once_with(stock1)
+        pricer.get_name.assert_called_once_with(stock1)
+
+
+class ValuePortfolioTest(unittest.TestCase):
+    def test_matches_portfolio(self):
+        StockPricer.set_pricer(TableStockPricer(QUOTES))
+        portfolio = invest.Portfolio()
+        portfolio.add_stock(stock1, 5)
+        portfolio.add_stock(stock2, 2)
+        target_allocation = invest.Allocation({'bond': 40, 'world': 60})
+        valuation = value_portfolio(portfolio, StockPricer.get_pricer(), target_allocation)
+        self.assertEqual([Holding('SYM1', 'Stock 1', 'bond', 5, Money(4), Money(20)),
+                          Holding('SYM2', 'Stock 2', 'world', 2, Money(10), Money(20))],
+                         valuation.holdings)
+        self.assertEqual(portfolio.value, valuation.value)
+        self.assertItemsEqual([AssetClassShare('bond', Money(20), 50.0, 40, 10.0),
+                               AssetClassShare('world', Money(20), 50.0, 60, -10.0)],
+                              valuation.asset_classes)
+
+    def test_without_target_allocation(self):
+        portfolio = invest.Portfolio()
+        portfolio.add_stock(stock1, 1)
+        self.assertEqual([], value_portfolio(portfolio, TableStockPricer(QUOTES)).asset_classes)
+
+
+class InvestReportTest(unittest.TestCase):
+    def test_report(self):
+        invest_report = make_client_invest_report()
+        self.assertEqual(DATE, invest_report.date)
+        self.assertEqual(Money(24), invest_report.spent)
+        self.assertEqual(Money(1), invest_report.remaining)
+        self.assertItemsEqual([BuyLine('SYM1', 'Stock 1', 'bond', 1, Money(4), Money(4),
+                                       100.0 / 6),
+                               BuyLine('SYM2', 'Stock 2', 'world', 2, Money(10), Money(20),
+                                       500.0 / 6)],
+                              invest_report.buys)
+        self.assertEqual(Money(44), invest_report.new.value)
+
+    def test_sells(self):
+        StockPricer.set_pricer(TableStockPricer(QUOTES))
+        portfolio = invest.Portfolio()
+        portfolio.add_stock(stock1, 5)
+        new_portfolio = portfolio.clone()
+        new_portfolio.remove_stock(stock1, 5)
+        new_portfolio.add_stock(stock2, 2)
+        invest_report = make_invest_report(
+            None, portfolio, invest.Allocation({'bond': 50, 'world': 50}), Money(0),
+            [Buy(stock1, -5), Buy(stock2, 2)], new_portfolio, Money(0), TableStockPricer(QUOTES))
+        self.assertEqual([BuyLine('SYM1', 'Stock 1', 'bond', -5, Money(4), Money(-20), 100.0),
+                          BuyLine('SYM2', 'Stock 2', 'world', 2, Money(10), Money(20), 100.0)],
+                         invest_report.buys)
+        output = StringIO()
+        invest.write_text_reports([invest_report], output)
+        self.assertIn(' - Sell   5 x Stock 1', output.getvalue())
+
+    def test_one_lookup_per_stock(self):
+        pricer = TableStockPricer(QUOTES)
+        pricer.get_price = Mock(wraps=pricer.get_price)
+        portfolio = invest.Portfolio()
+        portfolio.add_stock(stock1, 5)
+        new_portfolio = portfolio.clone()
+        new_portfolio.add_stock(stock2, 1)
+        make_invest_report(None, portfolio, invest.Allocation({'bond': 50, 'world': 50}),
+                           Money(10), [Buy(stock2, 1)], new_portfolio, Money(0), pricer)
+        self.assertEqual(2, pricer.get_price.call_count)
+
+    def test_jsonl(self):
+        output = StringIO()
+        write_jsonl([make_client_invest_report(), make_client_invest_report()], output)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(2, len(lines))
+        record = json.loads(lines[0])
+        self.assertEqual('client.ini', record['client'])
+        self.assertEqual('2013-10-17', record['date'])
+        self.assertEqual('24.00', record['spent'])
+        self.assertEqual({'symbol': 'SYM1', 'name': 'Stock 1', 'asset_class': 'bond',
+                          'amount': 5, 'price': '4.00', 'value': '20.00'},
+                         record['current']['holdings'][0])
+
+    def test_csv(self):
+        output = StringIO()
+        write_invest_csv([make_client_invest_report()], output)
+        rows = list(csv.reader(StringIO(output.getvalue())))
+        self.assertEqual(INVEST_CSV_FIELDS, rows[0])
+        sections = [row[1] for row in rows[1:]]
+        self.assertEqual(['current', 'current_class', 'buy', 'buy', 'new', 'new', 'new_class',
+                          'new_class', 'remaining'], sections)
+        self.assertEqual(['client.ini', 'remaining', '', '', '', '', '', '1.00', '', ''],
+                         rows[-1])
+
+
+class SeligsonReportTest(unittest.TestCase):
+    def test_report(self):
+        seligson_report, pricer = make_family_seligson_report()
+        self.assertEqual(Money(30), seligson_report.current.value)
+        self.assertEqual([Money(20), Money(10)],
+                         [fund.value for fund in seligson_report.current.funds])
+        self.assertEqual([InvestmentLine(u'Eurooppa', Money(10), Money('0.10'), Money('9.90')),
+                          InvestmentLine(u'Aasia', Money(20), Money(0), Money(20))],
+                         seligson_report.investments)
+        self.assertEqual(Money('59.90'), seligson_report.new.value)
+
+    def test_empty_portfolio_value(self):
+        portfolio = seligson.Portfolio()
+        portfolio.add_fund(seligson.Fund('Aasia', 0, 100))
+        valuation = value_funds(portfolio, Mock(**{'get_share_price.return_value': 1}))
+        self.assertEqual(0, valuation.funds[0].percent)
+        self.assertEqual(-100, valuation.funds[0].deviation)
+
+    def test_text_matches_printer(self):
+        seligson_report, pricer = make_family_seligson_report()
+        output = StringIO()
+        seligson.Printer(output).print_report(seligson_report._replace(
+            date=datetime.date.today()))
+        expected = StringIO()
+        printer = seligson.Printer(expected)
+        portfolio = seligson.Portfolio()
+        portfolio.add_fund(seligson.Fund('Eurooppa', 10, 50, 1))
+        portfolio.add_fund(seligson.Fund('Aasia', 10, 50))
+        printer.print_current_portfolio(portfolio, pricer)
+        investments, new_portfolio = seligson.calculate_investments(portfolio, Money(30), pricer)
+        printer.print_investments(investments)
+        printer.print_new_portfolio(new_portfolio, pricer)
+        self.assertEqual(expected.getvalue(), output.getvalue())
+
+    def test_csv(self):
+        output = StringIO()
+        write_seligson_csv([make_family_seligson_report()[0]], output)
+        rows = list(csv.reader(StringIO(output.getvalue())))
+        self.assertEqual(SELIGSON_CSV_FIELDS, rows[0])
+        self.assertEqual(['family.ini', 'current', 'Eurooppa', '10.0000', '2.0000', '20.00', '66.7',
+                          '50.0', ''], rows[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,24 @@
 # coding=utf-8
 import sys
-from decimal import Decimal
+from decimal import Decimal, InvalidOperation
 import datetime
 import ConfigParser
 import urllib
 from collections import namedtuple
+from functools import partial
+from HTMLParser import HTMLParser
+from htmlentitydefs import name2codepoint
 
-from bs4 import BeautifulSoup
+from bs4 import UnicodeDammit
+
+import compiled
+import profiling
+import rebalance
+import report
+from price_cache import PriceCache
+from snapshot import Snapshot, SnapshotWriter
+from util import (to_fixed, from_fixed, to_cents, from_cents, divide_half_even,
+                  divide_half_away_from_zero, water_fill)
 
 
 def Money(value):
@@ -87,6 +99,18 @@ class Investment(object):
     def real_investment(self):
         return self.amount - self.fee
 
+
+class Trade(Investment):
+    # An investment with a fee of its own. Sales are negative amounts: the
+    # money they bring in is -amount, after their fee.
+    def __init__(self, fund, amount, fee):
+        Investment.__init__(self, fund, amount)
+        self._fee = fee
+
+    @property
+    def fee(self):
+        return self._fee
+
     
 def format_fund_line(*fields):
     return u'{0:20}{1:>8}{2:>8}{3:>8}{4:>8}'.format(*fields)
@@ -102,40 +126,70 @@ def make_header_lines(header):
             make_separator_line()]
 
 
-def read_portfolio(portfolio_file):
-    portfolio = Portfolio()
-    
+def compile_portfolio_file(portfolio_file):
+    # The file as plain data, amounts kept as strings to stay exact
     config = ConfigParser.ConfigParser()
     config.optionxform = str
     config.readfp(portfolio_file)
-    
+    funds = []
     for fund_name in sorted(config.sections()):
-        value = config.get(fund_name, 'omistus')
-        shares = ShareAmount(value.replace(',', '.'))
-        target_allocation = Allocation(config.get(fund_name, 'allokaatio'))
-        if config.has_option(fund_name, 'palkkio_prosentti'):
-            fee_percent = FeePercent(config.get(fund_name, 'palkkio_prosentti'))
-        else:
-            fee_percent = FeePercent(0)
-        portfolio.add_fund(Fund(fund_name, shares, target_allocation, fee_percent))
+        options = dict(config.items(fund_name))
+        funds.append([fund_name, options['omistus'].replace(',', '.'), options['allokaatio'],
+                      options.get('palkkio_prosentti', '0')])
+    return {'funds': funds}
+
+
+def load_portfolio_data(data):
+    portfolio = Portfolio()
+    for fund_name, shares, target_allocation, fee_percent in data['funds']:
+        portfolio.add_fund(Fund(fund_name, ShareAmount(shares), Allocation(target_allocation),
+                                FeePercent(fee_percent)))
 
     total_allocation = sum(fund.target_allocation for fund in portfolio.funds)
     if total_allocation != 100:
         raise ValueError('Portfolio fund allocations sum to %d%% != 100%%' % total_allocation)
-        
+
     return portfolio
-    
 
-def adjust_investments(investments, target_amount):
-    while 1:
-        total_investment = sum(i.amount for i in investments)
-        excess = total_investment - target_amount
-        n = len(investments)
-        per_investment_excess = excess / n
-        investments = [i for i in investments if i.amount >= per_investment_excess]
-        if len(investments) == n:
-            break
-    return [Investment(i.fund, Money(round(i.amount - per_investment_excess))) for i in investments]
+
+def read_portfolio(portfolio_file):
+    return load_portfolio_data(compile_portfolio_file(portfolio_file))
+
+
+def load_portfolio(path):
+    # Like read_portfolio(open(path)) through a compiled cache beside the file
+    return load_portfolio_data(compiled.load_cached(path, 'seligson', compile_portfolio_file))
+
+
+def read_compiled_portfolios(compiled_file):
+    # Yields (name, portfolio)
+    for name, data in compiled.read_compiled(compiled_file, 'seligson'):
+        yield name, load_portfolio_data(data)
+
+
+def adjust_investments(investments, target_amount, fixed_point=False):
+    if fixed_point:
+        return _adjust_investments_fixed(investments, target_amount)
+    # Sorting Decimals is slow, so the survivors are found with the amounts
+    # scaled exactly to integers
+    places = max(-min(Decimal(value).as_tuple().exponent, 0)
+                 for value in [target_amount] + [i.amount for i in investments])
+    amounts = [to_fixed(i.amount, places) for i in investments]
+    excess, n = water_fill(amounts, to_fixed(target_amount, places))
+    if not n:
+        return []
+    per_investment_excess = from_fixed(excess, places) / n
+    return [Investment(i.fund, Money(round(i.amount - per_investment_excess)))
+            for i, amount in zip(investments, amounts) if amount * n >= excess]
+
+
+def _adjust_investments_fixed(investments, target_amount):
+    # The same cuts in integer cents; the per investment excess is kept as
+    # the exact fraction excess / n
+    amounts = [(i, to_cents(i.amount)) for i in investments]
+    excess, n = water_fill([amount for _, amount in amounts], to_cents(target_amount))
+    return [Investment(i.fund, Money(divide_half_away_from_zero(amount * n - excess, 100 * n)))
+            for i, amount in amounts if amount * n >= excess]
 
 
 def filter_too_low_investments(investments, min_investment_amount=0):
@@ -148,43 +202,106 @@ def filter_too_low_investments(investments, min_investment_amount=0):
     return valid_investments
 
 
-def calculate_investments(portfolio, target_amount, pricer, min_investment_amount=0):
+def calculate_fund_value_cents(fund, pricer):
+    share_price = to_fixed(pricer.get_share_price(fund.name), 4)
+    return divide_half_even(to_fixed(fund.shares, 4) * share_price, 10**6)
+
+
+def calculate_investments(portfolio, target_amount, pricer, min_investment_amount=0,
+                          fixed_point=False):
     assert target_amount > 0
     
-    portfolio_value = portfolio.calculate_value(pricer)
-    new_value = portfolio_value + target_amount
-    investments = [Investment(fund, Money(fund.target_allocation / 100 * new_value - fund.calculate_value(pricer))) for fund in portfolio.funds]
+    if fixed_point:
+        # Money in integer cents, allocations in tenths of a percent and
+        # share amounts and prices in units of 0.0001
+        fund_values = [calculate_fund_value_cents(fund, pricer) for fund in portfolio.funds]
+        new_value = sum(fund_values) + to_cents(target_amount)
+        investments = [Investment(fund, from_cents(divide_half_even(
+                           to_fixed(fund.target_allocation, 1) * new_value - 1000 * fund_value, 1000)))
+                       for fund, fund_value in zip(portfolio.funds, fund_values)]
+    else:
+        portfolio_value = portfolio.calculate_value(pricer)
+        new_value = portfolio_value + target_amount
+        investments = [Investment(fund, Money(fund.target_allocation / 100 * new_value - fund.calculate_value(pricer))) for fund in portfolio.funds]
     
-    investments = adjust_investments(investments, target_amount)
+    return apply_investments(portfolio, investments, target_amount, pricer,
+                             min_investment_amount, fixed_point)
+
+
+def apply_investments(portfolio, investments, target_amount, pricer, min_investment_amount=0,
+                      fixed_point=False):
+    investments = adjust_investments(investments, target_amount, fixed_point)
     if min_investment_amount > 0:
         investments = filter_too_low_investments(investments, min_investment_amount)
-        investments = adjust_investments(investments, target_amount)
+        investments = adjust_investments(investments, target_amount, fixed_point)
         
     new_portfolio = portfolio.new_with_investments(investments, pricer)
         
     return investments, new_portfolio
 
 
+def calculate_rebalance(portfolio, target_amount, pricer, min_investment_amount=None,
+                        sell_fee_percent=0, penalty=1.0):
+    # Sells as well as buys, found by rebalance.solve_trades with the fees of
+    # the funds and sell_fee_percent as the costs of trading. The solver
+    # balances the money going into the funds, so the buys are then scaled
+    # for the buys to be paid by target_amount and the sales after all fees.
+    # Trades under the minimum investment are left out and the rest solved
+    # again.
+    assert target_amount >= 0
+    funds = portfolio.funds
+    values = [float(fund.calculate_value(pricer)) for fund in funds]
+    buy_rates = [1 - float(fund.fee_percent) / 100 for fund in funds]
+    sell_rate = float(sell_fee_percent) / 100
+    min_investment_amount = float(min_investment_amount or 0)
+    fixed = set()
+    while True:
+        trades = rebalance.solve_trades(
+            values, [float(fund.target_allocation) / 100 for fund in funds], float(target_amount),
+            [1 / rate - 1 for rate in buy_rates], [sell_rate] * len(funds),
+            [0 if i in fixed else -value for i, value in enumerate(values)],
+            [0 if i in fixed else rebalance.INFINITY for i in range(len(funds))], penalty)
+        too_low = set(i for i, trade in enumerate(trades)
+                      if i not in fixed and 0 < abs(trade) < min_investment_amount)
+        if not too_low:
+            break
+        fixed |= too_low
+
+    investments = [None] * len(funds)
+    for i, trade in enumerate(trades):
+        if trade < 0:
+            fee = Money(-trade * sell_rate)
+            investments[i] = Trade(funds[i], Money(trade) + fee, fee)
+    buys = [i for i, trade in enumerate(trades) if trade > 0]
+    if buys:
+        money = target_amount - sum(i.amount for i in investments if i is not None)
+        scale = float(money) / sum(trades[i] / buy_rates[i] for i in buys)
+        for i in buys:
+            investments[i] = Investment(funds[i], Money(trades[i] / buy_rates[i] * scale))
+        # Rounding to cents is made up in the largest buy
+        largest = max((investments[i] for i in buys), key=lambda buy: buy.amount)
+        largest.amount += money - sum(investments[i].amount for i in buys)
+    investments = [investment for investment in investments if investment is not None]
+    return investments, portfolio.new_with_investments(investments, pricer)
+
+
 class Printer(object):
     def __init__(self, output=sys.stdout):
         self.output = output
     
     def _print_portfolio(self, portfolio, pricer, header):
+        self._print_valuation(report.value_funds(portfolio, pricer), header)
+
+    def _print_valuation(self, valuation, header):
         output_lines = make_header_lines(header)
-        portfolio_value = portfolio.calculate_value(pricer)
-        for fund in portfolio.funds:
-            fund_value = fund.calculate_value(pricer)
-            if portfolio_value > 0.0:
-                actual_allocation = fund_value / portfolio_value * 100
-            else:
-                actual_allocation = 0
-            actual_str = '{0:.1f}%'.format(actual_allocation)
-            target_str = '{0:.1f}%'.format(fund.target_allocation)
-            deviation_str = '{0:+.1f}%'.format(actual_allocation - fund.target_allocation)
-            output_lines.append(format_fund_line(fund.name, fund_value, actual_str, target_str,
+        for fund in valuation.funds:
+            actual_str = '{0:.1f}%'.format(fund.percent)
+            target_str = '{0:.1f}%'.format(fund.target)
+            deviation_str = '{0:+.1f}%'.format(fund.deviation)
+            output_lines.append(format_fund_line(fund.name, fund.value, actual_str, target_str,
                                                  deviation_str))
         output_lines.append(make_separator_line())
-        output_lines.append(format_fund_line(u'Yhteensä', portfolio_value, '', '', ''))
+        output_lines.append(format_fund_line(u'Yhteensä', valuation.value, '', '', ''))
         print >>self.output, '\n'.join(output_lines).encode('utf-8')
 
     def print_current_portfolio(self, portfolio, pricer):
@@ -194,6 +311,11 @@ class Printer(object):
         self._print_portfolio(portfolio, pricer, 'Uusi portfolio')
         
     def print_investments(self, investments):
+        self._print_investment_lines([(investment.fund.name, investment.amount, investment.fee,
+                                       investment.real_investment)
+                                      for investment in investments])
+
+    def _print_investment_lines(self, investment_lines):
         def format_line(*args):
             return u'{0:20}{1:>8}{2:>8}{3:>10}'.format(*args)
         
@@ -203,45 +325,190 @@ class Printer(object):
         total_amount = Money(0)
         total_fees = Money(0)
         total_investment = Money(0)
-        for investment in investments:
-            output_lines.append(format_line(investment.fund.name, investment.amount, investment.fee, investment.real_investment))
-            total_amount += investment.amount
-            total_fees += investment.fee
-            total_investment += investment.real_investment
+        for name, amount, fee, real_investment in investment_lines:
+            output_lines.append(format_line(name, amount, fee, real_investment))
+            total_amount += amount
+            total_fees += fee
+            total_investment += real_investment
             
         output_lines.append('-' * 46)
         output_lines.append(format_line(u'Yhteensä', total_amount, total_fees, total_investment))
         
         print >>self.output, '\n'.join(output_lines).encode('utf-8')
+
+    def print_report(self, seligson_report):
+        self._print_valuation(seligson_report.current,
+                              'Seligson rahastot %s' % seligson_report.date)
+        self._print_investment_lines(seligson_report.investments)
+        self._print_valuation(seligson_report.new, 'Uusi portfolio')
+
+
+def write_text_reports(reports, output=sys.stdout):
+    printer = Printer(output)
+    for seligson_report in reports:
+        printer.print_report(seligson_report)
+
+
+REPORT_WRITERS = {'text': write_text_reports, 'jsonl': report.write_jsonl,
+                  'csv': report.write_seligson_csv}
         
         
 def seligson_downloader():
     return urllib.urlopen('http://www.seligson.fi/suomi/rahastot/FundValues_FI.html').read()
 
 
+class FundValuesParser(HTMLParser):
+    # Collects the cells of every table row and maps the text of each link
+    # in a row to the row's third cell, which holds the share price
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.prices = {}
+        self._tables = [None]
+        self._anchor = None
+
+    def _close_row(self):
+        row = self._tables[-1]
+        if row is not None:
+            cells, anchors = row
+            if len(cells) > 2:
+                for anchor in anchors:
+                    self.prices.setdefault(anchor, u''.join(cells[2]).strip())
+            self._tables[-1] = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'table':
+            self._tables.append(None)
+        elif tag == 'tr':
+            self._close_row()
+            self._tables[-1] = ([], [])
+        elif tag == 'td' and self._tables[-1] is not None:
+            self._tables[-1][0].append([])
+        elif tag == 'a':
+            self._anchor = []
+
+    def handle_endtag(self, tag):
+        if tag == 'table':
+            self._close_row()
+            if len(self._tables) > 1:
+                self._tables.pop()
+        elif tag == 'tr':
+            self._close_row()
+        elif tag == 'a' and self._anchor is not None:
+            if self._tables[-1] is not None:
+                self._tables[-1][1].append(u''.join(self._anchor))
+            self._anchor = None
+
+    def handle_data(self, data):
+        if self._anchor is not None:
+            self._anchor.append(data)
+        row = self._tables[-1]
+        if row is not None and row[0]:
+            row[0][-1].append(data)
+
+    def handle_entityref(self, name):
+        if name in name2codepoint:
+            self.handle_data(unichr(name2codepoint[name]))
+
+    def handle_charref(self, name):
+        if name.lower().startswith('x'):
+            self.handle_data(unichr(int(name[1:], 16)))
+        else:
+            self.handle_data(unichr(int(name)))
+
+
+def parse_fund_values(html):
+    parser = FundValuesParser()
+    parser.feed(UnicodeDammit(html, is_html=True).unicode_markup)
+    parser.close()
+    prices = {}
+    for name, value in parser.prices.items():
+        try:
+            prices[name] = SharePrice(value.replace(',', '.'))
+        except InvalidOperation:
+            pass
+    return prices
+
+
 class Pricer(object):
-    def __init__(self, downloader=seligson_downloader):
+    def __init__(self, downloader=seligson_downloader, price_cache=None):
         self.downloader = downloader
-        self._soup = None
+        self.price_cache = price_cache
+        self._prices = None
+
+    def _get_prices(self):
+        if self._prices is None:
+            self.refresh()
+        return self._prices
 
-    def _get_soup(self):
-        if self._soup is None:
+    def refresh(self):
+        with profiling.span('download'):
             html = self.downloader()
-            self._soup = BeautifulSoup(html)
-        return self._soup
+        with profiling.span('parse'):
+            prices = parse_fund_values(html)
+        if self.price_cache is not None:
+            self.price_cache.put_many([(u'seligson:' + name, name, price)
+                                       for name, price in prices.items()])
+        self._prices = prices
         
     def get_share_price(self, share_name):
-        value = self._get_soup().find('a', text=share_name).parent.parent('td')[2].text
-        return SharePrice(value.replace(',', '.'))
+        profiling.count('price_lookups')
+        if self._prices is None and self.price_cache is not None:
+            quote = self.price_cache.get(u'seligson:' + share_name)
+            if quote is not None:
+                profiling.count('price_cache_hits')
+                return SharePrice(quote[1])
+            profiling.count('price_cache_misses')
+        return self._get_prices()[share_name]
+
+
+class RecordingPricer(object):
+    def __init__(self, pricer, writer):
+        self.pricer = pricer
+        self.writer = writer
+
+    def get_share_price(self, share_name):
+        price = self.pricer.get_share_price(share_name)
+        self.writer.record(u'seligson:' + share_name, share_name, price)
+        return price
+
+    def refresh(self):
+        self.pricer.refresh()
+
+
+class SnapshotPricer(object):
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def get_share_price(self, share_name):
+        quote = self.snapshot.get(u'seligson:' + share_name)
+        if quote is None:
+            raise KeyError(share_name)
+        return SharePrice(quote[1])
+
+    def refresh(self):
+        pass
 
 
 def main(portfolio, amount, minimum_investment=None, pricer=Pricer(),
-         investment_strategy=calculate_investments, printer=Printer()):
-    printer.print_current_portfolio(portfolio, pricer)
-    investments, new_portfolio = investment_strategy(portfolio, amount, pricer,
-                                                     minimum_investment)
-    printer.print_investments(investments)
-    printer.print_new_portfolio(new_portfolio, pricer)
+         investment_strategy=calculate_investments, printer=Printer(), output_format='text',
+         output=sys.stdout):
+    if output_format != 'text':
+        current = report.value_funds(portfolio, pricer)
+        with profiling.span('solve'):
+            investments, new_portfolio = investment_strategy(portfolio, amount, pricer,
+                                                             minimum_investment)
+        with profiling.span('render'):
+            REPORT_WRITERS[output_format]([report.make_seligson_report(
+                None, current, amount, investments, new_portfolio, pricer)], output)
+        return
+    with profiling.span('render'):
+        printer.print_current_portfolio(portfolio, pricer)
+    with profiling.span('solve'):
+        investments, new_portfolio = investment_strategy(portfolio, amount, pricer,
+                                                         minimum_investment)
+    with profiling.span('render'):
+        printer.print_investments(investments)
+        printer.print_new_portfolio(new_portfolio, pricer)
 
 
 if __name__ == '__main__':
@@ -251,8 +518,53 @@ if __name__ == '__main__':
     parser.add_argument('amount')
     parser.add_argument('-m', '--minimum-investment', help='minimum investment',
                         type=Money)
+    parser.add_argument('--fixed-point', help='calculate with integer fixed-point numbers',
+                        action='store_true')
+    parser.add_argument('--rebalance', help='sell as well as buy to reach the allocations',
+                        action='store_true')
+    parser.add_argument('--sell-fee-percent', help='fee percent of sales when rebalancing',
+                        type=Decimal, default=Decimal(0))
+    parser.add_argument('--price-cache', help='persistent price cache file')
+    parser.add_argument('--cache-ttl', help='price cache time to live in seconds', type=float,
+                        default=3600)
+    parser.add_argument('--profile', help='write a JSON timing profile to FILE (default stderr)',
+                        nargs='?', const='-', metavar='FILE')
+    parser.add_argument('--compiled-cache', help='cache the parsed portfolio file beside it',
+                        action='store_true')
+    parser.add_argument('--format', help='output format', choices=sorted(REPORT_WRITERS),
+                        default='text')
+    snapshot_group = parser.add_mutually_exclusive_group()
+    snapshot_group.add_argument('--record-snapshot', help='record the prices used to a snapshot '
+                                'file', metavar='FILE')
+    snapshot_group.add_argument('--snapshot', help='use the prices of a snapshot file instead '
+                                'of downloading them', metavar='FILE')
     args = parser.parse_args()
+    if args.profile:
+        profiling.set_profiler(profiling.Profiler())
     
-    portfolio = read_portfolio(open(args.portfolio))
+    with profiling.span('read_config'):
+        if args.compiled_cache:
+            portfolio = load_portfolio(args.portfolio)
+        else:
+            portfolio = read_portfolio(open(args.portfolio))
     amount = Money(args.amount)
-    main(portfolio, amount, args.minimum_investment)
+    price_cache = None
+    if args.price_cache:
+        price_cache = PriceCache(args.price_cache, args.cache_ttl)
+    investment_strategy = calculate_investments
+    if args.fixed_point:
+        investment_strategy = partial(calculate_investments, fixed_point=True)
+    if args.rebalance:
+        investment_strategy = partial(calculate_rebalance,
+                                      sell_fee_percent=args.sell_fee_percent)
+    pricer = Pricer(price_cache=price_cache)
+    if args.snapshot:
+        pricer = SnapshotPricer(Snapshot(args.snapshot))
+    elif args.record_snapshot:
+        pricer = RecordingPricer(pricer, SnapshotWriter(args.record_snapshot))
+    main(portfolio, amount, args.minimum_investment, pricer, investment_strategy,
+         output_format=args.format)
+    if args.record_snapshot:
+        pricer.writer.close()
+    if args.profile:
+        profiling.write_profile(profiling.get_profiler(), args.profile)
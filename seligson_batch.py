@@ -0,0 +1,125 @@
+# coding=utf-8
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import report
+import seligson
+from price_cache import PriceCache
+from util import to_fixed, to_cents, from_cents
+
+
+def read_portfolios(paths, compiled_cache=False):
+    # A .jsonl path is a file of compiled portfolios named by their files
+    portfolios = []
+    for path in paths:
+        if path.endswith('.jsonl'):
+            portfolios.extend(seligson.read_compiled_portfolios(open(path)))
+        elif compiled_cache:
+            portfolios.append((path, seligson.load_portfolio(path)))
+        else:
+            portfolios.append((path, seligson.read_portfolio(open(path))))
+    return portfolios
+
+
+def _divide_half_even(numerators, denominator):
+    quotients, remainders = numpy.divmod(numerators, denominator)
+    return quotients + ((2 * remainders > denominator) |
+                        ((2 * remainders == denominator) & (quotients % 2 == 1)))
+
+
+def calculate_target_investments(portfolios, target_amount, pricer):
+    # The fixed-point investments calculate_investments starts from, for all
+    # portfolios at once in int64 arrays of every fund of every portfolio
+    if numpy is None:
+        raise RuntimeError('Vectorized investments require numpy')
+    if not portfolios:
+        return []
+    funds = [fund for portfolio in portfolios for fund in portfolio.funds]
+    share_prices = {}
+    for fund in funds:
+        if fund.name not in share_prices:
+            share_prices[fund.name] = to_fixed(pricer.get_share_price(fund.name), 4)
+    sizes = [len(portfolio.funds) for portfolio in portfolios]
+    shares = numpy.array([to_fixed(fund.shares, 4) for fund in funds], dtype=numpy.int64)
+    prices = numpy.array([share_prices[fund.name] for fund in funds], dtype=numpy.int64)
+    allocations = numpy.array([to_fixed(fund.target_allocation, 1) for fund in funds],
+                              dtype=numpy.int64)
+    fund_values = _divide_half_even(shares * prices, 10**6)
+    offsets = numpy.cumsum([0] + sizes[:-1])
+    new_values = numpy.add.reduceat(fund_values, offsets) + to_cents(target_amount)
+    amounts = _divide_half_even(allocations * numpy.repeat(new_values, sizes) -
+                                1000 * fund_values, 1000)
+    investments = [seligson.Investment(fund, from_cents(int(amount)))
+                   for fund, amount in zip(funds, amounts)]
+    return [investments[offset:offset + size] for offset, size in zip(offsets, sizes)]
+
+
+def make_reports(portfolios, amount, minimum_investment, pricer, fixed_point=False):
+    # Yields a report per (name, portfolio) as it is calculated
+    if fixed_point and numpy is not None:
+        target_investments = calculate_target_investments(
+            [portfolio for _, portfolio in portfolios], amount, pricer)
+    else:
+        target_investments = [None] * len(portfolios)
+    for (name, portfolio), investments in zip(portfolios, target_investments):
+        current = report.value_funds(portfolio, pricer)
+        if investments is None:
+            investments, new_portfolio = seligson.calculate_investments(
+                portfolio, amount, pricer, minimum_investment, fixed_point)
+        else:
+            investments, new_portfolio = seligson.apply_investments(
+                portfolio, investments, amount, pricer, minimum_investment, fixed_point)
+        yield report.make_seligson_report(name, current, amount, investments, new_portfolio,
+                                          pricer)
+
+
+def write_text_reports(reports, output=sys.stdout):
+    printer = seligson.Printer(output)
+    for seligson_report in reports:
+        print >>output, '=== %s ===' % seligson_report.client
+        printer.print_report(seligson_report)
+        print >>output
+
+
+REPORT_WRITERS = dict(seligson.REPORT_WRITERS, text=write_text_reports)
+
+
+def main(paths, amount, minimum_investment=None, pricer=None, fixed_point=False,
+         output=sys.stdout, compiled_cache=False, output_format='text'):
+    # One pricer, and so one FundValues download, serves every portfolio
+    if pricer is None:
+        pricer = seligson.Pricer()
+    reports = make_reports(read_portfolios(paths, compiled_cache), amount, minimum_investment,
+                           pricer, fixed_point)
+    REPORT_WRITERS[output_format](reports, output)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('amount')
+    parser.add_argument('portfolios', nargs='+', help='portfolio files or .jsonl files of '
+                        'compiled portfolios')
+    parser.add_argument('-m', '--minimum-investment', help='minimum investment',
+                        type=seligson.Money)
+    parser.add_argument('--fixed-point', help='calculate with integer fixed-point numbers, '
+                        'vectorized across portfolios', action='store_true')
+    parser.add_argument('--price-cache', help='persistent price cache file')
+    parser.add_argument('--cache-ttl', help='price cache time to live in seconds', type=float,
+                        default=3600)
+    parser.add_argument('--compiled-cache', help='cache each parsed portfolio file beside it',
+                        action='store_true')
+    parser.add_argument('--format', help='output format', choices=sorted(REPORT_WRITERS),
+                        default='text')
+    args = parser.parse_args()
+
+    price_cache = None
+    if args.price_cache:
+        price_cache = PriceCache(args.price_cache, args.cache_ttl)
+    main(args.portfolios, seligson.Money(args.amount), args.minimum_investment,
+         seligson.Pricer(price_cache=price_cache), args.fixed_point,
+         compiled_cache=args.compiled_cache, output_format=args.format)
@@ -0,0 +1,99 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+from mock import Mock
+
+import compiled
+import seligson
+from benchmark import make_fund_values_html, make_seligson_case
+from seligson import Money, Pricer, calculate_investments, apply_investments
+from seligson_batch import *
+
+
+PORTFOLIO = '''[Rahasto 0]
+omistus=%d
+allokaatio=60
+[Rahasto 1]
+omistus=10
+allokaatio=40
+'''
+
+
+class CalculateTargetInvestmentsTest(unittest.TestCase):
+    def test_matches_calculate_investments(self):
+        for seed in range(10):
+            portfolios = [make_seligson_case(5 + i, 1000, seed * 10 + i)[0] for i in range(4)]
+            pricer = make_seligson_case(10, 1000, seed * 10)[2]
+            expected = [calculate_investments(portfolio, Money(1000), pricer, fixed_point=True)
+                        for portfolio in portfolios]
+            portfolios = [make_seligson_case(5 + i, 1000, seed * 10 + i)[0] for i in range(4)]
+            target_investments = calculate_target_investments(portfolios, Money(1000), pricer)
+            self.assertEqual([investments for investments, _ in expected],
+                             [apply_investments(portfolio, investments, Money(1000), pricer,
+                                                fixed_point=True)[0]
+                              for portfolio, investments in zip(portfolios, target_investments)])
+
+    def test_no_portfolios(self):
+        self.assertEqual([], calculate_target_investments([], Money(1000), Mock()))
+
+
+class MainTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.paths = []
+        for i in range(3):
+            self.paths.append(os.path.join(self.directory, 'family%d.ini' % i))
+            open(self.paths[-1], 'w').write(PORTFOLIO % (i * 10))
+        self.downloader = Mock(return_value=make_fund_values_html(['Rahasto 0', 'Rahasto 1']))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_main(self, fixed_point):
+        output = StringIO()
+        main(self.paths, Money(500), pricer=Pricer(self.downloader), fixed_point=fixed_point,
+             output=output)
+        return output.getvalue()
+
+    def test_downloads_once(self):
+        output = self.run_main(False)
+        self.downloader.assert_called_once_with()
+        for path in self.paths:
+            self.assertTrue('=== %s ===' % path in output)
+
+    def test_fixed_point(self):
+        self.assertEqual(self.run_main(False), self.run_main(True))
+
+    def test_compiled_portfolios(self):
+        expected = self.run_main(False)
+        compiled_path = os.path.join(self.directory, 'families.jsonl')
+        with open(compiled_path, 'w') as compiled_file:
+            for path in self.paths:
+                compiled.write_compiled(compiled_file, path, 'seligson',
+                                        seligson.compile_portfolio_file(open(path)))
+        output = StringIO()
+        main([compiled_path], Money(500), pricer=Pricer(self.downloader), output=output)
+        self.assertEqual(expected, output.getvalue())
+
+    def test_jsonl_output(self):
+        output = StringIO()
+        main(self.paths, Money(500), pricer=Pricer(self.downloader), output=output,
+             output_format='jsonl')
+        records = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(self.paths, [record['client'] for record in records])
+        self.assertEqual(['500.00'] * 3,
+                         [str(sum(Money(investment['amount'])
+                                  for investment in record['investments']))
+                          for record in records])
+        self.downloader.assert_called_once_with()
+
+    def test_compiled_cache(self):
+        output = StringIO()
+        main(self.paths, Money(500), pricer=Pricer(self.downloader), output=output,
+             compiled_cache=True)
+        self.assertEqual(self.run_main(False), output.getvalue())
+        self.assertTrue(os.path.exists(compiled.cache_path(self.paths[0])))
@@ -125,6 +125,26 @@ class ReadFundConfigTest(unittest.TestCase):
         self.assertRaises(ValueError, read_portfolio, invalid_portfolio_file)
         
     
+FUND_VALUES_HTML = '''<html><head><meta charset="iso-8859-1"></head><body>
+<table><tr><td><a href="/">Etusivu</a></td><td>Valikko</td></tr></table>
+<table>
+<tr><th>Rahasto</th><th>Pvm</th><th>Arvo</th></tr>
+<tr><td><a href="e.htm">Eurooppa</a></td><td>17.10.2013</td><td> 2,1363 </td><td>+0,5</td></tr>
+<tr><td><a href="p.htm">Pohjois-Amer.</a></td><td>17.10.2013</td><td>0,5000</td>
+<tr><td><a href="a.htm">Aasia</a></td><td>17.10.2013</td><td><b>1</b>,0000</td></tr>
+<tr><td><a href="k.htm">Kehittyv&auml;t</a></td><td>17.10.2013</td><td>3,25</td></tr>
+</table></body></html>'''
+
+
+class ParseFundValuesTest(unittest.TestCase):
+    def test(self):
+        self.assertEqual({'Eurooppa': SharePrice('2.1363'),
+                          'Pohjois-Amer.': SharePrice('0.5'),
+                          'Aasia': SharePrice('1'),
+                          u'Kehittyv\xe4t': SharePrice('3.25')},
+                         parse_fund_values(FUND_VALUES_HTML))
+
+
 class PricerTest(unittest.TestCase):
     def test_existing_share(self):
         html = open('fundvalues.html').read()
@@ -132,6 +152,33 @@ class PricerTest(unittest.TestCase):
         pricer = Pricer(mock_downloader)
         self.assertEqual(SharePrice('2.1363'), pricer.get_share_price('Eurooppa'))
 
+    def test_downloads_once(self):
+        mock_downloader = Mock(return_value=FUND_VALUES_HTML)
+        pricer = Pricer(mock_downloader)
+        self.assertEqual(SharePrice('2.1363'), pricer.get_share_price('Eurooppa'))
+        self.assertEqual(SharePrice('1'), pricer.get_share_price('Aasia'))
+        mock_downloader.assert_called_once_with()
+
+    def test_refresh(self):
+        mock_downloader = Mock(return_value=FUND_VALUES_HTML)
+        pricer = Pricer(mock_downloader)
+        pricer.get_share_price('Eurooppa')
+        mock_downloader.return_value = FUND_VALUES_HTML.replace('2,1363', '2,2000')
+        pricer.refresh()
+        self.assertEqual(SharePrice('2.2'), pricer.get_share_price('Eurooppa'))
+
+    def test_missing_share(self):
+        pricer = Pricer(Mock(return_value=FUND_VALUES_HTML))
+        self.assertRaises(KeyError, pricer.get_share_price, 'Venaja')
+
+    def test_cached_share(self):
+        price_cache = PriceCache(':memory:')
+        price_cache.put(u'seligson:Eurooppa', 'Eurooppa', SharePrice('2.5'))
+        mock_downloader = Mock()
+        pricer = Pricer(mock_downloader, price_cache)
+        self.assertEqual(SharePrice('2.5'), pricer.get_share_price('Eurooppa'))
+        self.assertFalse(mock_downloader.called)
+
 
 class CalculateInvestmentsTest(unittest.TestCase):
     def setUp(self):
@@ -166,6 +213,70 @@ class CalculateInvestmentsTest(unittest.TestCase):
                           Fund('Pohjois-Amer.', ShareAmount(159.9), Allocation(50))],
                          new_portfolio.funds)
 
+
+class CalculateRebalanceTest(unittest.TestCase):
+    def setUp(self):
+        self.portfolio = make_portfolio()
+        self.asia_fund = self.portfolio.funds[0]
+        self.euro_fund = self.portfolio.funds[1]
+        self.usa_fund = self.portfolio.funds[2]
+        self.pricer = make_pricer()
+
+    def test_sells_overweight_fund(self):
+        investments, new_portfolio = calculate_rebalance(self.portfolio, Money(0), self.pricer)
+        self.assertEqual([Investment(self.asia_fund, Money(-8)),
+                          Investment(self.euro_fund, Money(8))], investments)
+        self.assertEqual(Money(0), sum(investment.amount for investment in investments))
+
+    def test_fees(self):
+        investments, _ = calculate_rebalance(self.portfolio, Money(10), self.pricer,
+                                             sell_fee_percent=1)
+        self.assertEqual(Money(10), sum(investment.amount for investment in investments))
+        for investment in investments:
+            self.assertEqual(investment.amount - investment.fee, investment.real_investment)
+            if investment.amount < 0:
+                self.assertEqual(Money(-investment.real_investment / 100), investment.fee)
+
+    def test_minimum_investment(self):
+        investments, _ = calculate_rebalance(self.portfolio, Money(0), self.pricer, Money(9))
+        self.assertEqual([], investments)
+
+    def test_new_portfolio(self):
+        _, new_portfolio = calculate_rebalance(self.portfolio, Money(0), self.pricer)
+        self.assertEqual([ShareAmount(12), ShareAmount(9), ShareAmount(60)],
+                         [fund.shares for fund in new_portfolio.funds])
+
+
+class FixedPointTest(unittest.TestCase):
+    def setUp(self):
+        self.pricer = MockPricer({'Eurooppa': SharePrice('2.1363'),
+                                  'Pohjois-Amer.': SharePrice('0.4711'),
+                                  'Aasia': SharePrice('1.0897')})
+
+    def assertSameInvestments(self, amount, min_investment_amount=0):
+        expected, expected_portfolio = calculate_investments(
+            make_portfolio(), amount, self.pricer, min_investment_amount)
+        investments, new_portfolio = calculate_investments(
+            make_portfolio(), amount, self.pricer, min_investment_amount, fixed_point=True)
+        self.assertEqual([(i.fund.name, i.amount) for i in expected],
+                         [(i.fund.name, i.amount) for i in investments])
+        self.assertEqual(expected_portfolio.funds, new_portfolio.funds)
+
+    def test_balanced_investments(self):
+        self.assertSameInvestments(Money(100))
+
+    def test_unbalanced_investments(self):
+        self.assertSameInvestments(Money('10.55'))
+
+    @patch('sys.stdout')
+    def test_minimum_investment(self, stdout):
+        self.assertSameInvestments(Money(40), Money(15))
+
+    def test_fund_value_cents(self):
+        fund = Fund('Eurooppa', ShareAmount('5.0005'), Allocation(30))
+        self.assertEqual(1068, calculate_fund_value_cents(fund, self.pricer))
+        self.assertEqual(Money('10.68'), fund.calculate_value(self.pricer))
+
         
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,139 @@
+import mmap
+import os
+import struct
+import time
+
+import profiling
+from util import Money, to_fixed, from_fixed
+from stock_pricer import StockPricer
+
+
+# A header with the record count followed by fixed-size records sorted by
+# key: the key and name as NUL padded UTF-8, the price in units of 0.0001 and
+# the time the price was seen
+MAGIC = 'PBSNAP01'
+HEADER = struct.Struct('<8sI')
+RECORD = struct.Struct('<48s80sqd')
+KEY_SIZE = 48
+NAME_SIZE = 80
+PRICE_PLACES = 4
+
+
+def _encode(text):
+    return text.encode('utf-8') if isinstance(text, unicode) else text
+
+
+class SnapshotWriter(object):
+    def __init__(self, path, clock=time.time):
+        self.path = path
+        self.clock = clock
+        self._records = {}
+
+    def record(self, key, name, price):
+        key = _encode(key)
+        if len(key) > KEY_SIZE:
+            raise ValueError('Snapshot key too long: %r' % key)
+        self._records[key] = (_encode(name)[:NAME_SIZE], to_fixed(price, PRICE_PLACES),
+                              self.clock())
+
+    def close(self):
+        # Written to a temporary file first so that readers never map a
+        # partially written snapshot
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, len(self._records)))
+            for key in sorted(self._records):
+                name, price, timestamp = self._records[key]
+                f.write(RECORD.pack(key, name, price, timestamp))
+        os.rename(temporary_path, self.path)
+
+
+class Snapshot(object):
+    # Lookups binary search the memory mapped file, so processes opening the
+    # same snapshot share its pages
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError('Not a price snapshot: %s' % path)
+
+    def __getstate__(self):
+        return self.path
+
+    def __setstate__(self, path):
+        self.__init__(path)
+
+    def __len__(self):
+        return self._count
+
+    def _key(self, i):
+        offset = HEADER.size + i * RECORD.size
+        return self._map[offset:offset + KEY_SIZE].rstrip('\0')
+
+    def _record(self, i):
+        key, name, price, timestamp = RECORD.unpack_from(self._map,
+                                                         HEADER.size + i * RECORD.size)
+        return key.rstrip('\0'), name.rstrip('\0'), from_fixed(price, PRICE_PLACES), timestamp
+
+    def get(self, key):
+        # Returns (name, price, timestamp) or None
+        key = _encode(key)
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._count and self._key(low) == key:
+            return self._record(low)[1:]
+        return None
+
+    def __iter__(self):
+        return (self._record(i) for i in xrange(self._count))
+
+
+class RecordingStockPricer(StockPricer):
+    def __init__(self, pricer, writer):
+        self._pricer = pricer
+        self._writer = writer
+
+    def _record(self, stock):
+        self._writer.record('yahoo:' + stock.symbol, self._pricer.get_name(stock),
+                            self._pricer.get_price(stock))
+
+    def prefetch(self, stocks):
+        stocks = list(stocks)
+        self._pricer.prefetch(stocks)
+        for stock in stocks:
+            self._record(stock)
+
+    def get_price(self, stock):
+        self._record(stock)
+        return self._pricer.get_price(stock)
+
+    def get_name(self, stock):
+        return self._pricer.get_name(stock)
+
+    def refresh(self):
+        self._pricer.refresh()
+
+
+class SnapshotStockPricer(StockPricer):
+    def __init__(self, snapshot):
+        self._snapshot = snapshot
+
+    def _get_quote(self, stock):
+        quote = self._snapshot.get('yahoo:' + stock.symbol)
+        if quote is None:
+            raise KeyError(stock.symbol)
+        return quote
+
+    def get_price(self, stock):
+        profiling.count('price_lookups')
+        return Money(self._get_quote(stock)[1])
+
+    def get_name(self, stock):
+        return self._get_quote(stock)[0]
@@ -0,0 +1,101 @@
+# coding=utf-8
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+from decimal import Decimal
+
+from mock import Mock
+
+import seligson
+from stock_pricer import TableStockPricer
+from util import Money, Stock
+from snapshot import *
+
+
+class SnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'prices.snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, records):
+        writer = SnapshotWriter(self.path, clock=Mock(return_value=1000.5))
+        for record in records:
+            writer.record(*record)
+        writer.close()
+        return Snapshot(self.path)
+
+
+class SnapshotTest(SnapshotTestCase):
+    def test_round_trip(self):
+        snapshot = self.write([('yahoo:SYM%d' % i, 'Stock %d' % i, Money(i)) for i in range(50)])
+        self.assertEqual(50, len(snapshot))
+        self.assertEqual(('Stock 7', Decimal('7'), 1000.5), snapshot.get('yahoo:SYM7'))
+        self.assertEqual(None, snapshot.get('yahoo:SYM50'))
+        self.assertEqual(None, snapshot.get('yahoo:SYM'))
+
+    def test_records_sorted(self):
+        snapshot = self.write([('b', 'B', 2), ('a', 'A', 1)])
+        self.assertEqual([('a', 'A', Decimal(1), 1000.5), ('b', 'B', Decimal(2), 1000.5)],
+                         list(snapshot))
+
+    def test_empty(self):
+        snapshot = self.write([])
+        self.assertEqual(0, len(snapshot))
+        self.assertEqual(None, snapshot.get('yahoo:SYM1'))
+
+    def test_unicode(self):
+        snapshot = self.write([(u'seligson:Kehittyv\xe4t', u'Kehittyv\xe4t', Decimal('3.2512'))])
+        self.assertEqual((u'Kehittyv\xe4t'.encode('utf-8'), Decimal('3.2512'), 1000.5),
+                         snapshot.get(u'seligson:Kehittyv\xe4t'))
+
+    def test_latest_record_kept(self):
+        snapshot = self.write([('a', 'A', 1), ('a', 'A', 2)])
+        self.assertEqual(Decimal(2), snapshot.get('a')[1])
+
+    def test_key_too_long(self):
+        writer = SnapshotWriter(self.path)
+        self.assertRaises(ValueError, writer.record, 'x' * 49, 'X', 1)
+
+    def test_not_a_snapshot(self):
+        open(self.path, 'wb').write('not a snapshot')
+        self.assertRaises(ValueError, Snapshot, self.path)
+
+    def test_pickle(self):
+        snapshot = self.write([('a', 'A', 1)])
+        self.assertEqual(Decimal(1), pickle.loads(pickle.dumps(snapshot)).get('a')[1])
+
+
+class StockPricerTest(SnapshotTestCase):
+    def test_record_and_replay(self):
+        stocks = [Stock('SYM1', 'bond'), Stock('SYM2', 'world')]
+        pricer = TableStockPricer({'SYM1': ('Stock 1', Money(4)), 'SYM2': ('Stock 2', Money(10))})
+        writer = SnapshotWriter(self.path)
+        recording_pricer = RecordingStockPricer(pricer, writer)
+        recording_pricer.prefetch(stocks[:1])
+        self.assertEqual(Money(10), recording_pricer.get_price(stocks[1]))
+        writer.close()
+
+        pricer = SnapshotStockPricer(Snapshot(self.path))
+        self.assertEqual(Money(4), pricer.get_price(stocks[0]))
+        self.assertEqual('Stock 2', pricer.get_name(stocks[1]))
+        self.assertRaises(KeyError, pricer.get_price, Stock('SYM3', 'bond'))
+
+
+class FundPricerTest(SnapshotTestCase):
+    def test_record_and_replay(self):
+        fund_pricer = Mock()
+        fund_pricer.get_share_price.return_value = seligson.SharePrice('2.1363')
+        writer = SnapshotWriter(self.path)
+        recording_pricer = seligson.RecordingPricer(fund_pricer, writer)
+        self.assertEqual(seligson.SharePrice('2.1363'),
+                         recording_pricer.get_share_price(u'Eurooppa'))
+        writer.close()
+
+        pricer = seligson.SnapshotPricer(Snapshot(self.path))
+        self.assertEqual(seligson.SharePrice('2.1363'), pricer.get_share_price(u'Eurooppa'))
+        self.assertRaises(KeyError, pricer.get_share_price, u'Aasia')
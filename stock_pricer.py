@@ -1,9 +1,45 @@
-import urllib
+import httplib
 import re
+import threading
+import urlparse
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
+import profiling
 from util import Money
 
 
+PRICE_PATTERN = re.compile(r'<span class="time_rtq_ticker"><span id="[^"]*">(\d+.\d+)</span>')
+NAME_PATTERN = re.compile(r'<div class="title"><h2>([^<]*?) \([^<]*\)</h2>')
+CHUNK_SIZE = 8192
+# Long enough to hold a whole match that straddles two chunks
+CHUNK_OVERLAP = 256
+MAX_REDIRECTS = 5
+# The most of a quote page left unread after parsing that is read to its
+# end to keep the connection, rather than opening a new one. Kept small, as
+# stopping early on a long page saves more than a new connection costs.
+MAX_DRAIN_SIZE = 4 * 1024
+
+
+def parse_yahoo_quote(chunks):
+    name = price = None
+    html = ''
+    for chunk in chunks:
+        start = max(len(html) - CHUNK_OVERLAP, 0)
+        html = html[start:] + chunk
+        if name is None:
+            m = NAME_PATTERN.search(html)
+            if m:
+                name = m.group(1)
+        if price is None:
+            m = PRICE_PATTERN.search(html)
+            if m:
+                price = Money(m.group(1))
+        if name is not None and price is not None:
+            return name, price
+    raise ValueError('Stock name or price not found in quote page')
+
+
 class StockPricer(object):
     _instance = None
 
@@ -15,35 +51,200 @@ class StockPricer(object):
     def get_pricer(cls):
         return cls._instance
 
-    
+    def prefetch(self, stocks):
+        for stock in stocks:
+            self.get_price(stock)
+
+    def get_prices(self, stocks):
+        stocks = list(stocks)
+        self.prefetch(stocks)
+        return dict((stock, self.get_price(stock)) for stock in stocks)
+
+    def refresh(self):
+        pass
+
+
+class TableStockPricer(StockPricer):
+    def __init__(self, quotes):
+        # quotes maps stock symbols to (name, price) pairs
+        self._quotes = quotes
+
+    def get_price(self, stock):
+        profiling.count('price_lookups')
+        return self._quotes[stock.symbol][1]
+
+    def get_name(self, stock):
+        return self._quotes[stock.symbol][0]
+
+
 class YahooStockPricer(StockPricer):
-    def __init__(self):
-        self._cache = {}
+    def __init__(self, url='http://finance.yahoo.com/q?s=', max_workers=8, price_cache=None,
+                 max_entries=None):
+        # Quotes in least recently used order; the oldest are evicted beyond
+        # max_entries
+        self._cache = OrderedDict()
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._price_cache = price_cache
+        self._url = urlparse.urlsplit(url)
+        self._path = urlparse.urlunsplit(('', '', self._url.path, self._url.query, ''))
+        self._max_workers = max_workers
+        self._pool = None
+        self._local = threading.local()
 
     @staticmethod
     def parse_yahoo_stock_price(html):
-        m = re.search('<span class="time_rtq_ticker"><span id=".*?">(\d+.\d+)</span>', html)
+        m = PRICE_PATTERN.search(html)
         return Money(m.group(1))
 
     @staticmethod
     def parse_yahoo_stock_name(html):
-        m = re.search('<div class="title"><h2>(.*?) \(.*\)</h2>', html)
+        m = NAME_PATTERN.search(html)
         return m.group(1)
 
-    def _cache_stock(self, stock):
-        url = 'http://finance.yahoo.com/q?s=' + stock.symbol
-        html = urllib.urlopen(url).read()
-        name = self.parse_yahoo_stock_name(html)
-        price = self.parse_yahoo_stock_price(html)
-        self._cache[stock.symbol] = (name, price)
+    def _get_connection(self, url):
+        # Each thread keeps its own keep-alive connection to each quote server.
+        # It is only reused when the previous page could be read to its end:
+        # pages whose Content-Length leaves more than MAX_DRAIN_SIZE unread,
+        # or that give no Content-Length, each take a connection of their own.
+        connections = self._local.__dict__.setdefault('connections', {})
+        connection = connections.get((url.scheme, url.netloc))
+        if connection is None:
+            if url.scheme == 'https':
+                connection = httplib.HTTPSConnection(url.netloc)
+            else:
+                connection = httplib.HTTPConnection(url.netloc)
+            connections[(url.scheme, url.netloc)] = connection
+        return connection
+
+    def _close_connection(self, url):
+        self._local.connections.pop((url.scheme, url.netloc)).close()
+
+    def _request(self, url, path):
+        # Returns the status, the Location header and, for a 200 response,
+        # the quote parsed from the page
+        for retry in (True, False):
+            connection = self._get_connection(url)
+            try:
+                connection.request('GET', path)
+                response = connection.getresponse()
+                quote = None
+                if response.status == httplib.OK:
+                    quote = parse_yahoo_quote(iter(lambda: response.read(CHUNK_SIZE), ''))
+                if (not response.isclosed() and response.length is not None and
+                        response.length <= MAX_DRAIN_SIZE):
+                    response.read()
+            except (httplib.HTTPException, IOError):
+                self._close_connection(url)
+                if not retry:
+                    raise
+                continue
+            if not response.isclosed():
+                # The rest of the page was not read, so the connection
+                # cannot be reused for the next request
+                self._close_connection(url)
+            return response.status, response.getheader('location'), quote
+
+    def _fetch_stock(self, symbol):
+        # Redirects are followed like urllib.urlopen does
+        url, path = self._url, self._path + symbol
+        for redirect in range(MAX_REDIRECTS + 1):
+            status, location, quote = self._request(url, path)
+            if status in (httplib.MOVED_PERMANENTLY, httplib.FOUND, httplib.SEE_OTHER,
+                          httplib.TEMPORARY_REDIRECT) and location:
+                url = urlparse.urlsplit(urlparse.urljoin(
+                    urlparse.urlunsplit(url[:2] + (path, '', '')), location))
+                path = urlparse.urlunsplit(('', '', url.path, url.query, ''))
+                continue
+            if status != httplib.OK:
+                raise IOError('Quote page for %s returned HTTP status %d' % (symbol, status))
+            return quote
+        raise IOError('Too many redirects for the quote page for %s' % symbol)
+
+    def _remember(self, symbols_quotes):
+        with self._lock:
+            for symbol, quote in symbols_quotes:
+                self._cache.pop(symbol, None)
+                self._cache[symbol] = quote
+            if self._max_entries is not None:
+                while len(self._cache) > self._max_entries:
+                    self._cache.popitem(last=False)
+
+    def _lookup(self, symbol):
+        with self._lock:
+            quote = self._cache.pop(symbol, None)
+            if quote is not None:
+                self._cache[symbol] = quote
+            return quote
+
+    def _load_persisted(self, symbols):
+        if self._price_cache is None:
+            return {}
+        quotes = self._price_cache.get_many(['yahoo:' + symbol for symbol in symbols])
+        return dict((key[len('yahoo:'):], (name, Money(price)))
+                    for key, (name, price) in quotes.items())
+
+    def _persist(self, symbols_quotes):
+        if self._price_cache is not None:
+            self._price_cache.put_many([('yahoo:' + symbol, name, price)
+                                        for symbol, (name, price) in symbols_quotes])
+
+    def _get_pool(self):
+        # The pool lives as long as the pricer, so the connections its
+        # threads keep are reused by later fetches
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self._max_workers)
+            return self._pool
+
+    def _fetch_stocks(self, symbols):
+        # Quote pages are parsed while they stream in, so parsing is part
+        # of the download span
+        with profiling.span('download'):
+            quotes = self._get_pool().map(self._fetch_stock, symbols)
+        self._remember(zip(symbols, quotes))
+        self._persist(zip(symbols, quotes))
+        return quotes
+
+    def close(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def prefetch(self, stocks):
+        with self._lock:
+            symbols = set(stock.symbol for stock in stocks) - set(self._cache)
+        persisted = self._load_persisted(symbols)
+        self._remember(persisted.items())
+        symbols = sorted(symbols - set(persisted))
+        if self._price_cache is not None:
+            profiling.count('price_cache_hits', len(persisted))
+            profiling.count('price_cache_misses', len(symbols))
+        if symbols:
+            self._fetch_stocks(symbols)
+
+    def refresh(self):
+        # Downloads every cached quote again
+        with self._lock:
+            symbols = list(self._cache)
+        if symbols:
+            self._fetch_stocks(symbols)
+
+    def _get_quote(self, stock):
+        quote = self._lookup(stock.symbol)
+        if quote is None:
+            self.prefetch([stock])
+            quote = self._lookup(stock.symbol)
+        if quote is None:
+            # Evicted already by a concurrent fetch
+            quote = self._fetch_stocks([stock.symbol])[0]
+        return quote
 
     def get_price(self, stock):
-        if stock.symbol not in self._cache:
-            self._cache_stock(stock)
-        return self._cache[stock.symbol][1]
+        profiling.count('price_lookups')
+        return self._get_quote(stock)[1]
 
     def get_name(self, stock):
-        if stock.symbol not in self._cache:
-            self._cache_stock(stock)
-        return self._cache[stock.symbol][0]
-    
+        return self._get_quote(stock)[0]
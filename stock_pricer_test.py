@@ -1,7 +1,12 @@
+import socket
+import threading
 import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
 
 from mock import Mock, sentinel
 
+from price_cache import PriceCache
 from util import *
 from stock_pricer import *
 
@@ -14,3 +19,193 @@ class ParseYahooPriceTest(unittest.TestCase):
     def test_get_name(self):
         html = open('yahoo.html').read()
         self.assertEqual('DBXT MSCI WORLD 1C', YahooStockPricer.parse_yahoo_stock_name(html))
+
+
+class ParseYahooQuoteTest(unittest.TestCase):
+    def setUp(self):
+        self.html = open('yahoo.html').read()
+        self.chunks_read = 0
+
+    def chunks(self, size):
+        for i in range(0, len(self.html), size):
+            self.chunks_read += 1
+            yield self.html[i:i + size]
+
+    def test_parse(self):
+        self.assertEqual(('DBXT MSCI WORLD 1C', Money(27.64)), parse_yahoo_quote(self.chunks(8192)))
+
+    def test_stops_reading_when_found(self):
+        parse_yahoo_quote(self.chunks(8192))
+        self.assertEqual(4, self.chunks_read)
+
+    def test_match_split_between_chunks(self):
+        self.assertEqual(('DBXT MSCI WORLD 1C', Money(27.64)), parse_yahoo_quote(self.chunks(7)))
+
+    def test_not_found(self):
+        self.assertRaises(ValueError, parse_yahoo_quote, ['<html>', '</html>'])
+
+
+class FakeQuoteServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeQuoteHandler)
+        self.html = open('yahoo.html').read()
+        self.paths = []
+        self.connections = set()
+        self.redirects = {}
+        self.status = 200
+        self.sockets = []
+
+    def close(self):
+        self.shutdown()
+        for client_socket in self.sockets:
+            try:
+                client_socket.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        self.server_close()
+
+
+class FakeQuoteHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.sockets.append(self.connection)
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        self.server.connections.add(self.client_address)
+        if self.path in self.server.redirects:
+            self.send_response(301)
+            self.send_header('Location', self.server.redirects[self.path])
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        html = self.server.html if self.server.status == 200 else 'Not found'
+        self.send_response(self.server.status)
+        self.send_header('Content-Length', str(len(html)))
+        self.end_headers()
+        self.wfile.write(html)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakePricer(StockPricer):
+    def __init__(self):
+        self.get_price = Mock(side_effect=lambda stock: Money(len(stock.symbol)))
+
+
+class StockPricerTest(unittest.TestCase):
+    def test_get_prices(self):
+        pricer = FakePricer()
+        stocks = [Stock('A', 'bond'), Stock('BB', 'world')]
+        self.assertEqual({stocks[0]: Money(1), stocks[1]: Money(2)}, pricer.get_prices(stocks))
+
+
+class TableStockPricerTest(unittest.TestCase):
+    def test(self):
+        pricer = TableStockPricer({'SYM1': ('Stock 1', Money(2))})
+        self.assertEqual(Money(2), pricer.get_price(Stock('SYM1', 'bond')))
+        self.assertEqual('Stock 1', pricer.get_name(Stock('SYM1', 'bond')))
+
+
+class YahooStockPricerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeQuoteServer()
+        thread = threading.Thread(target=self.server.serve_forever, args=(0.01,))
+        thread.daemon = True
+        thread.start()
+        url = 'http://127.0.0.1:%d/q?s=' % self.server.server_address[1]
+        self.pricer = YahooStockPricer(url, max_workers=2)
+        self.stocks = [Stock('SYM%d' % i, 'world') for i in range(6)]
+
+    def tearDown(self):
+        self.pricer.close()
+        self.server.close()
+
+    def test_prefetch_fetches_every_symbol_once(self):
+        self.pricer.prefetch(self.stocks + self.stocks[:2])
+        self.assertItemsEqual(['/q?s=SYM%d' % i for i in range(6)], self.server.paths)
+
+    def test_prefetch_reuses_connections(self):
+        self.server.html = self.server.html[:30000]
+        self.pricer.prefetch(self.stocks)
+        self.assertLessEqual(len(self.server.connections), 2)
+
+    def test_connections_reused_across_prefetches(self):
+        self.server.html = self.server.html[:30000]
+        stocks = [Stock('SYM%d' % i, 'world') for i in range(16)]
+        for i in range(0, 16, 4):
+            self.pricer.prefetch(stocks[i:i + 4])
+        self.assertEqual(16, len(self.server.paths))
+        self.assertLessEqual(len(self.server.connections), 2)
+
+    def test_connection_reused_after_draining_rest_of_page(self):
+        # The quote is found in the first 32 KB
+        self.server.html = self.server.html[:34000]
+        pricer = YahooStockPricer(self.pricer._url.geturl(), max_workers=1)
+        pricer.get_price(self.stocks[0])
+        pricer.get_price(self.stocks[1])
+        pricer.close()
+        self.assertEqual(1, len(self.server.connections))
+
+    def test_connection_not_reused_after_early_exit_from_long_page(self):
+        # Over 30 KB of the page are left unread
+        pricer = YahooStockPricer(self.pricer._url.geturl(), max_workers=1)
+        pricer.get_price(self.stocks[0])
+        self.assertEqual(Money(27.64), pricer.get_price(self.stocks[1]))
+        pricer.close()
+        self.assertEqual(2, len(self.server.connections))
+
+    def test_redirect_followed(self):
+        self.server.redirects['/q?s=SYM0'] = '/quote?s=SYM0'
+        self.assertEqual(Money(27.64), self.pricer.get_price(self.stocks[0]))
+        self.assertEqual(['/q?s=SYM0', '/quote?s=SYM0'], self.server.paths)
+
+    def test_http_error(self):
+        self.server.status = 404
+        self.assertRaisesRegexp(IOError, 'HTTP status 404', self.pricer.get_price,
+                                self.stocks[0])
+
+    def test_prices_served_from_prefetched_quotes(self):
+        self.pricer.prefetch(self.stocks)
+        self.assertEqual(Money(27.64), self.pricer.get_price(self.stocks[3]))
+        self.assertEqual('DBXT MSCI WORLD 1C', self.pricer.get_name(self.stocks[3]))
+        self.assertEqual(6, len(self.server.paths))
+
+    def test_get_prices(self):
+        prices = self.pricer.get_prices(self.stocks[:3])
+        self.assertEqual(dict((stock, Money(27.64)) for stock in self.stocks[:3]), prices)
+
+    def test_persistent_cache_avoids_downloads(self):
+        price_cache = PriceCache(':memory:')
+        price_cache.put('yahoo:SYM0', 'Cached name', Money(1))
+        pricer = YahooStockPricer(self.pricer._url.geturl(), price_cache=price_cache)
+        pricer.prefetch(self.stocks[:2])
+        self.assertEqual(Money(1), pricer.get_price(self.stocks[0]))
+        self.assertEqual('Cached name', pricer.get_name(self.stocks[0]))
+        self.assertEqual(['/q?s=SYM1'], self.server.paths)
+        self.assertEqual(('DBXT MSCI WORLD 1C', Money(27.64)), price_cache.get('yahoo:SYM1'))
+
+    def test_lru_eviction(self):
+        pricer = YahooStockPricer(self.pricer._url.geturl(), max_entries=2)
+        pricer.prefetch(self.stocks[:2])
+        pricer.get_price(self.stocks[0])
+        pricer.get_price(self.stocks[2])
+        self.assertEqual(['SYM0', 'SYM2'], list(pricer._cache))
+        pricer.get_price(self.stocks[1])
+        self.assertEqual(4, len(self.server.paths))
+
+    def test_refresh(self):
+        self.pricer.prefetch(self.stocks[:2])
+        self.server.html = self.server.html.replace('27.64', '28.00')
+        self.pricer.refresh()
+        self.assertEqual(Money(28), self.pricer.get_price(self.stocks[0]))
+        self.assertEqual(4, len(self.server.paths))
+
+    def test_lazy_fetch(self):
+        self.assertEqual(Money(27.64), self.pricer.get_price(self.stocks[0]))
+        self.assertEqual(['/q?s=SYM0'], self.server.paths)
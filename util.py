@@ -1,9 +1,10 @@
 from collections import namedtuple, defaultdict
-from decimal import Decimal
+from decimal import Decimal, ROUND_HALF_EVEN
 
 
 Stock = namedtuple('Stock', 'symbol asset_class')
 Buy = namedtuple('Buy', 'stock amount')
+RepairStats = namedtuple('RepairStats', 'moves evaluations cold_evaluations')
 
 
 def Money(value):
@@ -15,4 +16,57 @@ def compress_buys(buys):
     for buy in buys:
         buy_dict[buy.stock] += buy.amount
     return [Buy(stock, amount) for stock, amount in buy_dict.items()]
-    
+
+
+# Fixed-point numbers are integers counting units of 10**-places, e.g. money
+# as integer cents with places=2
+
+def to_fixed(value, places):
+    sign, digits, exponent = Decimal(value).as_tuple()
+    if isinstance(exponent, int) and exponent + places >= 0:
+        # Exact, so the digits can be used directly
+        units = int(''.join(map(str, digits))) * 10 ** (exponent + places)
+        return -units if sign else units
+    return int(Decimal(value).scaleb(places).to_integral_value(ROUND_HALF_EVEN))
+
+
+def from_fixed(units, places):
+    return Decimal(units).scaleb(-places)
+
+
+def to_cents(money):
+    return to_fixed(money, 2)
+
+
+def from_cents(cents):
+    # Formatting is much faster than Decimal arithmetic
+    return Decimal('%s%d.%02d' % ('-' if cents < 0 else '', abs(cents) // 100, abs(cents) % 100))
+
+
+def divide_half_even(numerator, denominator):
+    assert denominator > 0
+    quotient, remainder = divmod(numerator, denominator)
+    if 2 * remainder > denominator or (2 * remainder == denominator and quotient % 2):
+        quotient += 1
+    return quotient
+
+
+def divide_half_away_from_zero(numerator, denominator):
+    assert denominator > 0
+    quotient = (2 * abs(numerator) + denominator) // (2 * denominator)
+    return quotient if numerator >= 0 else -quotient
+
+
+def water_fill(amounts, target):
+    # The excess over the target is cut evenly from the amounts, and any
+    # amount smaller than its cut is dropped and the cut recomputed. The
+    # survivors are always the n largest amounts for the largest n whose
+    # smallest amount covers its cut, so one scan of the sorted amounts finds
+    # them. Returns the final excess and the number of survivors.
+    amounts = sorted(amounts, reverse=True)
+    total = sum(amounts)
+    for n in range(len(amounts), 0, -1):
+        if amounts[n - 1] * n >= total - target:
+            return total - target, n
+        total -= amounts[n - 1]
+    return 0, 0
@@ -0,0 +1,34 @@
+import unittest
+from decimal import Decimal
+
+from util import *
+
+
+class FixedPointTest(unittest.TestCase):
+    def test_to_fixed(self):
+        self.assertEqual(123456, to_fixed(Decimal('12.3456'), 4))
+        self.assertEqual(-1250, to_cents(Money('-12.50')))
+        self.assertEqual(1200, to_cents(Decimal('12')))
+        self.assertEqual(0, to_fixed(Decimal('-0.0'), 1))
+
+    def test_to_fixed_rounds_half_even(self):
+        self.assertEqual([12, 12, 14, -12], [to_fixed(Decimal(value), 1)
+                                             for value in ['1.15', '1.25', '1.35', '-1.25']])
+
+    def test_from_fixed(self):
+        self.assertEqual(Decimal('12.3456'), from_fixed(123456, 4))
+        self.assertEqual(Money('-12.50'), from_cents(-1250))
+        self.assertEqual(['0.00', '0.05', '-0.05', '-1234.56'],
+                         [str(from_cents(cents)) for cents in [0, 5, -5, -123456]])
+
+    def test_divide_half_even(self):
+        self.assertEqual([0, 2, 2, 2, -2, -2], [divide_half_even(n, 10) for n in
+                                                [4, 15, 16, 25, -15, -25]])
+
+    def test_divide_half_even_matches_quantize(self):
+        for n in range(-300, 300):
+            self.assertEqual(Money(Decimal(n) / 1000), from_cents(divide_half_even(n, 10)))
+
+    def test_divide_half_away_from_zero_matches_round(self):
+        for n in range(-300, 300):
+            self.assertEqual(round(n / 20.0), divide_half_away_from_zero(n, 20))